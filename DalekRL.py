@@ -10,20 +10,31 @@ import libtcodpy as libtcod
 # our imports
 from interfaces import Position, TurnTaker
 from ui import UI
-from maps import Map
 from player import Player
 from errors import GameOverError, LevelWinError
+from context import GameContext
+from replay import Recording, Recorder
+from pregen import LevelPregenerator
+from levelcache import next_level
 
 SCREEN_SIZE = Position(80,50)
 LIMIT_FPS = 10
 RANDOM_SEED = 1999
-MAP = None
-PLAYER = None
 
 # for now
 if len(sys.argv)>1 and sys.argv[0].startswith('DalekRL') and len(sys.argv[1])>0:
     RANDOM_SEED=int(sys.argv[1])-1
 
+# record each game to this directory, for replay.py
+RECORD_DIR = None
+if len(sys.argv)>2 and sys.argv[0].startswith('DalekRL'):
+    RECORD_DIR=sys.argv[2]
+
+GAME = GameContext(RANDOM_SEED)
+
+# generates each next level while the current one is played
+PREGEN = None
+
 def init():
     # init window
     font = os.path.join(b'resources', b'consolas10x10_gs_tc.png')
@@ -39,46 +50,54 @@ def init():
     libtcod.console_set_color_control(libtcod.COLCTRL_5,libtcod.purple,libtcod.black)
 
 
-def reset(keep_player=False):
-    global SCREEN_SIZE, RANDOM_SEED, MAP, PLAYER
-
-    RANDOM_SEED += 1
-    UI.clear_all()
-    TurnTaker.clear_all()
-
-    if keep_player:
-        PLAYER.refresh_turntaker()
-        PLAYER.levels_seen += 1
-
-    else:
+def reset(game, keep_player=False):
+    """start the next level of game (a GameContext); a new game unless keep_player is set"""
+    def new_player():
+        if not RECORD_DIR is None:
+            game.recorder = Recorder(Recording(game.seed,SCREEN_SIZE-(0,4)))
+        return Player()
 
-        if not PLAYER is None:
+    with game:
+        if not keep_player and not game.player is None:
             print("Game Over")
-            print("%d evidence in %d turns; %d levels seen" %(len(PLAYER.evidence),PLAYER.turns,PLAYER.levels_seen))
+            print("%d evidence in %d turns; %d levels seen" %(len(game.player.evidence),game.player.turns,game.player.levels_seen))
+            save_recording(game, Recording.GAME_OVER)
 
-        PLAYER = Player()
+        next_level(game, SCREEN_SIZE-(0,4), not keep_player and new_player or None, PREGEN)
+        if not PREGEN is None:
+            PREGEN.request(game.seed+1)
 
-    if not MAP is None:
-        MAP.close()
-        del MAP
 
-    MAP = Map.random(RANDOM_SEED,SCREEN_SIZE-(0,4),PLAYER)
-    MAP.generate()
+def save_recording(game, outcome):
+    """finish and save the recording of game, if there is one"""
+    if game.recorder is None or game.player is None:
+        return
+    game.recorder.finish(game.player, outcome)
+    r = game.recorder.recording
+    r.save(os.path.join(RECORD_DIR, 'dalekrl-%d.json' % r.seed))
+    game.recorder = None
 
 
 
 
 if __name__ == '__main__':
+    # start the worker before the window opens, so it doesn't inherit it
+    PREGEN = LevelPregenerator(SCREEN_SIZE-(0,4))
     init()
 
     # main loop
-    reset()
-    while not libtcod.console_is_window_closed():
-        print("-------------")
-        try:
-            # monster movement and items
-            TurnTaker.take_all_turns()
-        except GameOverError:
-            reset(False)
-        except LevelWinError:
-            reset(True)
+    GAME.activate()
+    reset(GAME)
+    try:
+        while not libtcod.console_is_window_closed():
+            print("-------------")
+            try:
+                # monster movement and items
+                TurnTaker.take_all_turns(GAME)
+            except GameOverError:
+                reset(GAME, False)
+            except LevelWinError:
+                reset(GAME, True)
+    finally:
+        save_recording(GAME, Recording.STOPPED)
+        PREGEN.close()
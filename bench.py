@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for hot parts of the game.
+
+Usage: bench.py [-n NUMBER] [-r ROUNDS] [-s SEED] position|daleks
+
+position: interfaces.Position against the class it replaced (LegacyPosition, below), operation by operation, and
+the memory taken by a map's worth of positions. Times are the best of several runs, in nanoseconds per operation.
+
+daleks: a level of SEED with 200 daleks on it, and what each round of their turns has to work out, as it was done
+one dalek at a time and as it is done for all of them at once: whether they can see the player, and (for all of
+them, as if every one was chasing) the next step towards the player. Times are the best of ROUNDS rounds, in
+milliseconds per round."""
+
+# system imports
+import sys
+import argparse
+import timeit
+import tracemalloc
+import io
+import contextlib
+from math import hypot
+
+# our imports
+from interfaces import Position
+from context import GameContext
+
+
+class LegacyPosition:
+    """interfaces.Position as it was before it was slotted, immutable and interned; kept for comparison"""
+    def __init__(self, x, y=None):
+        if y is None:
+            if isinstance(x, tuple) or isinstance(x, list):
+                y = x[1]
+                x = x[0]
+            elif isinstance(x, LegacyPosition):
+                y = x.y
+                x = x.x
+        self.x = x
+        self.y = y
+
+    def __hash__(self):
+        return hash((self.x, self.y))
+
+    def __add__(self, other):
+        if isinstance(other, tuple):
+            return LegacyPosition(self.x + other[0], self.y + other[1])
+        else:
+            return LegacyPosition(self.x + other.x, self.y + other.y)
+
+    def __sub__(self, other):
+        if isinstance(other, tuple):
+            return LegacyPosition(self.x - other[0], self.y - other[1])
+        else:
+            return LegacyPosition(self.x - other.x, self.y - other.y)
+
+    def __eq__(self, other):
+        if not isinstance(other, LegacyPosition):
+            other = LegacyPosition(other)
+        return self.x == other.x and self.y == other.y
+
+    def distance_to(self, other):
+        if not isinstance(other, LegacyPosition):
+            other = LegacyPosition(other)
+        return hypot(self.x - other.x, self.y - other.y)
+
+
+POSITION_OPS = (
+    ('construct',    'P(31, 17)'),
+    ('add',          'a + b'),
+    ('add tuple',    'a + (1, 1)'),
+    ('sub',          'a - b'),
+    ('eq',           'a == c'),
+    ('eq tuple',     'a == (10, 20)'),
+    ('hash',         'hash(a)'),
+    ('dict lookup',  'd.get(c)'),
+    ('distance',     'a.distance_to(b)'),
+    )
+
+def position(number=100000, repeat=5, size=(80, 46)):
+    """{class name: {operation: best ns per operation}}, and {class name: bytes held by 5 positions per cell of a
+    map of size, made as the game makes them, one at a time}"""
+    times  = {}
+    memory = {}
+    for P in (LegacyPosition, Position):
+        env = {'P': P, 'a': P(10, 20), 'b': P(1, -1), 'c': P(10, 20),
+               'd': dict((P(x, y), None) for x in range(size[0]) for y in range(size[1]))}
+        times[P.__name__] = dict((op, min(timeit.repeat(stmt, globals=env, number=number, repeat=repeat)) / number * 1e9)
+                                 for (op, stmt) in POSITION_OPS)
+        tracemalloc.start()
+        keep = [P(x, y) for x in range(size[0]) for y in range(size[1]) for i in range(5)]
+        memory[P.__name__] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del keep
+    return (times, memory)
+
+
+def daleks(rounds=20, seed=1, count=200):
+    """{way: best ms per round} for a level of seed with count daleks on it"""
+    import sweep
+    from maps import Map
+    from monsters import Dalek, DalekAI
+    from player import HeadlessPlayer
+
+    game = GameContext(seed)
+    with game, contextlib.redirect_stdout(io.StringIO()):
+        p = game.player = HeadlessPlayer(sweep.stair_runner)
+        m = game.map = Map.random(seed, Position(sweep.MAP_SIZE), p, game)
+        m.generate()
+        rng = game.rng('bench')
+        while len(m.find_all(DalekAI)) < count:
+            m.add(Dalek(m.find_random_clear(rng)))
+        ds = m.find_all(DalekAI)
+        p.reset_fov()
+
+        def sight_each():
+            return [m.can_see(d, p, DalekAI.ANGLE_OF_VIS) for d in ds]
+
+        def sight_all():
+            game.ticks += 1
+            return [d.can_see_player() for d in ds]
+
+        def chase_each():
+            return [m.get_path(d.pos, p.pos, 1) for d in ds]
+
+        def chase_all():
+            m.use_flow(p.pos)
+            steps = [m.flow_step(d.pos, p.pos) for d in ds]
+            m.release_flow(p.pos)
+            return steps
+
+        assert sight_each() == sight_all()
+        times = dict((f.__name__, min(timeit.repeat(f, number=1, repeat=rounds)) * 1e3)
+                     for f in (sight_each, sight_all, chase_each, chase_all))
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hot parts of DalekRL")
+    parser.add_argument('-n', '--number', type=int, default=100000, help="operations per timing")
+    parser.add_argument('-r', '--rounds', type=int, default=20, help="rounds of turns to time")
+    parser.add_argument('-s', '--seed', type=int, default=1, help="level to put the daleks on")
+    parser.add_argument('benchmark', choices=['position', 'daleks'])
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'daleks':
+        times = daleks(args.rounds, args.seed)
+        print("sight\t%.2fms one at a time\t%.2fms all at once" % (times['sight_each'], times['sight_all']))
+        print("chase\t%.2fms one at a time\t%.2fms shared field" % (times['chase_each'], times['chase_all']))
+        return
+
+    (times, memory) = position(args.number)
+    names = list(times.keys())
+    print("\t".join(['op'] + names))
+    for (op, stmt) in POSITION_OPS:
+        print("\t".join([op] + ["%.0fns" % times[n][op] for n in names]))
+    print("\t".join(['memory'] + ["%dKB" % (memory[n] // 1024) for n in names]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Per-game state, so that more than one game can run in a process"""
+
+import threading
+import weakref
+import zlib
+import ctypes
+
+import libtcodpy as libtcod
+
+
+# bytes in a libtcod RNG (TCOD_random_save copies this much)
+RNG_STATE_SIZE = 18900
+
+def save_rng(rng):
+    """libtcod RNG state as bytes (None for the global RNG)"""
+    if rng is None:
+        return None
+    return ctypes.string_at(rng, RNG_STATE_SIZE)
+
+def load_rng(state):
+    """new libtcod RNG from save_rng() bytes"""
+    if state is None:
+        return None
+    assert len(state) == RNG_STATE_SIZE, "not a libtcod RNG state"
+    rng = libtcod.random_new()
+    ctypes.memmove(rng, state, RNG_STATE_SIZE)
+    return rng
+
+
+class AlertRegistry:
+    """Positions that have been investigated, so that Alertables can forget alerts about them (see Alertable).
+    Alerts are numbered in the order they're made, so marking a position as investigated is one assignment however
+    many Alertables were alerted to it: each forgets its alerts about the position made before then, when it next
+    looks at them"""
+    def __init__(self):
+        self.serial       = 0
+        self.investigated = {} # Position: serial when last investigated
+
+    def next_serial(self):
+        """number for a new alert"""
+        self.serial += 1
+        return self.serial
+
+    def investigate(self, pos):
+        """pos has been investigated; alerts about it made before now are old news"""
+        self.investigated[pos] = self.next_serial()
+
+    def is_current(self, pos, serial):
+        """has pos gone uninvestigated since alert number serial was made?"""
+        return self.investigated.get(pos, 0) < serial
+
+
+class GameContext:
+    """Everything that belongs to one running game: turn order, UI elements, things that can be alerted
+    or are talking, console switches, and the current map and player.
+
+    Each thread has a current context. Objects join whichever context is current when they are created,
+    so build and play a game inside "with context:" (or after context.activate()). Threads get their
+    own default context, so games on different threads never see each other.
+
+    Randomness during play comes from rng(stream), so a seeded game plays out the same way every time
+    it is given the same input."""
+    __local = threading.local()
+
+    def __init__(self, seed=None):
+        # TurnTaker
+        self.turn_takers       = []
+        self.ticks             = 0 # rounds of turns begun
+        # UI
+        self.ui_elements       = []
+        self.timeout_register  = {}
+        # Alertable, Talker
+        self.alertables        = weakref.WeakSet()
+        self.alerts            = AlertRegistry()
+        self.currently_talking = weakref.WeakSet()
+        # CameraConsole, TrapConsole
+        self.cameras_on        = True
+        self.traps_on          = True
+        # the game itself
+        self.seed              = seed
+        self.map               = None
+        self.player            = None
+        # Recorder or Replayer, if this game's input is being recorded or replayed (see replay.py)
+        self.recorder          = None
+
+        self.__rngs            = {}
+        self.__previous        = []
+
+    def __del__(self):
+        for rng in self.__rngs.values():
+            libtcod.random_delete(rng)
+
+    def __str__(self):
+        return "GameContext for seed %s" % self.seed
+
+    def __getstate__(self):
+        # weak references become the (live) objects themselves, in the same order; RNGs become their state
+        d = self.__dict__.copy()
+        d['turn_takers']       = [r() for r in self.turn_takers if not r() is None]
+        d['ui_elements']       = [r() for r in self.ui_elements if not r() is None]
+        d['alertables']        = list(self.alertables)
+        d['currently_talking'] = list(self.currently_talking)
+        d['recorder']          = None
+        d['_GameContext__rngs']     = dict((k, save_rng(r)) for (k, r) in self.__rngs.items())
+        d['_GameContext__previous'] = []
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.turn_takers       = [weakref.ref(t) for t in d['turn_takers']]
+        self.ui_elements       = [weakref.ref(u) for u in d['ui_elements']]
+        self.alertables        = weakref.WeakSet(d['alertables'])
+        self.currently_talking = weakref.WeakSet(d['currently_talking'])
+        self.__rngs            = dict((k, load_rng(r)) for (k, r) in d['_GameContext__rngs'].items())
+
+    def rng(self, stream):
+        """libtcod RNG for the named stream of this game's randomness (e.g. 'ai', 'talk', 'draw').
+        Each stream is seeded from the game seed and the stream name, so that drawing the screen, say,
+        doesn't change what monsters do. Returns None (the global RNG) if the game has no seed"""
+        if self.seed is None:
+            return None
+        rng = self.__rngs.get(stream)
+        if rng is None:
+            rng = libtcod.random_new_from_seed(zlib.crc32(stream.encode(), self.seed & 0xffffffff))
+            self.__rngs[stream] = rng
+        return rng
+
+    def restart_rngs(self):
+        """start every stream afresh from the current seed, e.g. for a new game"""
+        for rng in self.__rngs.values():
+            libtcod.random_delete(rng)
+        self.__rngs = {}
+
+    @staticmethod
+    def current():
+        """context for the calling thread, creating one if needed"""
+        c = getattr(GameContext.__local, 'context', None)
+        if c is None:
+            c = GameContext()
+            GameContext.__local.context = c
+        return c
+
+    def activate(self):
+        """make this the calling thread's current context. Returns the context it replaces"""
+        previous = getattr(GameContext.__local, 'context', None)
+        GameContext.__local.context = self
+        return previous
+
+    def __enter__(self):
+        self.__previous.append(self.activate())
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        GameContext.__local.context = self.__previous.pop()
+        return False
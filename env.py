@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Step-by-step game environments for bots and automated playtesting.
+
+DalekEnv runs one headless game: reset(seed) starts it, step(action) plays one round. VecDalekEnv steps
+several of them in lockstep, one worker process each, exchanging observations, rewards and done flags
+through shared memory."""
+
+# system imports
+import os
+import sys
+import traceback
+import multiprocessing
+
+# our imports
+from interfaces import Position, TurnTaker
+from maps import Map
+from player import HeadlessPlayer
+from context import GameContext
+from levelcache import next_level
+from errors import GameOverError, LevelWinError, WorkerError
+from sweep import MAP_SIZE
+
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+
+class ActionPolicy:
+    """HeadlessPlayer policy that plays the action it has been given, once, and then waits. Holds nothing else, so
+    games it plays can be saved and forked (see snapshot.py)"""
+    def __init__(self):
+        self.action = None # Player.KEYMAP key
+
+    def __call__(self, player):
+        # first key of the round is the chosen action; if the turn isn't over after it, wait
+        a = self.action
+        self.action = None
+        return a is None and '.' or a
+
+
+class DalekEnv:
+    """A single headless game, driven one round at a time. Its game can be swapped for a fork of it (see
+    snapshot.fork), e.g. to look ahead"""
+    # actions are indices into this list of Player.KEYMAP keys
+    ACTIONS = ['.', 'k', 'j', 'h', 'l', 'y', 'u', 'b', 'n', ' ', '1', '2', '3', '4', '5', '6']
+
+    REWARD_EVIDENCE = 1.0   # per piece of evidence collected
+    REWARD_LEVEL    = 10.0  # per level escaped
+    REWARD_CAUGHT   = -10.0 # game over
+
+    def __init__(self, size=MAP_SIZE, max_turns=1000, obs_buffer=None):
+        """obs_buffer is an optional writable bytes-like object to write observations into
+        (e.g. a slice of shared memory); otherwise one is allocated"""
+        self.size      = Position(size)
+        self.max_turns = max_turns
+        self.game      = None
+
+        self.observation_size = len(Map.OBSERVATION_CHANNELS) * self.size.x * self.size.y
+        if obs_buffer is None:
+            obs_buffer = bytearray(self.observation_size)
+        self.__obs_buffer = memoryview(obs_buffer).cast('B')
+        assert len(self.__obs_buffer) == self.observation_size, "observation buffer is the wrong size"
+
+        if numpy_available:
+            self.observation = numpy.frombuffer(self.__obs_buffer, dtype=numpy.uint8).reshape(
+                len(Map.OBSERVATION_CHANNELS), self.size.x, self.size.y)
+        else:
+            self.observation = self.__obs_buffer
+
+    def reset(self, seed):
+        """start a new game from seed and return the first observation"""
+        self.game = GameContext(seed - 1) # next_level moves on to seed
+        with self.game:
+            next_level(self.game, self.size, lambda: HeadlessPlayer(ActionPolicy()))
+            self.game.map.observe(self.__obs_buffer)
+        return self.observation
+
+    def step(self, action):
+        """play one round with action (an index into ACTIONS).
+        Returns (observation, reward, done)"""
+        assert not self.game is None, "step() called before reset()"
+        g = self.game
+        p = g.player
+        evidence = len(p.evidence)
+        levels   = p.levels_seen
+        reward   = 0.0
+        done     = False
+
+        with g:
+            p.policy.action = DalekEnv.ACTIONS[action]
+            try:
+                TurnTaker.take_all_turns(g)
+            except GameOverError:
+                reward += DalekEnv.REWARD_CAUGHT
+                done = True
+            except LevelWinError:
+                next_level(g, self.size)
+
+            reward += (len(p.evidence) - evidence) * DalekEnv.REWARD_EVIDENCE
+            reward += (p.levels_seen - levels) * DalekEnv.REWARD_LEVEL
+            if p.turns >= self.max_turns:
+                done = True
+
+            g.map.observe(self.__obs_buffer)
+        return (self.observation, reward, done)
+
+
+class VecDalekEnv:
+    """N DalekEnvs stepped in lockstep, one worker process each.
+    Finished games restart straight away with the next seed for that worker (seed + N)"""
+
+    def __init__(self, num_envs, seed=0, size=MAP_SIZE, max_turns=1000):
+        self.num_envs = num_envs
+        size = Position(size)
+        n    = len(Map.OBSERVATION_CHANNELS) * size.x * size.y
+
+        self.__obs     = multiprocessing.RawArray('B', num_envs * n)
+        self.__actions = multiprocessing.RawArray('i', num_envs)
+        self.__rewards = multiprocessing.RawArray('d', num_envs)
+        self.__dones   = multiprocessing.RawArray('B', num_envs)
+
+        if numpy_available:
+            self.observations = numpy.frombuffer(self.__obs, dtype=numpy.uint8).reshape(
+                num_envs, len(Map.OBSERVATION_CHANNELS), size.x, size.y)
+        else:
+            self.observations = memoryview(self.__obs).cast('B')
+
+        self.__conns   = []
+        self.__workers = []
+        for i in range(num_envs):
+            (parent, child) = multiprocessing.Pipe()
+            w = multiprocessing.Process(target=_env_worker,
+                                        args=(child, i, seed + i, num_envs, (size.x, size.y), max_turns,
+                                              self.__obs, self.__actions, self.__rewards, self.__dones))
+            w.daemon = True
+            w.start()
+            child.close()
+            self.__conns.append(parent)
+            self.__workers.append(w)
+
+    def __command(self, cmd):
+        for c in self.__conns:
+            c.send_bytes(cmd)
+        # collect every reply before complaining, so workers stay in lockstep
+        replies = [c.recv_bytes() for c in self.__conns]
+        for (i, r) in enumerate(replies):
+            if r != b'ok':
+                raise WorkerError("environment %d failed:\n%s" % (i, r.decode()))
+
+    def reset(self):
+        """start every game; returns observations, shaped (N, channels, x, y) if numpy is available"""
+        self.__command(b'reset')
+        return self.observations
+
+    def step(self, actions):
+        """step every game with its action. Returns (observations, rewards, dones)"""
+        assert len(actions) == self.num_envs, "need one action per environment"
+        self.__actions[:] = actions
+        self.__command(b'step')
+        if numpy_available:
+            return (self.observations,
+                    numpy.frombuffer(self.__rewards, dtype=numpy.float64).copy(),
+                    numpy.frombuffer(self.__dones, dtype=numpy.uint8).astype(bool))
+        return (self.observations, list(self.__rewards), [bool(d) for d in self.__dones])
+
+    def close(self):
+        """stop worker processes"""
+        for c in self.__conns:
+            try:
+                c.send_bytes(b'close')
+            except (BrokenPipeError, OSError):
+                pass
+        for w in self.__workers:
+            w.join(1.0)
+            if w.is_alive():
+                w.terminate()
+        self.__conns   = []
+        self.__workers = []
+
+    def __del__(self):
+        self.close()
+
+
+def _env_worker(conn, index, seed, seed_step, size, max_turns, obs, actions, rewards, dones):
+    """worker process loop for VecDalekEnv"""
+    sys.stdout = open(os.devnull, 'w') # the game prints as it goes
+
+    n   = len(Map.OBSERVATION_CHANNELS) * size[0] * size[1]
+    env = DalekEnv(size, max_turns, memoryview(obs).cast('B')[index * n:(index + 1) * n])
+
+    while True:
+        cmd = conn.recv_bytes()
+        if cmd == b'close':
+            break
+        try:
+            if cmd == b'reset':
+                env.reset(seed)
+                rewards[index] = 0.0
+                dones[index]   = False
+            elif cmd == b'step':
+                (o, r, d) = env.step(actions[index])
+                if d:
+                    seed += seed_step
+                    env.reset(seed)
+                rewards[index] = r
+                dones[index]   = d
+            conn.send_bytes(b'ok')
+        except Exception:
+            conn.send_bytes(traceback.format_exc().encode())
+    conn.close()
@@ -27,3 +27,33 @@ class InvalidMoveContinueError(InvalidMoveError):
 
 class TodoError(DalekError):
     pass
+
+
+class WorkerError(DalekError):
+    """a game running in a worker process failed"""
+    pass
+
+
+class ReplayError(DalekError):
+    """a replayed game no longer matches its recording"""
+    pass
+
+
+class ReplayEndError(DalekError):
+    """a replayed game has used up all its recorded input"""
+    pass
+
+
+class SnapshotError(DalekError):
+    """a game snapshot can't be loaded"""
+    pass
+
+
+class MapRejectedError(DalekError):
+    """a generated map layout failed an acceptance check; generation starts it again"""
+    pass
+
+
+class MapGenerationError(DalekError):
+    """map generation gave up after too many rejected layouts"""
+    pass
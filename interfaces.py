@@ -7,36 +7,70 @@ import weakref
 
 from errors import InvalidMoveContinueError
 from ui import Message
+from context import GameContext
 
 
 class Position:
-    """Utility class for managing Cartesian coordinates"""
-    def __init__(self, x, y=None):
+    """Utility class for managing Cartesian coordinates. Positions are immutable, and those with whole coordinates
+    from 0 to INTERN_LIMIT - 1 are interned: there is only one Position(x,y) for each of those, however it was made"""
+    __slots__ = ('x', 'y', '_hash')
+
+    INTERN_LIMIT = 1024
+
+    def __new__(cls, x, y=None):
         """Initialise as Position(x,y), or Position((x,y)), Position(Position(x,y))"""
         if y is None:
-            if isinstance(x, tuple) or isinstance(x, list):
+            if isinstance(x, Position):
+                return x
+            elif isinstance(x, tuple) or isinstance(x, list):
                 y = x[1]
                 x = x[0]
-            elif isinstance(x, Position):
-                y = x.y
-                x = x.x
-        self.x = x
-        self.y = y
+        n = Position.INTERN_LIMIT
+        if type(x) is int and type(y) is int and 0 <= x < n and 0 <= y < n:
+            p = _interned_positions.get(x * n + y)
+            if p is None:
+                p = _interned_positions[x * n + y] = _new_position(x, y)
+            return p
+        return _new_position(x, y)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Position is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Position is immutable")
+
+    def __reduce__(self):
+        return (Position, (self.x, self.y))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def cell(self, height):
+        """packed cell id for a map height cells high, as maps index their per-cell arrays: x * height + y"""
+        return self.x * height + self.y
+
+    @staticmethod
+    def from_cell(i, height):
+        """Position for packed cell id i of a map height cells high"""
+        return _new(Position, i // height, i % height)
 
     def __hash__(self):
-        return hash((self.x, self.y))
+        return self._hash
 
     def __add__(self, other):
         if isinstance(other, tuple):
-            return Position(self.x + other[0], self.y + other[1])
+            return _new(Position, self.x + other[0], self.y + other[1])
         else:
-            return Position(self.x + other.x, self.y + other.y)
+            return _new(Position, self.x + other.x, self.y + other.y)
 
     def __sub__(self, other):
         if isinstance(other, tuple):
-            return Position(self.x - other[0], self.y - other[1])
+            return _new(Position, self.x - other[0], self.y - other[1])
         else:
-            return Position(self.x - other.x, self.y - other.y)
+            return _new(Position, self.x - other.x, self.y - other.y)
 
     def __gt__(self, other):
         """self > other if other would be enclosed in a box from (0,0) to self"""
@@ -65,9 +99,11 @@ class Position:
         return (self.x <= other.x and self.y <= other.y)
 
     def __eq__(self, other):
-        if not isinstance(other, Position):
-            other = Position(other)
-        return self.x == other.x and self.y == other.y
+        if isinstance(other, Position):
+            return self is other or (self.x == other.x and self.y == other.y)
+        elif isinstance(other, tuple) or isinstance(other, list):
+            return len(other) == 2 and self.x == other[0] and self.y == other[1]
+        return NotImplemented
 
     def __repr__(self):
         return "Position(%d,%d)" % (self.x, self.y)
@@ -93,6 +129,17 @@ class Position:
         return abs(t)
 
 
+_interned_positions = {} # x * INTERN_LIMIT + y: Position
+_new                = Position.__new__ # Position(x, y) without type.__call__, for arithmetic, which is hot
+
+def _new_position(x, y):
+    p = object.__new__(Position)
+    object.__setattr__(p, 'x', x)
+    object.__setattr__(p, 'y', y)
+    object.__setattr__(p, '_hash', hash((x, y)))
+    return p
+
+
 class Mappable:
     """Can appear on the map"""
     UNSEEN_COLOUR = libtcod.darkest_grey
@@ -205,6 +252,20 @@ class LightSource(Mappable):
         self.light_enabled      = True
         self.__tcod_light_map   = libtcod.map_new(radius * 2 + 1, radius * 2 + 1)
         self.__tcod_light_image = libtcod.image_new(radius * 2 + 1, radius * 2 + 1)
+        self.__light_map_blank  = False
+
+    def __getstate__(self):
+        # libtcod handles aren't pickled; the map redraws the light when it rebuilds its own (see Map.rebuild_native)
+        d = self.__dict__.copy()
+        d.pop('_LightSource__tcod_light_map', None)
+        d.pop('_LightSource__tcod_light_image', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.__tcod_light_map   = libtcod.map_new(self._radius * 2 + 1, self._radius * 2 + 1)
+        self.__tcod_light_image = libtcod.image_new(self._radius * 2 + 1, self._radius * 2 + 1)
+        self.__light_map_blank  = True # so the next reset covers the whole light
 
     @property
     def radius(self):
@@ -240,6 +301,9 @@ class LightSource(Mappable):
         assert not self.pos is None and not self.map is None, "resetting LightSource that is not placed on map"
 
         # [re-]calculating FOV of light within its map
+        if self.__light_map_blank:
+            pos = None
+            self.__light_map_blank = False
         if pos is None:
             libtcod.map_clear(self.__tcod_light_map, False, False)
             cov = {}
@@ -360,6 +424,17 @@ class FlatLightSource(LightSource):
         self.__tcod_light_map   = libtcod.map_new(size.x + 2, size.y + 2)
         self.__tcod_light_image = libtcod.image_new(size.x + 2, size.y + 2)
 
+    def __getstate__(self):
+        d = LightSource.__getstate__(self)
+        d.pop('_FlatLightSource__tcod_light_map', None)
+        d.pop('_FlatLightSource__tcod_light_image', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.__tcod_light_map   = libtcod.map_new(self._size.x + 2, self._size.y + 2)
+        self.__tcod_light_image = libtcod.image_new(self._size.x + 2, self._size.y + 2)
+
     @property
     def radius(self):
         """Dummy radius"""
@@ -428,11 +503,11 @@ class FlatLightSource(LightSource):
 
 class TurnTaker:
     """Mixin that provides a method call to take_turn() every turn"""
-    turn_takers = []
 
     def __init__(self, initiative, start=True):
         """Lowest initiative goes first"""
         self.initiative = initiative
+        self.context = GameContext.current()
         if start:
             TurnTaker.add_turntaker(self)
 
@@ -441,43 +516,48 @@ class TurnTaker:
         raise NotImplementedError
 
     @staticmethod
-    def take_all_turns():
-        """All instances take a turn"""
-        for tref in TurnTaker.turn_takers:
+    def take_all_turns(context=None):
+        """All instances take a turn. Defaults to the current game context"""
+        if context is None:
+            context = GameContext.current()
+        context.ticks += 1
+        for tref in context.turn_takers:
             t = tref()
             if t is None:
-                TurnTaker.turn_takers.remove(tref)
+                context.turn_takers.remove(tref)
             else:
                 t.take_turn()
 
     @staticmethod
-    def clear_all():
+    def clear_all(context=None):
         """Clear all turn takers from list"""
-        for tref in TurnTaker.turn_takers:
+        if context is None:
+            context = GameContext.current()
+        for tref in context.turn_takers:
             t = tref()
             if not t is None:
                 del t
-        TurnTaker.turn_takers = []
+        context.turn_takers = []
 
     def refresh_turntaker(self):
         """Re-add turn taker to list if missing"""
-        if not weakref.ref(self) in TurnTaker.turn_takers:
+        if not weakref.ref(self) in self.context.turn_takers:
             TurnTaker.add_turntaker(self)
 
     @staticmethod
     def add_turntaker(t):
         """Add a turn taker to the list that take a turn each round"""
         # might be a faster way to do this
-        TurnTaker.turn_takers.append(weakref.ref(t))
-        TurnTaker.turn_takers.sort(key=lambda x: x() is None and 100000 or x().initiative)
+        t.context.turn_takers.append(weakref.ref(t))
+        t.context.turn_takers.sort(key=lambda x: x() is None and 100000 or x().initiative)
 
     @staticmethod
     def clear_turntaker(t, count=1):
         """Clear count references of turn taker from the list"""
         r = weakref.ref(t)
         for x in range(count):
-            if r in TurnTaker.turn_takers:
-                TurnTaker.turn_takers.remove(r)
+            if r in t.context.turn_takers:
+                t.context.turn_takers.remove(r)
 
 
 class Traversable:
@@ -502,8 +582,9 @@ class Traversable:
 
     def blocks_movement(self, is_for_mapping=False):
         """Does this object block movement entirely?
-        Set is_for_mapping when testing possible paths (rather than actual ones)"""
-        return (self.walk_cost == 0.0) and (not is_for_mapping or self.may_block_movement)
+        Set is_for_mapping when testing possible paths (rather than actual ones), so that pathing doesn't rely on
+        what only may be traversable"""
+        return (self.walk_cost == 0.0) or (is_for_mapping and self.may_block_movement)
 
 
 class Transparent(Mappable):
@@ -529,8 +610,7 @@ class Transparent(Mappable):
             # converting v to a unit vector needs to favour diagonals to get better looking lighting
             #m = max(abs(v.x),abs(v.y))
             #v.x /= m; v.y /= m
-            v.x = v.x > 0 and 1 or v.x < 0 and -1 or 0
-            v.y = v.y > 0 and 1 or v.y < 0 and -1 or 0
+            v = Position(v.x > 0 and 1 or v.x < 0 and -1 or 0, v.y > 0 and 1 or v.y < 0 and -1 or 0)
             return self.map.light_level(self.pos + v)
 
     @property
@@ -544,8 +624,7 @@ class Transparent(Mappable):
             # see comment above
             #m = max(abs(v.x),abs(v.y))
             #v.x //= m; v.y //= m
-            v.x = v.x > 0 and 1 or v.x < 0 and -1 or 0
-            v.y = v.y > 0 and 1 or v.y < 0 and -1 or 0
+            v = Position(v.x > 0 and 1 or v.x < 0 and -1 or 0, v.y > 0 and 1 or v.y < 0 and -1 or 0)
             return self.map.light_colour(self.pos + v)
 
 
@@ -660,16 +739,26 @@ class Activatable:
 
 
 class Alertable(Mappable):
-    """Mixin for objects that can be alerted to things"""
+    """Mixin for objects that can be alerted to things. Each keeps a queue of positions per priority; low and
+    medium priority positions are forgotten once anyone has investigated them (see GameContext.alerts)"""
     PRI_LOW  = 0
     PRI_MED  = 1
     PRI_HIGH = 2
-    ALERTABLES = weakref.WeakSet()
 
     def __init__(self, listen_radius=10):
-        self.listen_radius    = listen_radius
-        self.investigate_list = {Alertable.PRI_LOW: [], Alertable.PRI_MED: [], Alertable.PRI_HIGH: []}
-        Alertable.ALERTABLES.add(self)
+        self.listen_radius = listen_radius
+        self.alert_queues  = {Alertable.PRI_LOW: {}, Alertable.PRI_MED: {}, Alertable.PRI_HIGH: {}} # pos: alert serial
+        self.context       = GameContext.current()
+        self.context.alertables.add(self)
+
+    @property
+    def investigate_list(self):
+        """positions still to investigate, by priority, oldest first"""
+        return dict((pri, [pos for (pos, serial) in q.items() if self.__is_current(pri, pos, serial)])
+                    for (pri, q) in self.alert_queues.items())
+
+    def __is_current(self, pri, pos, serial):
+        return pri == Alertable.PRI_HIGH or self.context.alerts.is_current(pos, serial)
 
     def alert(self, to_pos, priority=None):
         """Alert object to given position with optional priority (see PRI_* attributes)"""
@@ -680,33 +769,43 @@ class Alertable(Mappable):
             priority = Alertable.PRI_MED
 
         #print("%s alerted to %s, pri %d"%(self, to_pos, priority))
-        self.investigate_list[priority].append(to_pos)
+        q = self.alert_queues[priority]
+        q.pop(to_pos, None) # heard again: counts from now
+        q[to_pos] = self.context.alerts.next_serial()
 
         return True
 
     def clear_alert(self, pos, clear_others=True):
-        """Clear pos from alert list so that object no longer interested."""
+        """Clear pos from alert list so that object no longer interested. Unless clear_others is unset, or pos was
+        high priority, everyone else forgets their low and medium priority alerts about pos too"""
         r = False
-        for (pri, il) in self.investigate_list.items():
-            if pos in il:
-                il.remove(pos)
+        for (pri, q) in self.alert_queues.items():
+            serial = q.pop(pos, None)
+            if not serial is None and self.__is_current(pri, pos, serial):
                 r = True
                 if clear_others and pri != Alertable.PRI_HIGH:
-                    # clear from other priorities too
-                    for a in Alertable.ALERTABLES:
-                        if not a is self and \
-                                (pos in a.investigate_list[Alertable.PRI_LOW] or pos in a.investigate_list[Alertable.PRI_MED]):
-                            a.clear_alert(pos, clear_others=False)
+                    self.context.alerts.investigate(pos)
 
         return r
 
     def investigate_next(self):
-        """Find the next position to investigate, weighted by priority"""
-        # TODO: weight priority and self.pos
+        """Find the next position to investigate: the nearest, with each level of priority counting as listen_radius
+        nearer, and the oldest of those equally near"""
+        best = None
         for pri in (Alertable.PRI_HIGH, Alertable.PRI_MED, Alertable.PRI_LOW):
-            if len(self.investigate_list[pri]) > 0:
-                return self.investigate_list[pri].pop(0)
-        return None
+            q = self.alert_queues[pri]
+            for (pos, serial) in list(q.items()):
+                if not self.__is_current(pri, pos, serial):
+                    del q[pos]
+                    continue
+                d = pos.distance_to(self.pos) - pri * self.listen_radius
+                if best is None or d < best[0]:
+                    best = (d, pri, pos)
+
+        if best is None:
+            return None
+        del self.alert_queues[best[1]][best[2]]
+        return best[2]
 
 
 # TODO: use this for symmetry between player and monsters with same capabilities
@@ -732,8 +831,8 @@ class Shouter(Mappable):
         if at_thing is None:
             at_thing = self
 
-        # alert things within your audible radius, NOT the target's
-        for a in self.map.find_all_within_r(self, Alertable, self.audible_radius):
+        # alert things that can hear you within your audible radius, NOT the target's
+        for a in self.map.find_all_audible(self, Alertable, self.audible_radius):
             # don't alert yourself [TODO: this is probably right]
             # ... or the thing you're alerting about
             if not (a is self or a is at_thing):
@@ -742,9 +841,9 @@ class Shouter(Mappable):
 
 class Talker(Shouter):
     """Mixin for objects that talk out loud"""
-    currently_talking = weakref.WeakSet()
 
     def __init__(self):
+        self.context = GameContext.current()
         self.__phrases = {}
         self.is_talking = False
         self.__chat = Message(None, "", True)
@@ -766,8 +865,8 @@ class Talker(Shouter):
         """Stop any talking activity immediately."""
         self.__chat.is_visible = False
         self.is_talking = False
-        if self in self.currently_talking:
-            self.currently_talking.remove(self)
+        if self in self.context.currently_talking:
+            self.context.currently_talking.remove(self)
 
     def talk(self, key=None):
         """Talk out loud, using a randomly chosen phrase based on key."""
@@ -775,26 +874,29 @@ class Talker(Shouter):
             self.stop_talk()
         if not key in self.__phrases.keys() or len(self.__phrases[key]['phrases']) == 0:
             return False
-        if libtcod.random_get_float(None, 0.0, 1.0) < self.__phrases[key]['probability']:
+        rng = self.context.rng('talk')
+        if libtcod.random_get_float(rng, 0.0, 1.0) < self.__phrases[key]['probability']:
             #assert key in self.__phrases.keys(), "Talker %s has no vocab for key %s"%(self,key)
             self.__chat.pos = self.pos - (0, 1)
             self.__chat.text = self.__phrases[key]['phrases'][
-                libtcod.random_get_int(None, 0, len(self.__phrases[key]['phrases']) - 1)
+                libtcod.random_get_int(rng, 0, len(self.__phrases[key]['phrases']) - 1)
                 ]
             self.is_talking = True
             self.__chat.is_visible = True
-            self.currently_talking.add(self)
+            self.context.currently_talking.add(self)
             if self.__phrases[key]['is_shouting']:
                 self.shout()
             return True
         return False
 
     @staticmethod
-    def stop_all_talk():
-        """Clear list of objects currently talking."""
+    def stop_all_talk(context=None):
+        """Clear list of objects currently talking. Defaults to the current game context"""
+        if context is None:
+            context = GameContext.current()
         # NB: this can chuck a runtime error due to a bug in Python 3.2
         # see http://bugs.python.org/issue14159
-        #for t in Talker.currently_talking:
+        #for t in context.currently_talking:
         #    t.stop_talk()
-        while(len(Talker.currently_talking) > 0):
-            Talker.currently_talking.pop().stop_talk()
+        while(len(context.currently_talking) > 0):
+            context.currently_talking.pop().stop_talk()
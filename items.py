@@ -2,18 +2,20 @@
 
 import libtcodpy as libtcod
 
-from functools import reduce
 import re # for sub
 
 from interfaces import Carryable, Activatable, Activator, CountUp, Mappable, TurnTaker, StatusEffect, LightSource
 from ui import UI, HBar, Message
 from errors import InvalidMoveError
+from sampling import WeightedSampler
 
 class Item(Carryable, Activatable, Mappable):
     # for item generation
     awesome_rank    = 2   # out of 5. 0 can't be returned by .random()
     awesome_weight  = 1.0 # 0.0 never occur; 1.0 normal; 2.0 twice normal ... choices also sorted by weight within each rank
     AWESOME_MAP     = None
+    RANK_SAMPLERS   = None # rank: sampler over the items of that rank, by awesome_acc_weight
+    RANKS_SAMPLERS  = None # tuple of ranks: sampler over those ranks, by their total awesome_acc_weight
 
     def __init__(self, owner, power, colour, symbol='!'):
         pos = None
@@ -67,8 +69,11 @@ class Item(Carryable, Activatable, Mappable):
         elif isinstance(ranks,list):
             ranks.sort()
 
-        # calculate weighted range
-        awesome_range = reduce( lambda a,b: a + b, [A[1][-1].awesome_acc_weight for A in Item.AWESOME_MAP.items() if A[0] in ranks], 0.0 )
+        # weighted range of the ranks
+        ranks = tuple(ranks)
+        if not ranks in Item.RANKS_SAMPLERS:
+            Item.RANKS_SAMPLERS[ranks] = WeightedSampler([Item.AWESOME_MAP[r][-1].awesome_acc_weight for r in ranks])
+        awesome_range = Item.RANKS_SAMPLERS[ranks].total
 
         # roll die and weight by parameter
         # NB. weighting can push t out of bounds!
@@ -79,17 +84,13 @@ class Item(Carryable, Activatable, Mappable):
         #print("Range = 0.0 - %f  =>  %f" % (awesome_range,t))
 
         # find rank that was rolled
-        rank = ranks[0]
-        while t > Item.AWESOME_MAP[rank][-1].awesome_acc_weight:
-            t    -= Item.AWESOME_MAP[rank][-1].awesome_acc_weight
-            rank += 1
+        (r, t) = Item.RANKS_SAMPLERS[ranks].locate(t)
+        rank   = ranks[r]
 
         #print("Rank = %d  =>  %s   %s" %(rank,Item.AWESOME_MAP[rank],[C.awesome_acc_weight for C in Item.AWESOME_MAP[rank]]))
 
         # find item that was rolled
-        item_idx = 0
-        while t > Item.AWESOME_MAP[rank][item_idx].awesome_acc_weight:
-            item_idx += 1
+        item_idx = Item.RANK_SAMPLERS[rank].index(t)
 
         # calculate item power (higher in range => more power)
         item_power = 2 * (Item.AWESOME_MAP[rank][item_idx].awesome_acc_weight-t) / Item.AWESOME_MAP[rank][item_idx].awesome_weight
@@ -112,6 +113,9 @@ class Item(Carryable, Activatable, Mappable):
                 # generate a corrected cumulative weight, where high rank items are rarer
                 C.awesome_acc_weight = (C.awesome_weight + last)/C.awesome_rank
                 last += C.awesome_weight
+        Item.RANK_SAMPLERS  = dict((i, WeightedSampler([C.awesome_weight/i for C in CL], [C.awesome_acc_weight for C in CL]))
+                                   for (i, CL) in Item.AWESOME_MAP.items())
+        Item.RANKS_SAMPLERS = {}
 
     @staticmethod
     def get_item_by_name(name):
@@ -296,7 +300,7 @@ class HandTeleport(CoolDownItem):
             return False
 
         try:
-            self.owner.move_to(self.owner.map.find_random_clear())
+            self.owner.move_to(self.owner.map.find_random_clear(self.owner.map.context.rng('items')))
         except InvalidMoveError:
             print("Can't teleport from %s" % self.owner.pos)
             return False
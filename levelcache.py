@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Cache generated levels on disk.
+
+Generating a level is slow, and replays, tests and seed sweeps generate the same seeds over and over. A LevelCache
+keeps each generated level (the layout grid, tiles, monsters, items and evidence, and the map RNG as it was after
+generating) in a file named for its seed, size and the generator version. The version is a hash of the generator's
+source and map constants, so changing either stops old files being used; they are deleted when the cache is opened."""
+
+# system imports
+import os
+import sys
+import zlib
+import hashlib
+import tempfile
+
+# our imports
+from interfaces import Position, TurnTaker
+from ui import UI
+from maps import Map
+from player import Player
+from context import GameContext
+import maps
+import tiles
+import monsters
+import items
+import interfaces
+import sampling
+import snapshot
+
+
+# modules whose code decides what a seed generates
+GENERATOR_MODULES = (maps, tiles, monsters, items, interfaces, sampling, snapshot)
+
+def generator_version():
+    """hash of the generator's source and the constants of the map classes"""
+    h = hashlib.sha1()
+    for m in GENERATOR_MODULES:
+        with open(m.__file__, 'rb') as f:
+            h.update(f.read())
+    for C in sorted(Map.__subclasses__() + [Map], key=lambda C: C.__name__):
+        for (k, v) in sorted(vars(C).items()):
+            if k.isupper():
+                h.update(("%s.%s=%r\n" % (C.__name__, k, v)).encode())
+    return h.hexdigest()[:16]
+
+
+def generate_level(seed, size):
+    """generate the level for seed, as data for snapshot.load_level"""
+    game = GameContext(seed)
+    with game:
+        # stands in for the real player, so leave it and its belongings out of the level
+        game.player = Player()
+        UI.clear_all(game)
+        TurnTaker.clear_all(game)
+        game.alertables.clear()
+        game.currently_talking.clear()
+
+        game.map = Map.random(seed, Position(size), game.player, game)
+        game.map.generate()
+        return snapshot.save_level(game)
+
+
+def next_level(game, size, new_player=None, source=None):
+    """move game (a GameContext) on to the level for its next seed, of size. The old map is closed and the old
+    level's UI and turn takers cleared. If new_player is given this is a new game: RNG streams start afresh and
+    new_player() makes the player; otherwise the player carries on to the new level. The map comes from source
+    (anything with LevelCache's generate, e.g. a LevelPregenerator) if given and it has one, and is generated
+    otherwise. Returns the map"""
+    game.seed += 1
+    UI.clear_all(game)
+    TurnTaker.clear_all(game)
+    if new_player is None:
+        game.player.refresh_turntaker()
+        game.player.levels_seen += 1
+    else:
+        game.restart_rngs()
+        game.player = new_player()
+    if not game.map is None:
+        game.map.close()
+        game.map = None
+    if not source is None:
+        game.map = source.generate(game, size)
+    if game.map is None:
+        game.map = Map.random(game.seed, Position(size), game.player, game)
+        game.map.generate()
+    return game.map
+
+
+class LevelCache:
+    """Generated levels in directory path"""
+    SUFFIX = '.level'
+
+    def __init__(self, path):
+        self.path    = path
+        self.version = generator_version()
+        self.hits    = 0
+        self.misses  = 0
+        os.makedirs(path, exist_ok=True)
+        self.prune()
+
+    def __str__(self):
+        return "LevelCache %s (generator %s): %d hits, %d misses" % (self.path, self.version, self.hits, self.misses)
+
+    def file_for(self, seed, size):
+        return os.path.join(self.path, "%s-%d-%dx%d%s" % (self.version, seed, size.x, size.y, LevelCache.SUFFIX))
+
+    def prune(self):
+        """delete files left by other generator versions"""
+        for f in os.listdir(self.path):
+            if f.endswith(LevelCache.SUFFIX) and not f.startswith(self.version + '-'):
+                try:
+                    os.remove(os.path.join(self.path, f))
+                except FileNotFoundError:
+                    pass # another process got there first
+
+    def get(self, seed, size):
+        """level data for seed and size (as snapshot.save_level), or None if it isn't cached"""
+        try:
+            with open(self.file_for(seed, Position(size)), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, seed, size, data):
+        """store level data for seed and size"""
+        # write then rename, so that other processes never see half a file
+        (fd, tmp) = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zlib.compress(data, 1))
+        os.replace(tmp, self.file_for(seed, Position(size)))
+
+    def level_data(self, seed, size):
+        """level data for seed and size (see generate_level), generating and caching it if need be"""
+        data = self.get(seed, size)
+        if data is None:
+            data = generate_level(seed, size)
+            self.put(seed, size, data)
+        return data
+
+    def generate(self, game, size):
+        """game's level (for game.seed) of size, as Map.random and generate() would make it, attached to game and
+        its player as by snapshot.load_level. Returns the map"""
+        return snapshot.load_level(self.level_data(game.seed, size), game)
+
+
+def main(argv=None):
+    """print the generator version, or the state of a cache directory"""
+    argv = argv is None and sys.argv[1:] or argv
+    if len(argv) == 0:
+        print(generator_version())
+    else:
+        c = LevelCache(argv[0])
+        print("%s: %d levels" % (c, len([f for f in os.listdir(c.path) if f.endswith(LevelCache.SUFFIX)])))
+
+
+if __name__ == '__main__':
+    main()
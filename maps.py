@@ -2,24 +2,97 @@
 
 import libtcodpy as libtcod
 
-from monsters import Monster
+from monsters import Monster, StaticCamera, CrateLifter, Dalek, SlowDalek, BetterDalek, LitDalek
 from player import Player
 from interfaces import Mappable, Position, Traversable, Transparent, StatusEffect, LightSource
 from items import Item, Evidence
 from tiles import Tile, Wall, Floor, Light, FlatLight, Door, StairsDown, StairsUp, MapPattern, CanHaveEvidence
-from errors import InvalidMoveError
+from errors import InvalidMoveError, MapRejectedError, MapGenerationError
+from context import GameContext, save_rng, load_rng
+from sampling import WeightedSampler
 
 from functools import reduce
+from array import array
+import heapq
+import zlib
+
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+
+class SharedConsole:
+    """libtcod console in use by a map and those of its forks that haven't needed to change it"""
+    def __init__(self, console):
+        self.console = console
+        self.users   = 1
+
+    def release(self):
+        self.users -= 1
+        if self.users == 0:
+            libtcod.console_delete(self.console)
+
+
+class CellSet:
+    """set of map cells, by index, with constant time add, discard and random choice. Cells are kept in an array in
+    the order they came, except that discarding one moves the last cell into its place. Sets that can never hold
+    the same cell may share where, an array('l') of size -1s, rather than each keeping its own"""
+    def __init__(self, size, where=None):
+        self.cells   = array('l')
+        self.__where = where is None and array('l', [-1]) * size or where # index into cells, or -1 if not in the set
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, i):
+        return self.__where[i] >= 0
+
+    def add(self, i):
+        if self.__where[i] < 0:
+            self.__where[i] = len(self.cells)
+            self.cells.append(i)
+
+    def discard(self, i):
+        j = self.__where[i]
+        if j >= 0:
+            last = self.cells.pop()
+            if last != i:
+                self.cells[j]     = last
+                self.__where[last] = j
+            self.__where[i] = -1
+
+    def choice(self, rng=None):
+        """random cell, using given RNG, or TCOD default if none supplied"""
+        assert len(self.cells) > 0, "no cells to choose from"
+        return self.cells[libtcod.random_get_int(rng, 0, len(self.cells) - 1)]
 
 
 class Map:
     """Map of Mappable objects, representing the game map currently in play."""
     __layer_order = [Tile, Item, Monster, Player]
 
-    def __init__(self, seed, size, player):
+    # observation channels; see Map.observation
+    OBSERVED_MONSTERS    = [StaticCamera, CrateLifter, Dalek, SlowDalek, BetterDalek, LitDalek]
+    OBSERVATION_CHANNELS = ('walkable', 'transparent', 'light', 'fov', 'seen', 'door', 'item', 'player') \
+        + tuple('monster:%s' % M.__name__ for M in OBSERVED_MONSTERS)
+    (OBS_WALKABLE, OBS_TRANSPARENT, OBS_LIGHT, OBS_FOV, OBS_SEEN, OBS_DOOR, OBS_ITEM, OBS_PLAYER, OBS_MONSTER) = range(9)
+    OBS_DOOR_CLOSED  = 1
+    OBS_DOOR_CLOSING = 2
+    OBS_DOOR_OPEN    = 3
+
+    # sound; see sound_field
+    SOUND_DAMPING    = 3.0 # cost of sound passing through a closed door or a window, against 1.0 for open space
+    SOUND_CACHE_SIZE = 64  # sound fields kept at once
+    LOS_CACHE_SIZE   = 512 # cells whose line of sight is kept at once
+
+    def __init__(self, seed, size, player, context=None):
         """seed is the RNG seed to use for generating the map; size is a Position instance giving the map size
-        and player is a valid Player object."""
+        and player is a valid Player object. context is the GameContext the map belongs to, which generate() makes
+        everything on the map in (default: current)"""
         self.player = player
+        self.context = context is None and GameContext.current() or context
         self.__layers = {
             Player: {},
             Monster: {},
@@ -31,15 +104,123 @@ class Map:
         else:
             self.map_rng = libtcod.random_new_from_seed(seed)
         self.size = size
+        self.__new_native()
+        self._dirty_pos                   = []
+        self.cell_flags                   = bytearray(self.size.x * self.size.y) # see FlyweightTile
+        self.components                   = None # see label_components
+        self.__free                       = CellSet(self.size.x * self.size.y) # see find_random_clear
+        self.__free_in                    = None # clear cells by component; see label_components
+        self.__mobile                     = bytearray(self.size.x * self.size.y) # monsters per cell; see occupancy
+        self.__immobile                   = bytearray(self.size.x * self.size.y)
+        self.component_sizes              = None
+        self.geometry_version             = 0    # bumped whenever a cell changes how it can be walked or seen through
+        self.__sound_fields               = {}   # (cell, radius): sound field, as of __sound_version
+        self.__sound_version              = 0
+        self.__flow_users                 = {}   # cell: number of users of the flow field towards it; see use_flow
+        self.__paths_version              = 0    # bumped whenever pathing is recalculated
+        self.sight_version                = 0    # bumped whenever fov or lighting is recalculated; see can_see_all
+        self.__fov_radius                 = 0    # of the player's fov, as last prepared
+        self.__los                        = {}   # cell: what can be seen from there; see line_of_sight
+
+        # observation channels, kept up to date as the map changes so that reading them is free
+        self.__obs_plane         = self.size.x * self.size.y
+        self.__obs               = bytearray(len(self.OBSERVATION_CHANNELS) * self.__obs_plane)
+        self.__obs_moving_lights = []
+        self.__new_observation_view()
+
+    def __new_native(self):
         self.__tcod_map_empty             = libtcod.map_new(self.size.x, self.size.y) # for xray, audio, ghosts(?)
         libtcod.map_clear(self.__tcod_map_empty, True, True)               # clear the map to be traversable and visible
         self.__tcod_map                   = libtcod.map_new(self.size.x, self.size.y) # for pathing and rendering
         self.__tcod_pathfinder            = None
-        self.__tcod_static_light_console  = libtcod.console_new(self.size.x, self.size.y)  # stores cumulative light data
+        self.__flow_fields                = {}   # cell: [paths version, libtcod dijkstra from cell]
+        self.__new_static_light_console()
         self.__tcod_moving_light_console  = libtcod.console_new(self.size.x, self.size.y)
-        libtcod.console_set_default_background(self.__tcod_static_light_console, Mappable.LIGHT_L_CLAMP)
         #litbcod.console_set_default_background(self.__tcod_moving_light_console, Mappable.LIGHT_L_CLAMP)
-        self._dirty_pos                   = []
+
+    def __new_static_light_console(self):
+        self.__tcod_static_light_console  = libtcod.console_new(self.size.x, self.size.y)  # stores cumulative light data
+        libtcod.console_set_default_background(self.__tcod_static_light_console, Mappable.LIGHT_L_CLAMP)
+        self.__static_light_share         = SharedConsole(self.__tcod_static_light_console)
+
+    def fork_native(self, parent):
+        """give this map (a fork of parent) its libtcod handles: FOV and pathing maps are copied, and static
+        lighting is shared until one of the maps recalculates it, rather than rebuilding them all"""
+        parent.rebuild_native()
+        self.__dict__.pop('_Map__saved_static_light', None)
+        self.__tcod_map_empty             = libtcod.map_new(self.size.x, self.size.y)
+        libtcod.map_copy(parent.__tcod_map_empty, self.__tcod_map_empty)
+        self.__tcod_map                   = libtcod.map_new(self.size.x, self.size.y)
+        libtcod.map_copy(parent.__tcod_map, self.__tcod_map)
+        self.__tcod_pathfinder            = libtcod.dijkstra_new(self.__tcod_map)
+        self.__flow_fields                = {}
+        self.__tcod_static_light_console  = parent.__tcod_static_light_console
+        self.__static_light_share         = parent.__static_light_share
+        self.__static_light_share.users  += 1
+        self.__tcod_moving_light_console  = libtcod.console_new(self.size.x, self.size.y)
+        libtcod.console_blit(parent.__tcod_moving_light_console, 0, 0, 0, 0, self.__tcod_moving_light_console, 0, 0)
+
+    def __new_observation_view(self):
+        if numpy_available:
+            self.observation = numpy.frombuffer(self.__obs, dtype=numpy.uint8).reshape(
+                len(self.OBSERVATION_CHANNELS), self.size.x, self.size.y)
+        else:
+            self.observation = memoryview(self.__obs)
+
+    # libtcod handles; left out of pickles (see snapshot.py) and rebuilt from the map's contents when next used
+    NATIVE_ATTRS = ('_Map__tcod_map_empty', '_Map__tcod_map', '_Map__tcod_pathfinder', '_Map__flow_fields',
+                    '_Map__tcod_static_light_console', '_Map__static_light_share', '_Map__tcod_moving_light_console')
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        for a in Map.NATIVE_ATTRS:
+            d.pop(a, None)
+        del d['observation']
+        d['_Map__sound_fields'] = {}
+        d['_Map__los']          = {}
+        d['map_rng'] = save_rng(self.map_rng)
+        if self.has_native():
+            # static lighting is slow to recalculate and quick to save: red, green and blue planes, row by row
+            cols = [libtcod.console_get_char_background(self.__tcod_static_light_console, x, y)
+                    for y in range(self.size.y) for x in range(self.size.x)]
+            d['_Map__saved_static_light'] = bytes([c.r for c in cols] + [c.g for c in cols] + [c.b for c in cols])
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self.map_rng = load_rng(d['map_rng'])
+        self.__new_observation_view()
+
+    def __getattr__(self, name):
+        # only called for missing attributes, i.e. native handles not yet rebuilt after unpickling
+        if not name in Map.NATIVE_ATTRS or '_Map__tcod_map' in self.__dict__:
+            raise AttributeError(name)
+        self.rebuild_native()
+        return self.__dict__[name]
+
+    def has_native(self):
+        """are the libtcod handles built? (they aren't in a freshly unpickled map until it's used)"""
+        return '_Map__tcod_map' in self.__dict__
+
+    def rebuild_native(self):
+        """rebuild libtcod handles (pathing, FOV and lighting) from the map's contents"""
+        if self.has_native():
+            return
+        obs   = bytes(self.__obs) # as saved; recalculating would bring stale cells up to date
+        saved = self.__dict__.pop('_Map__saved_static_light', None)
+        self.__new_native()
+        if saved is None:
+            self.recalculate_paths(force_now=True)
+        else:
+            self.__set_tile_properties()
+            self.__tcod_pathfinder = libtcod.dijkstra_new(self.__tcod_map)
+            n = self.size.x * self.size.y
+            libtcod.console_fill_background(self.__tcod_static_light_console,
+                                            list(saved[:n]), list(saved[n:n * 2]), list(saved[n * 2:]))
+            self.recalculate_lighting(statics=False)
+        if not self.player is None and self.player.map is self:
+            self.player.reset_fov()
+        self.__obs[:] = obs
 
     def __get_layer_from_obj(self, obj):
         """Return which map layer obj is in"""
@@ -55,6 +236,7 @@ class Map:
             layer = self.__get_layer_from_obj(obj)
         self.__layers[layer].setdefault(obj.pos, []).append(obj)
         obj.map = self
+        self.__observe_obj(obj, layer, obj.pos, 1)
 
     def remove(self, obj, layer=None):
         """remove object obj from given map layer, or first layer found if none given."""
@@ -67,6 +249,7 @@ class Map:
         self.__layers[layer][obj.pos].remove(obj)
         if len(self.__layers[layer][obj.pos]) == 0:
             del self.__layers[layer][obj.pos]
+        self.__observe_obj(obj, layer, obj.pos, -1)
         obj.map = None
         obj.pos = None
 
@@ -102,6 +285,8 @@ class Map:
         # move obj reference
         self.__layers[layer][obj.pos].remove(obj)
         self.__layers[layer].setdefault(pos, []).append(obj)
+        self.__observe_obj(obj, layer, obj.pos, -1)
+        self.__observe_obj(obj, layer, pos, 1)
 
         # update obj position
         obj.last_pos = obj.pos
@@ -152,17 +337,121 @@ class Map:
                 ret.append(o)
         return ret
 
-    def find_random_clear(self, rng=None):
-        """find random clear cell in map, using given RNG, or TCOD default if none supplied"""
-        # assumes that 2+ tiles in the same space means a door/crate/what-have-you
-        occupied = list(self.__layers[Player].keys()) + list(self.__layers[Monster].keys()) \
-            + [t[0] for t in self.__layers[Tile].items() if t[1][0].blocks_movement() and len(t[1]) == 0]
+    def find_all_audible(self, obj, otype, radius, must_be_visible=True, layer=None):
+        """find all type otype that can hear obj, i.e. where sound from obj carries within radius (see sound_field).
+        Can limit by map layer and whether visible (i.e. drawn)"""
+        field  = self.sound_field(obj.pos, radius)
+        layers = [layer]
+        if layer is None:
+            layers = self.__layer_order
+
+        ret = []
+        for l in layers:
+            # look up whichever is smaller: the cells sound reaches, or the cells with something in them
+            where = self.__layers[l]
+            if len(field) < len(where):
+                found = [where.get(Position.from_cell(i, self.size.y), ()) for i in field]
+            else:
+                found = [os for (pos, os) in where.items() if pos.cell(self.size.y) in field]
+            for os in found:
+                for o in os:
+                    if obj is o or (must_be_visible and not o.is_visible) or not isinstance(o, otype):
+                        continue
+                    ret.append(o)
+        return ret
 
-        while 1:
-            p = Position(libtcod.random_get_int(rng, 0, self.size.x - 1),
-                         libtcod.random_get_int(rng, 0, self.size.y - 1))
-            if not p in occupied and not self.is_blocked(p):
-                return p
+    def sound_field(self, pos, radius):
+        """how far sound from pos travels to reach each cell it reaches within radius, as {cell: distance} (cells are
+        x * size.y + y). Sound goes the quickest way round: walls stop it, and closed doors and windows damp it
+        (see SOUND_DAMPING). Fields are cached until the map's geometry changes"""
+        if self.__sound_version != self.geometry_version or len(self.__sound_fields) >= self.SOUND_CACHE_SIZE:
+            self.__sound_fields  = {}
+            self.__sound_version = self.geometry_version
+        key = (pos.cell(self.size.y), radius)
+        field = self.__sound_fields.get(key)
+        if field is None:
+            field = self.__sound_fields[key] = self.__propagate_sound(key[0], radius)
+        return field
+
+    def __propagate_sound(self, start, radius):
+        """Dijkstra over the sound cost of each cell, from cell start out to radius"""
+        (w, h) = (self.size.x, self.size.y)
+        obs    = self.__obs
+        walk   = self.OBS_WALKABLE * self.__obs_plane
+        trans  = self.OBS_TRANSPARENT * self.__obs_plane
+        door   = self.OBS_DOOR * self.__obs_plane
+        field  = {start: 0.0}
+        todo   = [(0.0, start)]
+        while todo:
+            (d, i) = heapq.heappop(todo)
+            if d > field[i]:
+                continue
+            (x, y) = divmod(i, h)
+            for nx in range(max(x - 1, 0), min(x + 2, w)):
+                for j in range(nx * h + max(y - 1, 0), nx * h + min(y + 2, h)):
+                    if obs[door + j] == self.OBS_DOOR_CLOSED or (obs[trans + j] and not obs[walk + j]):
+                        cost = self.SOUND_DAMPING
+                    elif obs[walk + j]:
+                        cost = 1.0
+                    else:
+                        continue # wall, or nothing there
+                    if nx != x and j != i + (nx - x) * h:
+                        cost *= 1.4142135623730951 # diagonal
+                    if d + cost < radius and d + cost < field.get(j, radius):
+                        field[j] = d + cost
+                        heapq.heappush(todo, (d + cost, j))
+        return field
+
+    def find_random_clear(self, rng=None, component=None, away_from=None, min_distance=0):
+        """find random clear cell in map, using given RNG, or TCOD default if none supplied. If component is given,
+        the cell is in that connected component, as last labelled by label_components. If away_from is given, the
+        cell is further than min_distance from that position, or as far as any clear cell is if none is that far"""
+        assert component is None or not self.components is None, "components not labelled"
+        assert component is None or 0 < component < len(self.component_sizes), "no component %s" % component
+        free = component is None and self.__free or self.__free_in[component]
+        if len(free) == 0 and not component is None:
+            raise MapGenerationError("No clear cells in component %s" % component)
+        if not away_from is None:
+            # one draw from the cells far enough away, rather than drawing until one is
+            (h, x, y) = (self.size.y, away_from.x, away_from.y)
+            cells = [((i // h - x) ** 2 + (i % h - y) ** 2, i) for i in free.cells]
+            assert len(cells) > 0, "no clear cells"
+            far = [i for (d, i) in cells if d > min_distance ** 2]
+            if len(far) == 0:
+                return Position.from_cell(max(cells)[1], h)
+            return Position.from_cell(far[libtcod.random_get_int(rng, 0, len(far) - 1)], h)
+        return Position.from_cell(free.choice(rng), self.size.y)
+
+    def __update_free(self, pos):
+        """a cell is clear (for find_random_clear) if nobody is in it and its tile doesn't block movement"""
+        i = pos.cell(self.size.y)
+        label = not self.__free_in is None and self.components[i]
+        if self.__layers[Player].get(pos) or self.__mobile[i] or self.__immobile[i] or self.is_blocked(pos):
+            self.__free.discard(i)
+            label and self.__free_in[label].discard(i)
+        else:
+            self.__free.add(i)
+            label and self.__free_in[label].add(i)
+
+    def occupancy(self, pos):
+        """(mobile, immobile): how many monsters at pos can move, and how many remain in place (e.g. cameras)"""
+        if pos.x < 0 or pos.y < 0 or pos.x >= self.size.x or pos.y >= self.size.y:
+            return (0, 0)
+        i = pos.cell(self.size.y)
+        return (self.__mobile[i], self.__immobile[i])
+
+    def free_neighbours(self, pos):
+        """cells next to pos with no monster in them and nothing blocking movement"""
+        h = self.size.y
+        r = []
+        for x in range(max(pos.x - 1, 0), min(pos.x + 2, self.size.x)):
+            for y in range(max(pos.y - 1, 0), min(pos.y + 2, h)):
+                i = x * h + y
+                if not (self.__mobile[i] or self.__immobile[i] or (x == pos.x and y == pos.y)):
+                    p = Position(x, y)
+                    if not self.is_blocked(p):
+                        r.append(p)
+        return r
 
     def find_at_pos(self, pos, layer=None):
         """find first object at pos in layer(s), or any layer if none supplied.
@@ -221,6 +510,14 @@ class Map:
             self._dirty_pos = []
         self.recalculate_lighting(self.player.pos, statics=False)
 
+    def __set_tile_properties(self, is_for_mapping=False):
+        libtcod.map_clear(self.__tcod_map)
+        for ol in self.__layers[Tile].values():
+            for o in ol:
+                is_walkable = (isinstance(o, Traversable) and (not o.blocks_movement(is_for_mapping)))
+                is_transparent = (isinstance(o, Transparent) and not o.blocks_light())
+                libtcod.map_set_properties(self.__tcod_map, o.pos.x, o.pos.y, is_transparent, is_walkable)
+
     def recalculate_paths(self, pos=None, is_for_mapping=False, force_now=False):
         """Recalculates pathing information. If a list of pos given, assume only those positions have changed state.
         If is_for_mapping is set, don't count things like teleports as traversable.
@@ -228,26 +525,30 @@ class Map:
         #print("%d: RECALCULATING PATHS%s!"%(self.player.turns,pos is None and " FOR ALL" or " AT %s"%pos))
 
         if pos is None:
-            libtcod.map_clear(self.__tcod_map)
-            for ol in self.__layers[Tile].values():
-                for o in ol:
-                    is_walkable = (isinstance(o, Traversable) and (not o.blocks_movement(is_for_mapping)))
-                    is_transparent = (isinstance(o, Transparent) and not o.blocks_light())
-                    libtcod.map_set_properties(self.__tcod_map, o.pos.x, o.pos.y, is_transparent, is_walkable)
+            self.__set_tile_properties(is_for_mapping)
+            self.__los = {}
         else:
             if not isinstance(pos, list):
                 pos = [pos]
+            for p in pos:
+                self.tile_changed(p)
             if not force_now:
                 self._dirty_pos += pos
                 return
+            changed = []
             for p in pos:
+                was_transparent = libtcod.map_is_transparent(self.__tcod_map, p.x, p.y)
                 for o in self.__layers[Tile].get(p, []):
                     is_walkable = (isinstance(o, Traversable) and (not o.blocks_movement(is_for_mapping)))
                     is_transparent = (isinstance(o, Transparent) and not o.blocks_light())
                     libtcod.map_set_properties(self.__tcod_map, o.pos.x, o.pos.y, is_transparent, is_walkable)
+                if libtcod.map_is_transparent(self.__tcod_map, p.x, p.y) != was_transparent:
+                    changed.append(p)
+            self.__forget_sight(changed)
 
         #self.__tcod_pathfinder = libtcod.path_new_using_map(self.__tcod_map)
         self.__tcod_pathfinder = libtcod.dijkstra_new(self.__tcod_map)
+        self.__paths_version  += 1
 
         # lighting needs updating too
         if not is_for_mapping:
@@ -255,12 +556,39 @@ class Map:
 
     def prepare_fov(self, pos, radius=0, reset=True):
         """recalculate player fov at pos with optional radius. Set reset=False to accumulate multiple fovs"""
+        self.sight_version += 1
+        if reset:
+            self.__fov_radius = radius
         libtcod.map_compute_fov(self.__tcod_map_empty, pos.x, pos.y, radius, True, libtcod.FOV_BASIC)
         libtcod.map_compute_fov(self.__tcod_map, pos.x, pos.y, radius, True, libtcod.FOV_BASIC)
-
+        self.__show(self._drawing_can_see, reset)
+
+    def add_view(self, pos):
+        """let the player see what can be seen from pos as well (e.g. through a camera), as prepare_fov(pos,
+        reset=False) would, but from the line of sight cache, leaving the player's own fov as it is"""
+        self.sight_version += 1
+        self.__show(lambda p: self.in_sight(pos, p), False)
+
+    def __show(self, can_see, reset):
+        """flag what the player can_see (pos -> bool) as visible, and if reset is set, the rest as not"""
+        obs  = self.__obs
+        fov  = self.OBS_FOV * self.__obs_plane
+        seen = self.OBS_SEEN * self.__obs_plane
+        cells = self.cell_flags
         for layer in self.__layer_order:
             for (pos, ts) in self.__layers[layer].items():
-                if self._drawing_can_see(pos):
+                if layer is Tile:
+                    # tiles keep these flags per cell
+                    i = pos.x * self.size.y + pos.y
+                    if can_see(pos):
+                        cells[i] |= Tile.CELL_VISIBLE
+                        obs[fov + i] = 1
+                    elif reset:
+                        cells[i] &= ~Tile.CELL_VISIBLE & 0xFF
+                        obs[fov + i] = 0
+                    # has_been_seen is set when drawn; pick it up here rather than on every draw
+                    obs[seen + i] = (cells[i] & Tile.CELL_SEEN) != 0
+                elif can_see(pos):
                     for t in ts:
                         t.visible_to_player = True
                 elif reset:
@@ -276,6 +604,7 @@ class Map:
         #  * individual light coverage maps are handled as images that are blitted to a console
         #  * the console is subsequently queried by the map for LOS and drawing
         #  * moving lights need to be calculating using whole map LOS
+        self.sight_version += 1
 
         lights = self.find_all(LightSource)
 
@@ -283,6 +612,10 @@ class Map:
 
         # reset light levels for every light source
         if statics:
+            if self.__static_light_share.users > 1:
+                # shared with forks; this map needs its own now
+                self.__static_light_share.release()
+                self.__new_static_light_console()
             libtcod.console_clear(self.__tcod_static_light_console)
         libtcod.console_clear(self.__tcod_moving_light_console)
 
@@ -296,6 +629,16 @@ class Map:
                 l.reset_map()
                 l.blit_to(self.__tcod_moving_light_console)
 
+        # light observation: everywhere if static lights changed, otherwise around where moving lights are and were
+        moving = [(l.pos.x - l.radius, l.pos.y - l.radius, l.pos.x + l.radius, l.pos.y + l.radius)
+                  for l in lights if not l.remains_in_place and not l.pos is None]
+        if statics:
+            self.__observe_light((0, 0, self.size.x - 1, self.size.y - 1))
+        else:
+            for r in self.__obs_moving_lights + moving:
+                self.__observe_light(r)
+        self.__obs_moving_lights = moving
+
     def is_lit(self, obj):
         """is obj lit enough to be visible?"""
         print("got here %s %s" % (obj, obj.current_effects))
@@ -340,13 +683,104 @@ class Map:
             #    player in-front:  player.pos-obj.pos  must (0, >0)
             return self.player.is_visible \
                 and self.is_lit(self.player) \
-                and libtcod.map_is_in_fov(self.__tcod_map, obj.pos.x, obj.pos.y) \
+                and self.__in_player_sight(obj.pos) \
                 and (angle_of_vis == 1.0 or (obj.pos - obj.last_pos).angle_to(self.player.pos - obj.pos) <= angle_of_vis)
         elif obj is self.player:
             return obj.is_visible and self.is_lit(obj) and libtcod.map_is_in_fov(self.__tcod_map, obj.pos.x, obj.pos.y)
         else:
             raise NotImplementedError
 
+    def can_see_all(self, objs, angle_of_vis=1.0):
+        """can_see(obj, player, angle_of_vis) for each of objs at once, as a list. What's needed of the player is
+        worked out once, and the vision cones with numpy, if available. Holds until sight_version changes or the
+        player or one of objs moves"""
+        p = self.player
+        if not (p.is_visible and self.is_lit(p)):
+            return [False] * len(objs)
+        if angle_of_vis == 1.0 or len(objs) == 0:
+            cone = [True] * len(objs)
+        elif numpy_available:
+            # as Position.angle_to, from where each obj is heading to the player
+            xy = numpy.array([(o.pos.x, o.pos.y, o.last_pos.x, o.last_pos.y) for o in objs], dtype=numpy.float64)
+            t  = (numpy.arctan2(xy[:, 0] - xy[:, 2], xy[:, 1] - xy[:, 3])
+                  - numpy.arctan2(p.pos.x - xy[:, 0], p.pos.y - xy[:, 1])) / numpy.pi
+            t  = numpy.where(t > 1.0, t - 2.0, numpy.where(t < -1.0, t + 2.0, t))
+            cone = (numpy.abs(t) <= angle_of_vis).tolist()
+        else:
+            cone = [(o.pos - o.last_pos).angle_to(p.pos - o.pos) <= angle_of_vis for o in objs]
+        return [c and not (isinstance(o, StatusEffect) and o.has_effect(StatusEffect.BLIND))
+                and self.__in_player_sight(o.pos)
+                for (o, c) in zip(objs, cone)]
+
+    def __in_player_sight(self, pos):
+        """is pos in the player's fov, as prepare_fov would have it from where the player is now?"""
+        p = self.player.pos
+        r = self.__fov_radius
+        return (r == 0 or (pos.x - p.x) ** 2 + (pos.y - p.y) ** 2 <= r * r) and self.in_sight(p, pos)
+
+    def line_of_sight(self, pos):
+        """what can be seen from pos, as prepare_fov(pos) would work it out, compressed by rows: (x0, rows), where
+        rows[x - x0] has bit y set for each cell (x, y) in sight, and rows only run from the first x with anything in
+        sight to the last. Worked out when first needed, and kept until a cell in sight from pos changes transparency
+        (see recalculate_paths)"""
+        i = pos.cell(self.size.y)
+        los = self.__los.get(i)
+        if los is None:
+            if len(self.__los) >= self.LOS_CACHE_SIZE:
+                self.__los = {}
+            los = self.__los[i] = self.__trace_sight(pos)
+        return los
+
+    def in_sight(self, from_pos, to_pos):
+        """can to_pos be seen from from_pos? (see line_of_sight)"""
+        return self.__sees(self.line_of_sight(from_pos), to_pos)
+
+    @staticmethod
+    def __sees(los, pos):
+        """is pos in los? (see line_of_sight)"""
+        (x0, rows) = los
+        k = pos.x - x0
+        return 0 <= k < len(rows) and pos.y >= 0 and (rows[k] >> pos.y) & 1 == 1
+
+    def __trace_sight(self, pos):
+        """fov from pos, on a copy of the map so as to leave the player's alone, read back into rows of bits"""
+        (w, h) = (self.size.x, self.size.y)
+        fov = libtcod.map_new(w, h)
+        libtcod.map_copy(self.__tcod_map, fov)
+        libtcod.map_compute_fov(fov, pos.x, pos.y, 0, True, libtcod.FOV_BASIC)
+
+        # whatever is in sight is seen past something in sight next to it, all the way back to pos; so there's no need
+        # to look anywhere but next to what's in sight and can be seen through
+        obs    = self.__obs # may be ahead of the native map, which only catches up in recalculate_dirty; ask it if not
+        trans  = self.OBS_TRANSPARENT * self.__obs_plane
+        rows   = {}
+        looked = set([pos.cell(h)])
+        todo   = [(pos.x, pos.y)]
+        while todo:
+            (px, py) = todo.pop()
+            if not libtcod.map_is_in_fov(fov, px, py):
+                continue
+            rows[px] = rows.get(px, 0) | (1 << py)
+            if (px, py) != (pos.x, pos.y) and not (obs[trans + px * h + py] or libtcod.map_is_transparent(fov, px, py)):
+                continue
+            for x in range(max(px - 1, 0), min(px + 2, w)):
+                for y in range(max(py - 1, 0), min(py + 2, h)):
+                    if not x * h + y in looked:
+                        looked.add(x * h + y)
+                        todo.append((x, y))
+        libtcod.map_delete(fov)
+
+        if len(rows) == 0:
+            return (0, ())
+        x0 = min(rows.keys())
+        return (x0, tuple(rows.get(x, 0) for x in range(x0, max(rows.keys()) + 1)))
+
+    def __forget_sight(self, changed):
+        """drop the line of sight of each cell that can see one of changed, which is all that changing them can affect"""
+        if len(changed) == 0 or len(self.__los) == 0:
+            return
+        self.__los = dict((i, los) for (i, los) in self.__los.items() if not any(self.__sees(los, p) for p in changed))
+
     def _drawing_can_see(self, pos):
         """can player see pos [FOR DRAWING!]"""
         # ONLY FOR DRAWING!!
@@ -372,19 +806,203 @@ class Map:
 
         return p
 
+    def use_flow(self, pos):
+        """count one more user of the flow field towards pos (see flow_step), e.g. a monster heading there. Fields
+        are shared by everyone heading to the same place, and dropped when release_flow says nobody is"""
+        i = pos.cell(self.size.y)
+        self.__flow_users[i] = self.__flow_users.get(i, 0) + 1
+
+    def release_flow(self, pos):
+        """count one fewer user of the flow field towards pos"""
+        i = pos.cell(self.size.y)
+        assert self.__flow_users.get(i, 0) > 0, "flow field towards %s released more than used" % pos
+        self.__flow_users[i] -= 1
+        if self.__flow_users[i] == 0:
+            del self.__flow_users[i]
+            field = self.__flow_fields.pop(i, None)
+            if not field is None:
+                libtcod.dijkstra_delete(field[1])
+
+    def flow_step(self, from_pos, to_pos):
+        """next step from from_pos on the way to to_pos, as get_path would take it, but read off a field of walking
+        distances to to_pos that is worked out once for everyone using it (see use_flow), until pathing changes.
+        None if already there or there's no way there"""
+        i = to_pos.cell(self.size.y)
+        field = self.__flow_fields.get(i)
+        if field is None:
+            field = [None, libtcod.dijkstra_new(self.__tcod_map)]
+            if i in self.__flow_users:
+                self.__flow_fields[i] = field
+        if field[0] != self.__paths_version:
+            libtcod.dijkstra_compute(field[1], to_pos.x, to_pos.y)
+            field[0] = self.__paths_version
+
+        # downhill to the nearest neighbour to to_pos
+        best = None
+        d    = libtcod.dijkstra_get_distance(field[1], from_pos.x, from_pos.y)
+        if d > 0.0:
+            for x in range(max(from_pos.x - 1, 0), min(from_pos.x + 2, self.size.x)):
+                for y in range(max(from_pos.y - 1, 0), min(from_pos.y + 2, self.size.y)):
+                    dn = libtcod.dijkstra_get_distance(field[1], x, y)
+                    if 0.0 <= dn < d:
+                        (best, d) = (Position(x, y), dn)
+        if not i in self.__flow_fields:
+            libtcod.dijkstra_delete(field[1])
+        return best
+
+    def tile_changed(self, pos):
+        """tile state at pos has changed (e.g. a door closing); update observation channels"""
+        if pos.x < 0 or pos.y < 0 or pos.x >= self.size.x or pos.y >= self.size.y:
+            return
+        i = pos.cell(self.size.y)
+        is_walkable = is_transparent = False
+        door = 0
+        for o in self.__layers[Tile].get(pos, []):
+            # last tile wins, as in recalculate_paths
+            is_walkable    = isinstance(o, Traversable) and not o.blocks_movement()
+            is_transparent = isinstance(o, Transparent) and not o.blocks_light()
+            if isinstance(o, Door):
+                door = o.state is Door.OPEN and self.OBS_DOOR_OPEN \
+                    or o.state is Door.CLOSING and self.OBS_DOOR_CLOSING \
+                    or self.OBS_DOOR_CLOSED
+        cell = (is_walkable, is_transparent, door)
+        if cell != (self.__obs[self.OBS_WALKABLE * self.__obs_plane + i],
+                    self.__obs[self.OBS_TRANSPARENT * self.__obs_plane + i],
+                    self.__obs[self.OBS_DOOR * self.__obs_plane + i]):
+            self.geometry_version += 1
+        self.__obs[self.OBS_WALKABLE * self.__obs_plane + i]    = is_walkable
+        self.__obs[self.OBS_TRANSPARENT * self.__obs_plane + i] = is_transparent
+        self.__obs[self.OBS_DOOR * self.__obs_plane + i]        = door
+        self.__update_free(pos)
+
+    def __observe_obj(self, obj, layer, pos, delta):
+        """obj has been added to (delta 1) or removed from (delta -1) pos; update observation channels"""
+        if pos is None or pos.x < 0 or pos.y < 0 or pos.x >= self.size.x or pos.y >= self.size.y:
+            return
+        if layer is Tile:
+            return self.tile_changed(pos)
+        if layer is Monster:
+            counts = obj.remains_in_place and self.__immobile or self.__mobile
+            counts[pos.cell(self.size.y)] += delta
+        if layer is Player or layer is Monster:
+            self.__update_free(pos)
+        if layer is Player:
+            channel = self.OBS_PLAYER
+        elif layer is Item:
+            channel = self.OBS_ITEM
+        else:
+            # most specific observed class, so e.g. a LitDalek isn't counted as a Dalek
+            for C in type(obj).__mro__:
+                if C in self.OBSERVED_MONSTERS:
+                    channel = self.OBS_MONSTER + self.OBSERVED_MONSTERS.index(C)
+                    break
+            else:
+                return
+        i = channel * self.__obs_plane + pos.x * self.size.y + pos.y
+        self.__obs[i] = max(0, min(255, self.__obs[i] + delta))
+
+    def __observe_light(self, rect):
+        """refresh light observation over rect (x0, y0, x1, y1), inclusive"""
+        x0 = max(rect[0], 0)
+        y0 = max(rect[1], 0)
+        x1 = min(rect[2], self.size.x - 1)
+        y1 = min(rect[3], self.size.y - 1)
+        base = self.OBS_LIGHT * self.__obs_plane
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                # HSV value is the brightest component; this is light_level without the extra calls
+                s = libtcod.console_get_char_background(self.__tcod_static_light_console, x, y)
+                m = libtcod.console_get_char_background(self.__tcod_moving_light_console, x, y)
+                self.__obs[base + x * self.size.y + y] = min(255, max(s.r, s.g, s.b) + max(m.r, m.g, m.b))
+
+    def observation_size(self):
+        """number of bytes written by observe()"""
+        return len(self.OBSERVATION_CHANNELS) * self.size.x * self.size.y
+
+    def observe(self, buf):
+        """copy the observation channels into buf, a writable bytes-like object of observation_size() bytes"""
+        buf[:len(self.__obs)] = self.__obs
+
+    def checksum(self, crc=0):
+        """CRC32 of the observable map state, continuing from crc. What has been seen is left out, as that only
+        changes when the map is drawn"""
+        obs  = memoryview(self.__obs)
+        seen = self.OBS_SEEN * self.__obs_plane
+        crc  = zlib.crc32(obs[:seen], crc)
+        return zlib.crc32(obs[seen + self.__obs_plane:], crc)
+
+    def label_components(self):
+        """label walkable cells by the connected component they are in, as pathing currently sees them: one label
+        per cell in components (x * size.y + y), 0 for unwalkable cells, and components numbered from 1 in order
+        of size, so 1 is the largest. component_sizes[label] is the number of cells with that label, and the clear
+        ones among them are kept apart for find_random_clear. Diagonal steps connect, as they do for get_path.
+        Returns components"""
+        (w, h) = (self.size.x, self.size.y)
+        walkable = [libtcod.map_is_walkable(self.__tcod_map, x, y) for x in range(w) for y in range(h)]
+        labels   = [0] * (w * h)
+        found    = [] # cells in each component, in order found
+
+        for i in range(w * h):
+            if not walkable[i] or labels[i]:
+                continue
+            labels[i] = -1
+            cells = [i]
+            for j in cells:
+                (x, y) = divmod(j, h)
+                for nx in range(max(x - 1, 0), min(x + 2, w)):
+                    for k in range(nx * h + max(y - 1, 0), nx * h + min(y + 2, h)):
+                        if walkable[k] and not labels[k]:
+                            labels[k] = -1
+                            cells.append(k)
+            found.append(cells)
+
+        # stable, so equal-sized components keep the order they were found in
+        found.sort(key=len, reverse=True)
+        for (label, cells) in enumerate(found, 1):
+            for i in cells:
+                labels[i] = label
+        self.components      = labels
+        self.component_sizes = [0] + [len(cells) for cells in found]
+        # each cell is in one component at most, so their sets can share one index
+        where = array('l', [-1]) * (w * h)
+        self.__free_in = [None] + [CellSet(w * h, where) for cells in found]
+        for i in self.__free.cells:
+            if labels[i]:
+                self.__free_in[labels[i]].add(i)
+        return labels
+
+    def get_distance(self, from_pos, to_pos):
+        """gets walking distance from from_pos to to_pos (diagonal steps cost more). -1.0 if there's no path"""
+        libtcod.dijkstra_compute(self.__tcod_pathfinder, from_pos.x, from_pos.y)
+        return libtcod.dijkstra_get_distance(self.__tcod_pathfinder, to_pos.x, to_pos.y)
+
     def close(self):
-        """close map (prior to deletion)"""
+        """close map (prior to deletion), freeing its libtcod handles. Closing a closed map does nothing"""
+        if not self.has_native():
+            return
         #libtcod.path_delete(self.__tcod_pathfinder)
         if not self.__tcod_pathfinder is None:
             libtcod.dijkstra_delete(self.__tcod_pathfinder)
+        for field in self.__flow_fields.values():
+            libtcod.dijkstra_delete(field[1])
+        self.__flow_fields = {}
         libtcod.map_delete(self.__tcod_map)
         libtcod.map_delete(self.__tcod_map_empty)
-        libtcod.console_delete(self.__tcod_static_light_console)
+        if not self.__static_light_share is None:
+            self.__static_light_share.release()
+            self.__static_light_share = None
         libtcod.console_delete(self.__tcod_moving_light_console)
+        # forget them, so that has_native is false and __del__ doesn't free them again
+        for a in Map.NATIVE_ATTRS:
+            self.__dict__.pop(a, None)
 
     def __del__(self):
         self.close()
 
+    def inert_tiles(self):
+        """tiles that never change during play (see Tile.is_inert)"""
+        return [t for ts in self.__layers[Tile].values() for t in ts if t.is_inert]
+
     def get_monsters(self):
         """get list of monsters in map"""
         return reduce(lambda a, b: a + b, self.__layers[Monster].values(), [])
@@ -394,6 +1012,11 @@ class Map:
         return reduce(lambda a, b: a + b, self.__layers[Item].values(), [])
 
     def generate(self):
+        """generate map, in the map's context, so that everything put on it joins the map's game"""
+        with self.context:
+            self._generate()
+
+    def _generate(self):
         """generate map (for subclasses to implement)"""
         raise NotImplementedError
 
@@ -415,28 +1038,27 @@ class Map:
         # figure out where to put it
         OPEN_SPACE_P  = 0.3 # probability weight of evidence being in the open
         hiding_places = self.find_all(CanHaveEvidence, Tile)
-        max_p         = reduce(lambda a, b: a + b, [h.evidence_chance for h in hiding_places], 0.0)
+        sampler       = WeightedSampler([h.evidence_chance for h in hiding_places])
+        max_p         = sampler.total
         p             = libtcod.random_get_float(self.map_rng, -OPEN_SPACE_P * max_p, max_p)
         if p <= 0.0:
-            e.pos = self.find_random_clear(self.map_rng)
+            # somewhere the player can get to from the stairs
+            self._gen_label_components()
+            e.pos = self.find_random_clear(self.map_rng, 1)
             self.add(e)
 
         else:
-            i = -1
-            while p > 0:
-                i += 1
-                p -= hiding_places[i].evidence_chance
-            hiding_places[i].evidence = e
+            hiding_places[sampler.locate(p)[0]].evidence = e
 
     def _gen_add_key_elements(self):
-        """add stairs and player"""
-        up_pos   = self.find_random_clear(self.map_rng)
-        down_pos = self.find_random_clear(self.map_rng)
-
-        self.recalculate_paths(is_for_mapping=True)
-        while len(self.get_path(up_pos, down_pos)) < 1:
-            up_pos   = self.find_random_clear(self.map_rng)
-            down_pos = self.find_random_clear(self.map_rng)
+        """add stairs and player, both stairs in the largest connected component"""
+        self._gen_label_components()
+        if self.component_sizes[1:2] < [2]:
+            raise MapGenerationError("No room for stairs: walkable areas are %s cells" % self.component_sizes[1:])
+        up_pos   = self.find_random_clear(self.map_rng, 1)
+        down_pos = self.find_random_clear(self.map_rng, 1)
+        while down_pos == up_pos:
+            down_pos = self.find_random_clear(self.map_rng, 1)
 
         # place stairs
         self.add(StairsDown(down_pos))
@@ -446,6 +1068,13 @@ class Map:
         self.player.pos = up_pos
         self.add(self.player)
 
+    def _gen_label_components(self):
+        """label connected components for placing things, with things like teleports counted as impassable, unless
+        already done. Nothing placed after labelling should change what is walkable"""
+        if self.components is None:
+            self.recalculate_paths(is_for_mapping=True)
+            self.label_components()
+
     def _gen_apply_patterns(self, map_array):
         """given a 2d array of MapPattern flags representing a map layout, randomly add features in valid places"""
         # won't return consistently ordered list!
@@ -474,18 +1103,18 @@ class Map:
         self.player.reset_fov()
 
     @staticmethod
-    def random(seed, size, player):
+    def random(seed, size, player, context=None):
         """return a random map of size for player using given RNG seed"""
         print(" -- MAP SEED %d --" % seed)
-        #return EmptyMap(seed,size,player)
-        #return DalekMap(seed,size,player)
-        return TypeAMap(seed, size, player)
+        #return EmptyMap(seed,size,player,context)
+        #return DalekMap(seed,size,player,context)
+        return TypeAMap(seed, size, player, context)
 
 
 class EmptyMap(Map):
     """Empty map, no monsters or items"""
 
-    def generate(self):
+    def _generate(self):
         """generate"""
         self._gen_draw_map_edges()
 
@@ -513,7 +1142,7 @@ class EmptyMap(Map):
 
 class DalekMap(Map):
     """Simple map with central obstruction, monsters and items."""
-    def generate(self):
+    def _generate(self):
         self._gen_draw_map_edges()
 
         # put floor in
@@ -579,16 +1208,20 @@ class TypeAMap(Map):
     REJECT_COVERAGE_PC  = 0.6
     REJECT_COVERAGE_SQ  = 0.8
     SANITY_LIMIT        = 100
+    MAX_LAYOUTS         = 100
     BOUNDARY_UNSET      = -1
     TELEPORT_CHANCE     = 0.2 # just less than 1 per room
     LIGHT_MIN_RADIUS    = 8
     LIGHT_MAX_RADIUS    = 25
     DEBUG               = False
 
-    def __init__(self, seed, size, player):
+    def __init__(self, seed, size, player, context=None):
         """map constructor"""
-        Map.__init__(self, seed, size, player)
+        Map.__init__(self, seed, size, player, context)
         self._map = [[]]
+        self.room_count = 0
+        self.layouts    = 0  # generated, including rejected ones
+        self.rejections = {} # reason: count
 
     def debug_print(self, s):
         """for debugging map gen code"""
@@ -623,6 +1256,14 @@ class TypeAMap(Map):
             assert self.pos.x + self.size.x <= len(m) and self.pos.y + self.size.y <= len(m[0]), \
                 "Can't commit %s to grid size (%d,%d)" % (self, len(m), len(m[0]))
             #self.debug_print(".commit %s to grid size (%d,%d)"%(self,len(m),len(m[0])))
+            if numpy_available and isinstance(m, numpy.ndarray):
+                if self.pos.x >= 0 and self.pos.y >= 0:
+                    m[self.pos.x:self.pos.x + self.size.x, self.pos.y:self.pos.y + self.size.y] |= self.tile_id
+                else:
+                    # elements can hang off the top or left, and wrap round as list indices do
+                    m[numpy.ix_(numpy.arange(self.pos.x, self.pos.x + self.size.x),
+                                numpy.arange(self.pos.y, self.pos.y + self.size.y))] |= self.tile_id
+                return
             for x in range(self.size.x):
                 for y in range(self.size.y):
                     #print(" ... (%d,%d) = %d"%(x+self.pos.x,y+self.pos.y,self.tile_id))
@@ -760,8 +1401,53 @@ class TypeAMap(Map):
         else:
             return self._gen_get_centre_tile(border)
 
+    def _gen_first_hit(self, x_range, y_range):
+        """[(x,y)] of the first occupied tile in _map, going through x_range then y_range; [] if none are"""
+        # edges running off the map (rare) are left to the loop, which wraps round or stops at the first hit
+        if not isinstance(self._map, list) and x_range.start >= 0 and y_range.start >= 0 \
+                and x_range.stop <= self.size.x and y_range.stop <= self.size.y:
+            i = numpy.flatnonzero(self._map[x_range.start:x_range.stop, y_range.start:y_range.stop])
+            if len(i) == 0:
+                return []
+            (x, y) = divmod(int(i[0]), len(y_range))
+            return [(x_range[x], y_range[y])]
+        for x in x_range:
+            for y in y_range:
+                if self._map[x][y] > 0:
+                    return [(x, y)]
+        return []
+
+    def _gen_cells_to_place(self):
+        """([(x,y)] of the tiles in _map to make map objects for, in x then y order; number of empty edge tiles).
+        Those are the occupied tiles and the empty tiles, away from the edge, with an occupied neighbour"""
+        (w, h) = (self.size.x, self.size.y)
+        if not isinstance(self._map, list):
+            occupied = self._map > 0
+            near = numpy.zeros_like(occupied)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    near[1:w - 1, 1:h - 1] |= occupied[1 + dx:w - 1 + dx, 1 + dy:h - 1 + dy]
+            edge = numpy.ones_like(occupied)
+            edge[1:w - 1, 1:h - 1] = False
+            misses = int(numpy.count_nonzero(edge & ~occupied))
+            return ([(int(x), int(y)) for (x, y) in numpy.argwhere(occupied | near)], misses)
+
+        cells  = []
+        misses = 0
+        for x in range(w):
+            for y in range(h):
+                if self._map[x][y] > 0:
+                    cells.append((x, y))
+                elif x > 0 and y > 0 and x < w - 1 and y < h - 1:
+                    if max(self._map[x + dx][y + dy] for dx in (-1, 0, 1) for dy in (-1, 0, 1)) > 0:
+                        cells.append((x, y))
+                else:
+                    misses += 1
+        return (cells, misses)
+
     def _gen_room(self, opos):
-        """Make a room, spiralling out from <pos>. Uses _map to identify collisions with corridors and other features"""
+        """Make a room, spiralling out from <pos>. Uses _map to identify collisions with corridors and other features.
+        Raises MapRejectedError if the room never stops growing"""
         # 6
         # 6455555     x = 1
         # 6423335     while 1:
@@ -828,17 +1514,17 @@ class TypeAMap(Map):
 
         while min(bounds.values()) == self.BOUNDARY_UNSET:
             sanity += 1
-            if sanity > self.SANITY_LIMIT * 10:
-                assert False, "Sanity limits hit in room gen"
+            if sanity > self.SANITY_LIMIT * max(10, (self.size.x + self.size.y) // 10):
+                raise MapRejectedError("room sanity")
             if direction in ['N', 'S']:
                 if bounds[direction] == self.BOUNDARY_UNSET:
-                    size.y += 1
+                    size = size + (0, 1)
                     length = size.y
                 else:
                     length = abs(bounds[direction] - pos.y) - 1
             else:
                 if bounds[direction] == self.BOUNDARY_UNSET:
-                    size.x += 1
+                    size = size + (1, 0)
                     length = size.x
                 else:
                     length = abs(bounds[direction] - pos.x) - 1
@@ -853,78 +1539,68 @@ class TypeAMap(Map):
             if pos.y > target_pos.y:
                 y_range = range(target_pos.y, pos.y + 1)
 
-            found = False
-            for x in x_range:
-                for y in y_range:
-                    if self._map[x][y] > 0:
-                        if (x == target_pos.x and y == target_pos.y):
-                            # hit at end of edge; don't need to rewind direction
-                            target_pos -= self._gen_pos_from_dir(direction, 1)
-
-                            # if we've already hit this edge, don't reset boundary
-                            if bounds[direction] != self.BOUNDARY_UNSET:
-                                self.debug_print("    end hit %d ignored at (%d,%d) size=%s; target now %s" % (
-                                        self._map[x][y], x, y, size, target_pos))
-                                found = True
-                                break
-                            self.debug_print("    end hit %d at (%d,%d) size=%s; target now %s" % (
-                                    self._map[x][y], x, y, size, target_pos))
-
-                            #  * put a door at collision point
-                            self.debug_print("    Door added in corner at %s" % (
-                                    target_pos + self._gen_pos_from_dir(self._gen_get_compass_right(direction), 1)))
-                            r_segs.append(self._ME(MapPattern.DOOR, target_pos + \
-                                                       self._gen_pos_from_dir(self._gen_get_compass_right(direction), 1),
-                                                   Position(1, 1),
-                                                   Position(x, y)))
-                            t = self._gen_get_compass_left(direction)
-                            if bounds[t] == self.BOUNDARY_UNSET:
-                                if t in ('N', 'S'):
-                                    bounds[t] = y + self._gen_pos_from_dir(t, 1).y
-                                else:
-                                    bounds[t] = x + self._gen_pos_from_dir(t, 1).x
-
-                        elif bounds[self._gen_get_compass_left(direction)] != self.BOUNDARY_UNSET:
-                            target_pos -= self._gen_pos_from_dir(direction, 1)
-                            self.debug_print("        hit %d ignored at (%d,%d) size=%s; target now %s" % (
-                                    self._map[x][y], x, y, size, target_pos))
-
-                            if bounds[direction] != self.BOUNDARY_UNSET:
-                                found = True
-                                break
-                            self.debug_print("        substituting for current dir! %s" % direction)
-                            target_pos -= self._gen_pos_from_dir(direction, 1)
+            # only the first hit along the edge matters
+            for (x, y) in self._gen_first_hit(x_range, y_range):
+                if (x == target_pos.x and y == target_pos.y):
+                    # hit at end of edge; don't need to rewind direction
+                    target_pos -= self._gen_pos_from_dir(direction, 1)
+
+                    # if we've already hit this edge, don't reset boundary
+                    if bounds[direction] != self.BOUNDARY_UNSET:
+                        self.debug_print("    end hit %d ignored at (%d,%d) size=%s; target now %s" % (
+                                self._map[x][y], x, y, size, target_pos))
+                        break
+                    self.debug_print("    end hit %d at (%d,%d) size=%s; target now %s" % (
+                            self._map[x][y], x, y, size, target_pos))
+
+                    #  * put a door at collision point
+                    self.debug_print("    Door added in corner at %s" % (
+                            target_pos + self._gen_pos_from_dir(self._gen_get_compass_right(direction), 1)))
+                    r_segs.append(self._ME(MapPattern.DOOR, target_pos + \
+                                               self._gen_pos_from_dir(self._gen_get_compass_right(direction), 1),
+                                           Position(1, 1),
+                                           Position(x, y)))
+                    t = self._gen_get_compass_left(direction)
+                    if bounds[t] == self.BOUNDARY_UNSET:
+                        if t in ('N', 'S'):
+                            bounds[t] = y + self._gen_pos_from_dir(t, 1).y
                         else:
-                            # collision with a corridor or another room
-                            #  * turn back anti-clockwise
-                            direction = self._gen_get_compass_left(direction)
-                            #  * move back one square from pos
-                            target_pos = pos - self._gen_pos_from_dir(direction, 1)
-
-                            if direction in ['N', 'S']:
-                                size.y -= 1
-                            else:
-                                size.x -= 1
-
-                            self.debug_print("        hit %d at (%d,%d) size=%s; target now %s" % (self._map[x][y], x, y, size, target_pos))
-
-                            #  * put a door at collision point
-                            self.debug_print("        Door added at %s" % (Position(x, y) - self._gen_pos_from_dir(direction, 1)))
-                            r_segs.append(self._ME(MapPattern.DOOR, Position(x, y) - self._gen_pos_from_dir(direction, 1), Position(1, 1), Position(x, y)))
-
-                        #  * record this position as the bound for this direction
-                        if bounds[direction] == self.BOUNDARY_UNSET:
-                            if direction in ['N', 'S']:
-                                bounds[direction] = y
-                            else:
-                                bounds[direction] = x
-                        self.debug_print("        bounds = %s" % bounds)
-
-                        #  * continue
-                        found = True
+                            bounds[t] = x + self._gen_pos_from_dir(t, 1).x
+
+                elif bounds[self._gen_get_compass_left(direction)] != self.BOUNDARY_UNSET:
+                    target_pos -= self._gen_pos_from_dir(direction, 1)
+                    self.debug_print("        hit %d ignored at (%d,%d) size=%s; target now %s" % (
+                            self._map[x][y], x, y, size, target_pos))
+
+                    if bounds[direction] != self.BOUNDARY_UNSET:
                         break
-                if found:
-                    break
+                    self.debug_print("        substituting for current dir! %s" % direction)
+                    target_pos -= self._gen_pos_from_dir(direction, 1)
+                else:
+                    # collision with a corridor or another room
+                    #  * turn back anti-clockwise
+                    direction = self._gen_get_compass_left(direction)
+                    #  * move back one square from pos
+                    target_pos = pos - self._gen_pos_from_dir(direction, 1)
+
+                    if direction in ['N', 'S']:
+                        size = size - (0, 1)
+                    else:
+                        size = size - (1, 0)
+
+                    self.debug_print("        hit %d at (%d,%d) size=%s; target now %s" % (self._map[x][y], x, y, size, target_pos))
+
+                    #  * put a door at collision point
+                    self.debug_print("        Door added at %s" % (Position(x, y) - self._gen_pos_from_dir(direction, 1)))
+                    r_segs.append(self._ME(MapPattern.DOOR, Position(x, y) - self._gen_pos_from_dir(direction, 1), Position(1, 1), Position(x, y)))
+
+                #  * record this position as the bound for this direction
+                if bounds[direction] == self.BOUNDARY_UNSET:
+                    if direction in ['N', 'S']:
+                        bounds[direction] = y
+                    else:
+                        bounds[direction] = x
+                self.debug_print("        bounds = %s" % bounds)
 
             direction = self._gen_get_compass_right(direction)
             pos = target_pos
@@ -1106,10 +1782,78 @@ class TypeAMap(Map):
 
         return c_segs
 
-    def generate(self):
-        """generate map"""
+    def _generate(self):
+        """generate map. Layouts are generated until one passes the acceptance checks, up to MAX_LAYOUTS times,
+        before anything is added to the map; layouts and rejections count them"""
+        for i in range(self.MAX_LAYOUTS):
+            self.layouts += 1
+            try:
+                (corridors, rooms) = self._gen_layout()
+                break
+            except MapRejectedError as e:
+                self.debug_print("Rejecting map !!! (%s)" % e)
+                self.rejections[str(e)] = self.rejections.get(str(e), 0) + 1
+        else:
+            raise MapGenerationError("No acceptable layout in %d tries: %s" % (self.MAX_LAYOUTS, self.rejections))
+
+        self._gen_place_tiles(corridors, rooms)
+
+        #####  PSEUDO-CODE  #########################################
+        # * corridors and rooms include just walkable tiles
+        # * route one corridor across most of map
+        #    * choose random site near one edge of map
+        #    * choose random site near far edge of map
+        #    * choose corridor width
+        #    * choose number of corridor bends (1-4, depending on sites)
+        #    * plot corridor
+        # * calculate allowance for intersecting corridors (1-5)
+        # * consume allowance: 1 for 1 tile width; 2 for 2 tile width, multiplied by 1 for short corridor, 2 for long
+        #    * choose random intersect on main corridor
+        #    * choose random length and termination points
+        #    * choose random number of bends
+        #    * plot corridor
+        # * for each remaining unplotted tile
+        #    * calculate largest square that can be made without overlapping a corridor+1 tile
+        #    * if square size > threshold or (>0 and random chance):
+        #       * if square overlaps another one
+        #          * if this square size > that square size
+        #             * remove that square
+        #          * else continue
+        #       * save square
+        # [* may need to repeat this loop 2-3 times, making squares permanent at each point]
+        # * for each square larger than threshold:
+        #    * if random chance succeeds:
+        #        * sub-divide with partitions
+        # * create doors at intersects
+        # * use pathing to prove map traversable
+        # * for tile in empty tiles:
+        #    * if tile adjoins one walkable tile, it is a wall tile
+
+
+        # place daleks
+        for i in range(15):
+            d = Monster.random(self.map_rng, self.find_random_clear(self.map_rng))
+            self.add(d)
+
+        # place some items
+        for i in range(8):
+            i = Item.random(self.map_rng, self.find_random_clear(self.map_rng))
+            self.add(i)
+
+        # add evidence
+        self._gen_add_evidence()
+
+        self._gen_add_key_elements()
+        self._gen_finish()
+
+    def _gen_layout(self):
+        """lay out corridors and rooms in _map. Returns (corridors, rooms) as lists of map elements.
+        Raises MapRejectedError if the layout is no good"""
         # reset internal map structure
-        self._map = [[0 for y in range(self.size.y)] for x in range(self.size.x)]
+        if numpy_available:
+            self._map = numpy.zeros((self.size.x, self.size.y), dtype=numpy.uint8)
+        else:
+            self._map = [[0 for y in range(self.size.y)] for x in range(self.size.x)]
 
         # map boundaries
         #self._gen_draw_map_edges()
@@ -1153,8 +1897,7 @@ class TypeAMap(Map):
         while used_len < main_len:
             sanity += 1
             if sanity > self.SANITY_LIMIT:
-                assert False, "broke sanity trying to add wriggle corridors"
-                break
+                raise MapRejectedError("wriggle corridors")
             delta_len = libtcod.random_get_int(self.map_rng, 0, self.CORRIDOR_MINOR_FREQ) * self.CORRIDOR_MINOR_STEP
             index_len += delta_len
             while index_len > corridors[c_idx].length:
@@ -1186,8 +1929,10 @@ class TypeAMap(Map):
             if c.pos + c.size > coverage_br_pos:
                 coverage_br_pos = c.pos + c.size
         if coverage_tl_pos.distance_to(coverage_br_pos) < Position(0, 0).distance_to(self.size) * self.REJECT_COVERAGE_PC:
-            self.debug_print("Rejecting map !!!")
-            return self.generate()
+            raise MapRejectedError("corridor coverage")
+        for c in corridors:
+            if c.pos.x + c.size.x > self.size.x or c.pos.y + c.size.y > self.size.y:
+                raise MapRejectedError("corridor off map")
 
         # * commit corridors to map
         for c in corridors:
@@ -1195,18 +1940,32 @@ class TypeAMap(Map):
 
         # * randomly pick empty tiles and grow rooms until they touch corridors
         room_count = 0
+        room_tries = 0
         while room_count < libtcod.random_get_int(self.map_rng, self.MIN_ROOMS, self.MAX_ROOMS):
+            room_tries += 1
+            if room_tries > self.SANITY_LIMIT * 10:
+                raise MapRejectedError("rooms")
             r = self._gen_room(self._gen_get_centre_tile(3))
             if len(r) > 0:
                 room_count += 1
                 rooms += r
                 for ri in r:
                     ri.commit(self._map) # prevents rooms from overlapping as much
+        self.room_count = room_count
 
         # put edges back
         for e in edges:
             e.commit(self._map)
 
+        # check coverage before anything is made from the layout
+        (cells, misses) = self._gen_cells_to_place()
+        if 1.0 - (misses / (self.size.x * self.size.y)) < self.REJECT_COVERAGE_SQ:
+            raise MapRejectedError("coverage")
+
+        return (corridors, rooms)
+
+    def _gen_place_tiles(self, corridors, rooms):
+        """add tiles, and features matching tile patterns, for the layout in _map"""
         # [* may need to repeat this loop 2-3 times, making squares permanent at each point]
         # * for each square larger than threshold:
         #    * if random chance succeeds:
@@ -1217,134 +1976,72 @@ class TypeAMap(Map):
 
         self._gen_apply_patterns(self._map)
 
-        misses = 0
-        for x in range(len(self._map)):
-            for y in range(len(self._map[x])):
-                t = self._map[x][y]
-
-                if t & MapPattern.SPECIAL:
-                    # assume special tiles have already managed floor/wall space, if necessary
-                    pass
-
-                elif t & MapPattern.DOOR:
-                    # only draw door if exactly two tiles in compass directions are walkable
-                    m_ns = 0
-                    m_ew = 0
-                    if y > 0 and y < self.size.y - 1:
-                        n = self._map[x][y - 1]
-                        s = self._map[x][y + 1]
-                        if n & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0 \
-                                and s & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0:
-                            m_ns = 1
-                        if (n & (MapPattern.WALL | MapPattern.DOOR) > 0 or n == 0) \
-                                and (s & (MapPattern.WALL | MapPattern.DOOR) > 0 or s == 0):
-                            m_ns = -1
-                    if x > 0 and x < self.size.x - 1:
-                        e = self._map[x - 1][y]
-                        w = self._map[x + 1][y]
-                        if e & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0 \
-                                and w & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0:
-                            m_ew = 1
-                        if (e & (MapPattern.WALL | MapPattern.DOOR) > 0 or e == 0) \
-                                and (w & (MapPattern.WALL | MapPattern.DOOR) > 0 or w == 0):
-                            m_ew = -1
-                    #if True or (m_ns > 0 and m_ew < 0) or (m_ns < 0 and m_ew > 0):
-                    if (m_ns > 0 and m_ew < 0) or (m_ns < 0 and m_ew > 0):
-                        self.add(Floor(Position(x, y)))
-                        self.add(Door(Position(x, y)))
-                    elif m_ns <= 0 and m_ew <= 0:
-                        self.add(Wall(Position(x, y)))
-                    else:
-                        self.add(Floor(Position(x, y)))
-
-                elif t & MapPattern.CORRIDOR:
-                    self.add(Floor(Position(x, y)))
-
-                elif t & MapPattern.ROOM:
+        # only occupied tiles, and empty ones that need a wall, have anything to place
+        cells = self._gen_cells_to_place()[0]
+        grid = isinstance(self._map, list) and self._map or self._map.tolist()
+        for (x, y) in cells:
+            t = grid[x][y]
+
+            if t & MapPattern.SPECIAL:
+                # assume special tiles have already managed floor/wall space, if necessary
+                pass
+
+            elif t & MapPattern.DOOR:
+                # only draw door if exactly two tiles in compass directions are walkable
+                m_ns = 0
+                m_ew = 0
+                if y > 0 and y < self.size.y - 1:
+                    n = grid[x][y - 1]
+                    s = grid[x][y + 1]
+                    if n & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0 \
+                            and s & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0:
+                        m_ns = 1
+                    if (n & (MapPattern.WALL | MapPattern.DOOR) > 0 or n == 0) \
+                            and (s & (MapPattern.WALL | MapPattern.DOOR) > 0 or s == 0):
+                        m_ns = -1
+                if x > 0 and x < self.size.x - 1:
+                    e = grid[x - 1][y]
+                    w = grid[x + 1][y]
+                    if e & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0 \
+                            and w & (MapPattern.CORRIDOR | MapPattern.ROOM | MapPattern.SPECIAL) > 0:
+                        m_ew = 1
+                    if (e & (MapPattern.WALL | MapPattern.DOOR) > 0 or e == 0) \
+                            and (w & (MapPattern.WALL | MapPattern.DOOR) > 0 or w == 0):
+                        m_ew = -1
+                #if True or (m_ns > 0 and m_ew < 0) or (m_ns < 0 and m_ew > 0):
+                if (m_ns > 0 and m_ew < 0) or (m_ns < 0 and m_ew > 0):
                     self.add(Floor(Position(x, y)))
-
-                elif t & MapPattern.WALL:
+                    self.add(Door(Position(x, y)))
+                elif m_ns <= 0 and m_ew <= 0:
                     self.add(Wall(Position(x, y)))
-
-                elif t == 0:
-                    if x > 0 and y > 0 and x < self.size.x - 1 and y < self.size.y - 1:
-                        # * if tile adjoins one walkable tile, it is a wall tile
-                        if self._map[x - 1][y - 1] > 0 or \
-                           self._map[x][y - 1] > 0 or \
-                           self._map[x + 1][y - 1] > 0 or \
-                           self._map[x - 1][y] > 0 or \
-                           self._map[x][y] > 0 or \
-                           self._map[x + 1][y] > 0 or \
-                           self._map[x - 1][y + 1] > 0 or \
-                           self._map[x][y + 1] > 0 or \
-                           self._map[x + 1][y + 1] > 0:
-                            self.add(Wall(Position(x, y)))
-                    else:
-                        misses += 1
                 else:
-                    print("WARNING: Invalid _map data at pos (%d,%d); flags 0x%x" % (x, y, self._map[x][y]))
-                    #assert False, "Invalid _map data at pos (%d,%d); flags 0x%x"%(x,y,self._map[x][y])
-
-                # overlay lights
-                if t & MapPattern.LIGHT:
-                    self.add(Light(Position(x, y), libtcod.random_get_int(self.map_rng, self.LIGHT_MIN_RADIUS, self.LIGHT_MAX_RADIUS)))
-
-        # add remaining lights
-        for s in corridors + rooms:
-            if s.flat_light and (s.tile_id & (MapPattern.CORRIDOR | MapPattern.ROOM)):
-                self.add(FlatLight(s.pos, s.size))
-
-        if 1.0 - (misses / (self.size.x * self.size.y)) < self.REJECT_COVERAGE_SQ:
-            return self.generate()
+                    self.add(Floor(Position(x, y)))
 
+            elif t & MapPattern.CORRIDOR:
+                self.add(Floor(Position(x, y)))
 
-        #####  PSEUDO-CODE  #########################################
-        # * corridors and rooms include just walkable tiles
-        # * route one corridor across most of map
-        #    * choose random site near one edge of map
-        #    * choose random site near far edge of map
-        #    * choose corridor width
-        #    * choose number of corridor bends (1-4, depending on sites)
-        #    * plot corridor
-        # * calculate allowance for intersecting corridors (1-5)
-        # * consume allowance: 1 for 1 tile width; 2 for 2 tile width, multiplied by 1 for short corridor, 2 for long
-        #    * choose random intersect on main corridor
-        #    * choose random length and termination points
-        #    * choose random number of bends
-        #    * plot corridor
-        # * for each remaining unplotted tile
-        #    * calculate largest square that can be made without overlapping a corridor+1 tile
-        #    * if square size > threshold or (>0 and random chance):
-        #       * if square overlaps another one
-        #          * if this square size > that square size
-        #             * remove that square
-        #          * else continue
-        #       * save square
-        # [* may need to repeat this loop 2-3 times, making squares permanent at each point]
-        # * for each square larger than threshold:
-        #    * if random chance succeeds:
-        #        * sub-divide with partitions
-        # * create doors at intersects
-        # * use pathing to prove map traversable
-        # * for tile in empty tiles:
-        #    * if tile adjoins one walkable tile, it is a wall tile
+            elif t & MapPattern.ROOM:
+                self.add(Floor(Position(x, y)))
 
+            elif t & MapPattern.WALL:
+                self.add(Wall(Position(x, y)))
 
-        # place daleks
-        for i in range(15):
-            d = Monster.random(self.map_rng, self.find_random_clear(self.map_rng))
-            self.add(d)
+            elif t == 0:
+                # empty tile next to a walkable one
+                self.add(Wall(Position(x, y)))
 
-        # place some items
-        for i in range(8):
-            i = Item.random(self.map_rng, self.find_random_clear(self.map_rng))
-            self.add(i)
+            else:
+                print("WARNING: Invalid _map data at pos (%d,%d); flags 0x%x" % (x, y, grid[x][y]))
+                #assert False, "Invalid _map data at pos (%d,%d); flags 0x%x"%(x,y,grid[x][y])
 
-        # add evidence
-        self._gen_add_evidence()
+            # overlay lights
+            if t & MapPattern.LIGHT:
+                self.add(Light(Position(x, y), libtcod.random_get_int(self.map_rng, self.LIGHT_MIN_RADIUS, self.LIGHT_MAX_RADIUS)))
 
-        self._gen_add_key_elements()
-        self._gen_finish()
+        # add remaining lights
+        for s in corridors + rooms:
+            if s.flat_light and (s.tile_id & (MapPattern.CORRIDOR | MapPattern.ROOM)):
+                self.add(FlatLight(s.pos, s.size))
 
 
 class TypeBMap(Map):
@@ -4,10 +4,11 @@ import libtcodpy as libtcod
 from interfaces import Mappable, Position, Activatable, Activator, CountUp, Talker, TurnTaker, Alertable, Shouter, StatusEffect, LightSource
 from errors import GameOverError, InvalidMoveError, TodoError
 from ui import HBar, Message, Menu
+from sampling import WeightedSampler
 
 # lang imports
-from functools import reduce
 import re # for sub
+from array import array
 
 class Monster_State:
     def __init__(self,monster):
@@ -16,12 +17,34 @@ class Monster_State:
     def get_move(self):
         raise NotImplementedError
 
+    def enter(self):
+        """monster has taken this state up"""
+        pass
+
+    def leave(self):
+        """monster has given this state up"""
+        pass
+
 
 class AI:
     """effectively a Monster_State factory"""
     def __init__(self):
         self.reset_state()
 
+    def __get_state(self):
+        return self.__state
+
+    def __set_state(self, state):
+        old = getattr(self, '_AI__state', None)
+        if state is old:
+            return
+        self.__state = state
+        if not old is None:
+            old.leave()
+        state.enter()
+
+    state = property(__get_state, __set_state, doc="current Monster_State, which is told when taken up and given up")
+
     def get_next_state(self):
         raise NotImplementedError
 
@@ -34,6 +57,7 @@ class Monster (Mappable, TurnTaker, StatusEffect):
     generator_weight = 1.0
     # put most dangerous to right
     GENERATOR = []
+    SAMPLER   = None # over generator_weight, in GENERATOR order
 
     def __init__(self,pos,symbol,colour):
         Mappable.__init__(self,pos,symbol,colour)
@@ -47,23 +71,13 @@ class Monster (Mappable, TurnTaker, StatusEffect):
     def random(rng,pos,weight=1.0):
         if Monster.GENERATOR == []:
             Monster.__GEN_GENERATOR()
-        
-        max_weight = reduce( lambda a,b: a+b, [C.generator_weight for C in Monster.GENERATOR], 0.0 )
-        r = max_weight + 1.0
-
-        while r > max_weight:
-            r = libtcod.random_get_float(rng,0.0,max_weight * weight)
 
-        m_idx = 0
-        while r > Monster.GENERATOR[m_idx].generator_weight:
-            r -= Monster.GENERATOR[m_idx].generator_weight
-            m_idx += 1
-
-        return Monster.GENERATOR[m_idx](pos)
+        return Monster.GENERATOR[Monster.SAMPLER.choose(rng,weight)](pos)
 
     @staticmethod
     def __GEN_GENERATOR():
         Monster.GENERATOR = [StaticCamera,CrateLifter,Dalek,SlowDalek,BetterDalek,LitDalek]
+        Monster.SAMPLER   = WeightedSampler([C.generator_weight for C in Monster.GENERATOR])
 
     @staticmethod
     def get_monster_by_name(name):
@@ -86,7 +100,7 @@ class MS_Confused(Monster_State,CountUp):
         self.inc()
 
         # this will give us a random direction +/- 1 square, or no move
-        d = libtcod.random_get_int(None,0,8)
+        d = libtcod.random_get_int(self.monster.context.rng('ai'),0,8)
         v = Position( d%3-1, d//3-1 )        
         return self.monster.pos + v
 
@@ -99,33 +113,68 @@ class MS_LostSearchTarget(MS_Confused):
         MS_Confused.__init__(self,monster,2)
 
 class MS_SeekingPlayer(Monster_State):
+    """head for the player, by the map's flow field towards where they are, shared with everyone else chasing them"""
     def __init__(self,monster):
         Monster_State.__init__(self,monster)
+        self.__flow = None # (map, pos) of the flow field in use
+
+    def leave(self):
+        if not self.__flow is None:
+            self.__flow[0].release_flow(self.__flow[1])
+            self.__flow = None
 
     def get_move(self):
-        p = self.monster.map.player
-        next_move = self.monster.map.get_path(self.monster.pos,p.pos,1)
-        self.player_last_pos = Position(p.pos.x,p.pos.y)
-
-        if len(next_move):
-            if not self.monster.pos.distance_to(next_move[0])<2:
-                next_move = [self.monster.pos]#self.monster.map.get_path(self.monster.pos,p.pos)
-                print ("BAD MOVE BY %s" % self.monster)
-            assert self.monster.pos.distance_to(next_move[0])<2, "Illegal move by %s to %s"%(self.monster,next_move[0])
-            return next_move[0]
-        else:
-            assert False, "Can't chase player!"
+        m = self.monster.map
+        p = m.player
+        self.player_last_pos = p.pos
+
+        # follow the player's field, wherever they have got to
+        if self.__flow != (m,p.pos):
+            self.leave()
+            self.__flow = (m,p.pos)
+            m.use_flow(p.pos)
+
+        next_move = m.flow_step(self.monster.pos,p.pos)
+        if next_move is None:
+            # e.g. seen through a window
+            print("WARNING: %s can't chase player at %s" % (self.monster,p.pos))
+            return self.monster.pos
+        return next_move
 
 class MS_InvestigateSpot(Monster_State):
+    """head for destination_pos, by the map's flow field towards it, shared with everyone else heading there"""
     def __init__(self,monster,pos):
         Monster_State.__init__(self,monster)
-        self.destination_pos = pos
+        self.__destination_pos = pos
+        self.__flow = None # (map, pos) of the flow field in use, while this is the monster's state
+
+    def enter(self):
+        if not self.monster.map is None:
+            self.__flow = (self.monster.map,self.__destination_pos)
+            self.monster.map.use_flow(self.__destination_pos)
+
+    def leave(self):
+        if not self.__flow is None:
+            self.__flow[0].release_flow(self.__flow[1])
+            self.__flow = None
+
+    @property
+    def destination_pos(self):
+        return self.__destination_pos
+
+    @destination_pos.setter
+    def destination_pos(self,pos):
+        in_use = not self.__flow is None
+        self.leave()
+        self.__destination_pos = pos
+        if in_use:
+            self.enter()
 
     def get_move(self):
-        next_move = self.monster.map.get_path(self.monster.pos,self.destination_pos)
+        next_move = self.monster.map.flow_step(self.monster.pos,self.destination_pos)
 
-        if len(next_move):
-            return next_move[0]
+        if not next_move is None:
+            return next_move
         elif self.monster.pos == self.destination_pos:
             if isinstance(self.monster,Alertable):
                 self.monster.clear_alert(self.destination_pos)
@@ -136,23 +185,58 @@ class MS_InvestigateSpot(Monster_State):
             return self.monster.pos
 
 class MS_Patrolling(Monster_State):
+    """walk back and forth between where patrolling started and a random point at least min_distance away that can
+    be walked to from there. Each leg's route is worked out once and kept as map cells, and only worked out again
+    if the monster is moved off it (e.g. by tangling or teleporting) or the map changes so that something blocks it"""
     def __init__(self,monster,min_distance=10):
         Monster_State.__init__(self,monster)
+        m = monster.map
+        component = not m.components is None and m.components[monster.pos.cell(m.size.y)] or None
         self.patrolpt1 = monster.pos
-        while True:
-            self.patrolpt2 = monster.map.find_random_clear()
-            if self.patrolpt1.distance_to(self.patrolpt2) > min_distance:
-                break
+        self.patrolpt2 = m.find_random_clear(monster.context.rng('ai'),component,monster.pos,min_distance)
+        self.route     = None # cells from patrolpt1 (or wherever the monster was) to patrolpt2
+        self.step      = 0    # index in route of the monster's cell
+        self.version   = None # map geometry version the route was checked against
+
+    def __plan(self):
+        m = self.monster.map
+        self.route   = array('l',[p.cell(m.size.y) for p in [self.monster.pos] + m.get_path(self.monster.pos,self.patrolpt2)])
+        self.step    = 0
+        self.version = m.geometry_version
+
+    def __is_blocked(self):
+        m = self.monster.map
+        for i in self.route[self.step+1:]:
+            if m.is_blocked(Position.from_cell(i,m.size.y)):
+                return True
+        self.version = m.geometry_version
+        return False
 
     def get_move(self):
-        if self.monster.pos == self.patrolpt2:
+        m = self.monster.map
+        here = self.monster.pos.cell(m.size.y)
+
+        # keep up with the monster, which may not have moved, or may have been moved off the route
+        if not self.route is None and self.step+1 < len(self.route) and self.route[self.step+1] == here:
+            self.step += 1
+        if self.route is None or self.route[self.step] != here \
+                or (self.version != m.geometry_version and self.__is_blocked()):
+            self.__plan()
+
+        if self.step == len(self.route)-1:
+            # end of the leg: back the way we came, if we came from the other end
             (self.patrolpt1,self.patrolpt2) = (self.patrolpt2,self.patrolpt1)
-        next_move = self.monster.map.get_path(self.monster.pos,self.patrolpt2)
+            if self.route[0] == self.patrolpt2.cell(m.size.y):
+                self.route.reverse()
+                self.step = 0
+            else:
+                self.__plan()
 
-        if len(next_move):
-            return next_move[0]
+        if self.step+1 < len(self.route):
+            return Position.from_cell(self.route[self.step+1],m.size.y)
         else:
-            assert False, "Can't patrol!"
+            # nowhere to go
+            return self.monster.pos
 
 class MS_Stationary(Monster_State):
     def get_move(self):
@@ -241,7 +325,7 @@ class CrateLifter (Monster,Tanglable,Talker,Shouter,AI):
                             self.am_carrying_my_crate = True
                             
                             # * choose somewhere to put it
-                            self.state.destination_pos = self.map.find_random_clear()
+                            self.state.destination_pos = self.map.find_random_clear(self.context.rng('ai'))
 
                         else:
                             # someone is in my crate :(
@@ -261,7 +345,7 @@ class CrateLifter (Monster,Tanglable,Talker,Shouter,AI):
                     if len( [c for c in self.map.find_all_at_pos(self.pos,Tile) if isinstance(c,Crate)] ) > 0:
                         # ... but i can't drop it here because there's one there already
                         # * choose somewhere else to put it
-                        self.state.destination_pos = self.map.find_random_clear()
+                        self.state.destination_pos = self.map.find_random_clear(self.context.rng('ai'))
 
                     else:
                         # i put crate down
@@ -283,7 +367,7 @@ class CrateLifter (Monster,Tanglable,Talker,Shouter,AI):
             if self.state.full():
                 # if i was confused and am now right, work out what to do next
                 if self.am_carrying_my_crate:
-                    self.state = MS_InvestigateSpot(self,self.map.find_random_clear())
+                    self.state = MS_InvestigateSpot(self,self.map.find_random_clear(self.context.rng('ai')))
 
                 else:
                     if self.my_crate is None:
@@ -319,10 +403,29 @@ class CrateLifter (Monster,Tanglable,Talker,Shouter,AI):
 
     def __choose_new_crate(self):
         all_crates = self.map.find_all(Crate,Tile)
-        self.my_crate = all_crates[libtcod.random_get_int(None,0,len(all_crates)-1)]
+        self.my_crate = all_crates[libtcod.random_get_int(self.context.rng('ai'),0,len(all_crates)-1)]
 
 
 class DalekAI(AI):
+    """whether daleks can see the player is worked out for all of those on the map at once (see Map.can_see_all),
+    when the first of them needs to know in a round of turns, then each decides what to do on its own turn"""
+    ANGLE_OF_VIS = 0.5
+
+    def __sight_key(self):
+        m = self.map
+        return (self.context.ticks, m.sight_version, m.player.pos, self.pos, self.last_pos)
+
+    def can_see_player(self):
+        """map.can_see(self, player, ANGLE_OF_VIS), as of this round"""
+        sight = getattr(self, '_DalekAI__sight', None)
+        if sight is None or sight[0] != self.__sight_key():
+            stale = [d for d in self.map.find_all(DalekAI, Monster)
+                     if getattr(d, '_DalekAI__sight', None) is None or d.__sight[0] != d.__sight_key()]
+            if not self in stale:
+                stale.append(self) # e.g. not on the map's monster layer
+            for (d, seen) in zip(stale, self.map.can_see_all(stale, self.ANGLE_OF_VIS)):
+                d.__sight = (d.__sight_key(), seen)
+        return self.__sight[1]
 
     def get_next_state(self):
         # if already on the player square(!), stop
@@ -334,7 +437,7 @@ class DalekAI(AI):
             return self.state
 
         # otherwise chase player if visible
-        elif self.map.can_see(self,self.map.player,0.5):
+        elif self.can_see_player():
             if not isinstance(self.state,MS_SeekingPlayer):
                 self.shout(self.map.player,priority=Alertable.PRI_HIGH)
                 return MS_SeekingPlayer(self)
@@ -397,24 +500,26 @@ class Dalek (Monster,Tanglable,Talker,Alertable,Shouter,DalekAI):
         try:
             new_pos = self.state.get_move()
 
-            m = self.map.find_all_at_pos(new_pos,Monster)
+            (mobile, immobile) = self.map.occupancy(new_pos)
 
             ## this logic stops the monster from entering the same square as a non-tanglable
             ## it also makes sure that the player can't stand on static cameras and be
             ## untouchable
-            if len(m) == 0 or len([mi for mi in m if not mi.remains_in_place]) == 0:
-                self.move_to(new_pos)
-            
-            elif len([mi for mi in m if isinstance(mi,Tanglable)]) > 0:
-                # tangle if poss
+            if mobile == 0:
                 self.move_to(new_pos)
-                self.tangle([mi for mi in m if isinstance(mi,Tanglable)][0])
-                self.state = MS_RecentlyTangled(self)
             
             else:
-                # don't move if can't tangle with dest monster
-                #print("%s can't tangle with %s" % (self,m[0]))
-                pass
+                m = [mi for mi in self.map.find_all_at_pos(new_pos,Monster) if isinstance(mi,Tanglable)]
+                if len(m) > 0:
+                    # tangle if poss
+                    self.move_to(new_pos)
+                    self.tangle(m[0])
+                    self.state = MS_RecentlyTangled(self)
+
+                else:
+                    # don't move if can't tangle with dest monster
+                    #print("%s can't tangle with %s" % (self,m[0]))
+                    pass
 
             #self.move_to(new_pos)
             #ms = [mi for mi in m if isinstance(mi,Tanglable)]
@@ -460,6 +565,22 @@ class LitDalek(Dalek,LightSource):
 class BetterDalek (Monster,Talker,Alertable,Shouter,DalekAI):
     generator_weight = 0.1
 
+    #  directions of the squares around, clockwise:
+    #      -1,-1   0,-1   1,-1          0    1    2
+    #      -1,0    0,0    1,0           7         3
+    #      -1,1    0,1    1,1           6    5    4
+    #
+    V_MAP = (
+        Position(-1,-1),
+        Position(0,-1),
+        Position(1,-1),
+        Position(1,0),
+        Position(1,1),
+        Position(0,1),
+        Position(-1,1),
+        Position(-1,0)
+        )
+
     def __init__(self,pos=None):
         Monster.__init__(self,pos,'b',libtcod.red)
         Talker.__init__(self)
@@ -487,36 +608,22 @@ class BetterDalek (Monster,Talker,Alertable,Shouter,DalekAI):
         # try to move
         try:
             new_pos = self.state.get_move()
-            ms = [m for m in self.map.find_all_at_pos(new_pos,Monster) if not m.remains_in_place]
-            if new_pos != self.pos and len(ms)>0:
+            if new_pos != self.pos and self.map.occupancy(new_pos)[0] > 0:
                 # TODO: complain about path being blocked
                 # attempt a different move
                 #  * get a vector representing the direction we tried
                 v  = new_pos - self.pos
-                #  * convert to an int
-                #      -1,-1   0,-1   1,-1          0    1    2
-                #      -1,0    0,0    1,0           7         3
-                #      -1,1    0,1    1,1           6    5    4
-                #
-                V_MAP = [
-                    Position(-1,-1),
-                    Position(0,-1),
-                    Position(1,-1),
-                    Position(1,0),
-                    Position(1,1),
-                    Position(0,1),
-                    Position(-1,1),
-                    Position(-1,0)
-                    ]
-                if not v in V_MAP:
+                #  * convert to an int (see V_MAP)
+                if not v in self.V_MAP:
                     raise InvalidMoveError # not sure how this happens?
-                vi  = V_MAP.index(v)
+                vi  = self.V_MAP.index(v)
                 #  * get the adjacent vectors
-                #  * try both of those
-                if    len(self.map.find_all_at_pos(self.pos + V_MAP[vi-1],Monster)) == 0:
-                    new_pos = self.pos + V_MAP[vi-1]
-                elif  len(self.map.find_all_at_pos(self.pos + V_MAP[(vi+1)%8],Monster)) == 0:
-                    new_pos = self.pos + V_MAP[(vi+1)%8]
+                #  * try both of those, if free
+                free = self.map.free_neighbours(self.pos)
+                if    self.pos + self.V_MAP[vi-1] in free:
+                    new_pos = self.pos + self.V_MAP[vi-1]
+                elif  self.pos + self.V_MAP[(vi+1)%8] in free:
+                    new_pos = self.pos + self.V_MAP[(vi+1)%8]
                 #  * ... otherwise give up
                 else:
                     raise InvalidMoveError
@@ -40,8 +40,8 @@ class Player (Activator,TurnTaker,StatusEffect,HasInventory,LightSource,Mappable
         
         # init items (must be done this way to invoke any pickup triggers)
         #  - inv items
-        self.pickup(Item.random(None,self,2,1.5))
-        self.pickup(Item.random(None,self,1))
+        self.pickup(Item.random(self.context.rng('items'),self,2,1.5))
+        self.pickup(Item.random(self.context.rng('items'),self,1))
         #  - slot items
         self.pickup(NightVisionGoggles(self))
         self.pickup(NinjaSuit(self))
@@ -284,11 +284,13 @@ class Player (Activator,TurnTaker,StatusEffect,HasInventory,LightSource,Mappable
 
     def take_turn(self):
         # runs just before handle_keys, so expensive ops run whilst player chooses what to do
-        Talker.stop_all_talk()
+        Talker.stop_all_talk(self.context)
         self.reset_fov()
         #self.map.recalculate_lighting()
 
         self.turns += 1
+        if not self.context.recorder is None:
+            self.context.recorder.checkpoint(self)
         t_remaining = 1.0 # TODO: weight this based on passive buffs
         have_used_item = False
 
@@ -328,7 +330,7 @@ class Player (Activator,TurnTaker,StatusEffect,HasInventory,LightSource,Mappable
 
             ev = libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS, k, m)
             if ev and k and k.pressed and chr(k.c) in self.KEYMAP:
-                return self.KEYMAP.get(chr(k.c))
+                return self.keypress(chr(k.c))
 
         # redraw screen after first second after keypress
         self.redraw_screen(Player.MAX_TIMEOUT)
@@ -338,19 +340,25 @@ class Player (Activator,TurnTaker,StatusEffect,HasInventory,LightSource,Mappable
 
         while True:
             if k and k.pressed and chr(k.c) in self.KEYMAP:
-                return self.KEYMAP.get(chr(k.c))
+                return self.keypress(chr(k.c))
             k = libtcod.console_wait_for_keypress(True)
 
+    def keypress(self,c):
+        """returns pointer to function to call for key c, recording c if the game is being recorded"""
+        if not self.context.recorder is None:
+            self.context.recorder.record_key(c)
+        return self.KEYMAP.get(c)
+
     def redraw_screen(self,t=0):
         # draw and flush screen
-        if not UI.need_update(t):
+        if not UI.need_update(t, self.context):
             # clearly one of the libtcod functions here causes the wait for the next frame
             sleep(1.0/Player.LIMIT_FPS)
             return
 
         self.map.draw()
         self.draw_ui(Position(0,Player.SCREEN_SIZE.y-3))
-        UI.draw_all(t)
+        UI.draw_all(t, self.context)
 
         libtcod.console_flush()
 
@@ -371,3 +379,40 @@ class Player (Activator,TurnTaker,StatusEffect,HasInventory,LightSource,Mappable
             # TODO: this isn't great :(
             if hasattr(i,'bar') and isinstance(i.bar,UI):
                 i.bar.refresh_ui_list()
+
+
+class HeadlessPlayer (Player):
+    """Player driven by a policy rather than the keyboard, for automated play.
+    policy is called with the player each time a key is needed and returns a KEYMAP key"""
+    MAX_ATTEMPTS = 10
+
+    def __init__(self,policy,pos=None):
+        Player.__init__(self,pos)
+        self.policy = policy
+        self.__attempt_turn = 0
+        self.__attempts = 0
+
+    def handle_keys(self):
+        # don't let a policy that keeps picking invalid moves hang the turn
+        if self.__attempt_turn != self.turns:
+            self.__attempt_turn = self.turns
+            self.__attempts = 0
+        self.__attempts += 1
+        if self.__attempts > HeadlessPlayer.MAX_ATTEMPTS:
+            return self.keypress('.')
+        return self.keypress(self.policy(self))
+
+    def redraw_screen(self,t=0):
+        pass
+
+    def pickup(self,i):
+        """as Player.pickup, but never prompts: items that would need a swap are left where they are"""
+        if not isinstance(i,Evidence):
+            items = self.items
+            if isinstance(i,SlotItem):
+                items = [self.slot_items[i.valid_slot]]
+            if not None in items:
+                if not self.context.recorder is None:
+                    self.context.recorder.record_key('x') # as if declined at Player.pickup's prompt
+                return 0.0
+        return Player.pickup(self,i)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Generate levels ahead of time in a worker process.
+
+Levels are generated in order of seed, so the next one is known while the current one is being played.
+LevelPregenerator builds it in the background and hands it over, ready to play, when the player gets there."""
+
+# system imports
+import os
+import sys
+import traceback
+import multiprocessing
+
+# our imports
+from interfaces import Position
+from levelcache import LevelCache, generate_level
+import snapshot
+
+
+class LevelPregenerator:
+    """Generates levels of size in a worker process, using the LevelCache in cache_path if given"""
+
+    def __init__(self, size, cache_path=None):
+        self.size       = Position(size)
+        self.cache_path = cache_path
+        self.__pool     = multiprocessing.Pool(1, _init_worker, (cache_path,))
+        self.__pending  = {} # seed: AsyncResult
+
+    def request(self, seed):
+        """start generating the level for seed"""
+        if not seed in self.__pending:
+            self.__pending[seed] = self.__pool.apply_async(_generate, (seed, (self.size.x, self.size.y)))
+
+    def take(self, game):
+        """game's level (for game.seed), attached to game and its player as by snapshot.load_level, waiting for it
+        if it isn't finished yet. Returns None if it wasn't requested or failed to generate; the caller should
+        generate the level itself. Forgets any levels requested for earlier seeds"""
+        for s in [s for s in self.__pending.keys() if s < game.seed]:
+            del self.__pending[s]
+        r = self.__pending.pop(game.seed, None)
+        if r is None:
+            return None
+        try:
+            data = r.get()
+        except Exception:
+            sys.stderr.write("Pregenerating level %d failed:\n%s" % (game.seed, traceback.format_exc()))
+            return None
+        return snapshot.load_level(data, game)
+
+    def generate(self, game, size):
+        """as LevelCache.generate, for levelcache.next_level: the level taken (see take) if size is the size being
+        generated, else None"""
+        return Position(size) == self.size and self.take(game) or None
+
+    def close(self):
+        """stop the worker process"""
+        if not self.__pool is None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+
+    def __del__(self):
+        self.close()
+
+
+_cache = None # worker's LevelCache, if any
+
+def _init_worker(cache_path):
+    """the game prints as it goes; keep the worker quiet. The cache is opened once, for every level"""
+    global _cache
+    sys.stdout = open(os.devnull, 'w')
+    _cache = not cache_path is None and LevelCache(cache_path) or None
+
+def _generate(seed, size):
+    """worker: level data for seed"""
+    if _cache is None:
+        return generate_level(seed, size)
+    return _cache.level_data(seed, size)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Record games and replay them headlessly.
+
+A Recording holds a game's seed and map size, every key the player pressed (menu choices included) and
+state checksums taken every few turns. Randomness during play comes from the game's seeded streams
+(GameContext.rng), so replaying the keys from the same seed plays out the same game; the checksums
+show where a replay stops matching.
+
+Usage: replay.py [--no-verify] [--cache DIR] RECORDING..."""
+
+# system imports
+import sys
+import json
+import zlib
+import argparse
+from time import perf_counter
+
+# our imports
+from interfaces import Position, TurnTaker
+from player import Player
+from context import GameContext
+from levelcache import LevelCache, next_level
+from errors import GameOverError, LevelWinError, ReplayError, ReplayEndError
+
+
+def checksum(player):
+    """CRC32 of the game state: the map's observable state plus the player's progress"""
+    crc = zlib.crc32(("%s %d %d %d" % (player.pos, player.turns, len(player.evidence), player.levels_seen)).encode())
+    return player.map.checksum(crc)
+
+
+class Recording:
+    """The input for one game, from its first level to game over (or wherever recording stopped)"""
+    VERSION          = 1
+    CHECKPOINT_EVERY = 10 # turns
+
+    GAME_OVER = 'game over'
+    STOPPED   = 'stopped' # recording ended mid-game
+
+    def __init__(self, seed, size, checkpoint_every=CHECKPOINT_EVERY):
+        self.seed             = seed # of the first level
+        self.size             = Position(size)
+        self.checkpoint_every = checkpoint_every
+        self.keys             = []   # KEYMAP keys and menu choices, in the order the game asked for them
+        self.checkpoints      = []   # (turn, checksum) pairs
+        self.outcome          = None
+        self.final            = None # (turn, checksum) at the end
+
+    def __str__(self):
+        return "Recording of seed %d: %d keys, %s" % (self.seed, len(self.keys), self.outcome)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                    'version':          Recording.VERSION,
+                    'seed':             self.seed,
+                    'size':             [self.size.x, self.size.y],
+                    'checkpoint_every': self.checkpoint_every,
+                    'keys':             self.keys,
+                    'checkpoints':      self.checkpoints,
+                    'outcome':          self.outcome,
+                    'final':            self.final,
+                    }, f)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            d = json.load(f)
+        if d.get('version') != Recording.VERSION:
+            raise ReplayError("%s: unsupported recording version %s" % (path, d.get('version')))
+        r = Recording(d['seed'], d['size'], d['checkpoint_every'])
+        r.keys        = d['keys']
+        r.checkpoints = [tuple(c) for c in d['checkpoints']]
+        r.outcome     = d['outcome']
+        r.final       = d['final'] and tuple(d['final'])
+        return r
+
+
+class Recorder:
+    """Records a game into a Recording; set as the game's GameContext.recorder"""
+    is_replaying = False
+
+    def __init__(self, recording):
+        self.recording = recording
+
+    def record_key(self, c):
+        self.recording.keys.append(c)
+
+    def checkpoint(self, player):
+        """called at the start of each player turn"""
+        if player.turns % self.recording.checkpoint_every == 0:
+            self.recording.checkpoints.append((player.turns, checksum(player)))
+
+    def finish(self, player, outcome):
+        self.recording.outcome = outcome
+        if outcome != Recording.STOPPED:
+            # a game can stop between turns or part way through one; only a finished game has a definite end state
+            self.recording.final = (player.turns, checksum(player))
+
+
+class Replayer:
+    """Feeds a Recording's keys back to a game, checking its checksums as it goes if verify is set;
+    set as the game's GameContext.recorder"""
+    is_replaying = True
+
+    def __init__(self, recording, verify=True):
+        self.recording     = recording
+        self.verify        = verify
+        self.checked       = 0    # checkpoints passed
+        self.game          = None # set by replay()
+        self.__next_key    = 0
+        self.__checkpoints = dict(recording.checkpoints)
+
+    def next_key(self):
+        if self.__next_key >= len(self.recording.keys):
+            raise ReplayEndError("recording ends after %d keys" % len(self.recording.keys))
+        c = self.recording.keys[self.__next_key]
+        self.__next_key += 1
+        return c
+
+    def record_key(self, c):
+        pass
+
+    def checkpoint(self, player):
+        expected = self.__checkpoints.get(player.turns)
+        if self.verify and not expected is None:
+            self.__check(player, expected)
+
+    def finish(self, player, outcome):
+        if not self.verify:
+            return
+        if outcome != self.recording.outcome:
+            raise ReplayError("replay ended with %s at turn %d; recording ended with %s"
+                              % (outcome, player.turns, self.recording.outcome))
+        if not self.recording.final is None:
+            if player.turns != self.recording.final[0]:
+                raise ReplayError("replay ended at turn %d; recording ended at turn %d"
+                                  % (player.turns, self.recording.final[0]))
+            self.__check(player, self.recording.final[1])
+
+    def __check(self, player, expected):
+        got = checksum(player)
+        if got != expected:
+            raise ReplayError("turn %d: state checksum %08x, recorded %08x" % (player.turns, got, expected))
+        self.checked += 1
+
+
+class ReplayPlayer(Player):
+    """Player whose keys come from the game's Replayer. Never draws"""
+
+    def __init__(self, pos=None):
+        Player.__init__(self, pos)
+        self.KEYMAP['Q'] = self.stop # quitting ends the recording; don't quit the replay
+
+    def handle_keys(self):
+        return self.keypress(self.context.recorder.next_key())
+
+    def stop(self):
+        raise ReplayEndError("recording stopped here")
+
+    def redraw_screen(self, t=0):
+        pass
+
+
+def replay(recording, verify=True, cache=None):
+    """play recording back headlessly, as fast as possible. Returns the Replayer, which has the
+    finished game. Raises ReplayError if verify is set and the game doesn't match the recording.
+    Levels come from cache (a LevelCache) if given"""
+    game = GameContext(recording.seed - 1) # next_level moves on to seed
+    replayer = game.recorder = Replayer(recording, verify)
+    replayer.game = game
+    with game:
+        next_level(game, recording.size, ReplayPlayer, cache)
+        try:
+            while True:
+                try:
+                    TurnTaker.take_all_turns(game)
+                except LevelWinError:
+                    next_level(game, recording.size, None, cache)
+        except GameOverError:
+            outcome = Recording.GAME_OVER
+        except ReplayEndError:
+            outcome = Recording.STOPPED
+        replayer.finish(game.player, outcome)
+    return replayer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded DalekRL games")
+    parser.add_argument('recordings', nargs='+')
+    parser.add_argument('--no-verify', action='store_true', help="don't check state checksums")
+    parser.add_argument('--cache', default=None, metavar='DIR', help="cache generated levels in DIR")
+    args = parser.parse_args(argv)
+    cache = not args.cache is None and LevelCache(args.cache) or None
+
+    failed = 0
+    for path in args.recordings:
+        recording = Recording.load(path)
+        t = perf_counter()
+        try:
+            r = replay(recording, not args.no_verify, cache)
+        except ReplayError as e:
+            sys.stderr.write("%s: %s\n" % (path, e))
+            failed += 1
+            continue
+        t = perf_counter() - t
+        p = r.game.player
+        sys.stderr.write("%s: %s after %d turns, %d levels; %d checkpoints ok; %.2fs (%.0f turns/s)\n"
+                         % (path, recording.outcome, p.turns, p.levels_seen, r.checked, t, p.turns / max(t, 1e-6)))
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
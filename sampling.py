@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Weighted random choice.
+
+A WeightedSampler picks indices in proportion to their weights by bisecting the running totals of the weights,
+which are worked out once, when it is made. Monster.random, Item.random and evidence placement use them.
+
+Those used to walk their weights, subtracting each from the draw until it ran out. Bisecting picks the same index
+for the same draw, so a seed gives the same levels as before, unless rounding puts a draw within a rounding error of
+a boundary between two choices. Setting LEGACY makes samplers walk the weights as the old code did, for sequences
+that match it bit for bit."""
+
+import libtcodpy as libtcod
+
+from bisect import bisect_left
+from itertools import accumulate
+
+LEGACY = False # walk weights as the generators used to (see above)
+
+
+class WeightedSampler:
+    """picks from indices 0 to len(weights)-1, each in proportion to its weight. If given, totals are the running
+    totals of the weights, as worked out by the caller; they are used as they are"""
+
+    def __init__(self, weights, totals=None):
+        self.weights = list(weights)
+        if totals is None:
+            self.totals = list(accumulate(self.weights))
+        else:
+            self.totals = list(totals)
+        assert len(self.totals) == len(self.weights), "%d totals for %d weights" % (len(self.totals), len(self.weights))
+        self.total = len(self.totals) > 0 and self.totals[-1] or 0.0
+
+    def __len__(self):
+        return len(self.totals)
+
+    def index(self, r):
+        """the first index whose running total reaches r, for a draw r from 0.0 to total"""
+        assert len(self.totals) > 0, "nothing to choose from"
+        return min(bisect_left(self.totals, r), len(self.totals) - 1)
+
+    def locate(self, r):
+        """(index, remainder) for a draw r from 0.0 to total: the first index whose running total reaches r, and how
+        much of r is left after the weights before it"""
+        assert len(self.totals) > 0, "nothing to choose from"
+        if LEGACY:
+            i = 0
+            while i < len(self.weights) - 1 and r > self.weights[i]:
+                r -= self.weights[i]
+                i += 1
+            return (i, r)
+        i = self.index(r)
+        if i > 0:
+            r -= self.totals[i - 1]
+        return (i, r)
+
+    def choose(self, rng=None, scale=1.0):
+        """random index, using given RNG, or TCOD default if none supplied. The draw is made as Monster.random always
+        has: a float from 0.0 to total * scale, drawn again until it's no more than total"""
+        r = self.total + 1.0
+        while r > self.total:
+            r = libtcod.random_get_float(rng, 0.0, self.total * scale)
+        return self.locate(r)[0]
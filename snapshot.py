@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Save and restore whole games.
+
+A snapshot is a game's GameContext (map, player, monsters, items, turn order and RNG states) as a short header
+followed by a zlib-compressed pickle. libtcod handles aren't saved: lights and the map rebuild theirs the first
+time they're used after loading, so loading is quick and a snapshot that is only inspected never builds them.
+
+fork() copies a running game in memory for lookahead, sharing what doesn't change with the original.
+save_level() and load_level() move a level from the process that generated it to the game that will play it.
+
+Usage: snapshot.py SNAPSHOT... (prints a summary of each)"""
+
+# system imports
+import io
+import sys
+import zlib
+import pickle
+import struct
+import weakref
+
+# our imports
+from interfaces import TurnTaker
+from errors import SnapshotError
+
+
+MAGIC   = b'DRLS'
+VERSION = 11 # 2: tiles keep seen and visible flags per cell, in Map.cell_flags; 3: maps keep their clear cells;
+             # 4: positions pickle as (x, y); 5: maps keep a geometry version;
+             # 6: alertables keep alert queues, and games an AlertRegistry; 7: maps count users of flow fields;
+             # 8: maps count monsters per cell; 9: games count rounds of turns, and daleks keep what they saw;
+             # 10: maps keep the radius of the player's fov; 11: maps keep their clear cells by component
+HEADER  = struct.Struct('<4sH')
+
+
+def save(game, level=6):
+    """snapshot of game (a GameContext) as bytes. level is the zlib compression level; 0 doesn't compress"""
+    data = pickle.dumps(game, pickle.HIGHEST_PROTOCOL)
+    if level > 0:
+        data = zlib.compress(data, level)
+    return HEADER.pack(MAGIC, VERSION) + data
+
+def load(data):
+    """GameContext from a snapshot made by save()"""
+    if len(data) < HEADER.size:
+        raise SnapshotError("snapshot too short")
+    (magic, version) = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError("not a snapshot")
+    if version != VERSION:
+        raise SnapshotError("unsupported snapshot version %d" % version)
+    data = data[HEADER.size:]
+    if data[:1] != pickle.PROTO:
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+def copy(game):
+    """independent copy of game, sharing nothing with it"""
+    return load(save(game, 0))
+
+
+def _shared(i):
+    """stands in for shared object i (see _SharingPickler); _SharingUnpickler swaps in the real thing"""
+    raise SnapshotError("shared object %d loaded without its shared objects" % i)
+
+class _SharingPickler(pickle.Pickler):
+    """pickles references to the objects in shared, rather than the objects themselves"""
+    def __init__(self, f, shared):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.shared_ids = dict((id(o), i) for (i, o) in enumerate(shared))
+
+    def reducer_override(self, obj):
+        # only called for class instances, unlike persistent_id, which would be called for every int and string
+        i = self.shared_ids.get(id(obj))
+        if i is None:
+            return NotImplemented
+        return (_shared, (i,))
+
+class _SharingUnpickler(pickle.Unpickler):
+    """unpickles what _SharingPickler pickled, with references resolved to the objects in shared"""
+    def __init__(self, f, shared):
+        pickle.Unpickler.__init__(self, f)
+        self.shared = shared
+
+    def find_class(self, module, name):
+        if module == __name__ and name == '_shared':
+            return self.shared.__getitem__
+        return pickle.Unpickler.find_class(self, module, name)
+
+def fork(game):
+    """copy of game to play ahead from the current turn, e.g. for lookahead search.
+    Inert tiles (walls and plain floor) aren't pickled: the copy's map gets views of them (see FlyweightTile.view)
+    that are its own, so what is seen and lit in one game stays there. The copy's map also takes its libtcod handles
+    from game's map: FOV and pathing maps are copied and static lighting is shared until either map relights"""
+    shared = game.map.inert_tiles()
+    f = io.BytesIO()
+    _SharingPickler(f, shared).dump(game)
+    f.seek(0)
+    views = [t.view() for t in shared]
+    g = _SharingUnpickler(f, views).load()
+    for v in views:
+        v.map = g.map
+    g.map.fork_native(game.map)
+    return g
+
+
+def save_level(game):
+    """game's map as bytes, with everything in game's turn order and UI elements (which should be only the map's
+    contents) but not game itself or its player, for load_level() to attach to another game"""
+    level = (game.map,
+             game.player.pos,
+             [r() for r in game.turn_takers if not r() is None],
+             [r() for r in game.ui_elements if not r() is None],
+             list(game.alertables),
+             list(game.currently_talking))
+    f = io.BytesIO()
+    _SharingPickler(f, [game, game.player]).dump(level)
+    return f.getvalue()
+
+def load_level(data, game):
+    """attach a level from save_level() to game in place of its current map, with game's player on it (at the
+    up stairs). Returns the map"""
+    (m, pos, turn_takers, ui_elements, alertables, talking) = _SharingUnpickler(io.BytesIO(data), [game, game.player]).load()
+    game.map = m
+    game.player.pos = pos
+    game.player.map = m
+    for t in turn_takers:
+        TurnTaker.add_turntaker(t)
+    game.ui_elements += [weakref.ref(u) for u in ui_elements]
+    game.alertables.update(alertables)
+    game.currently_talking.update(talking)
+    game.player.reset_fov()
+    return m
+
+
+def save_file(game, path):
+    with open(path, 'wb') as f:
+        f.write(save(game))
+
+def load_file(path):
+    with open(path, 'rb') as f:
+        return load(f.read())
+
+
+def main(argv=None):
+    for path in (argv is None and sys.argv[1:] or argv):
+        try:
+            game = load_file(path)
+        except SnapshotError as e:
+            sys.stderr.write("%s: %s\n" % (path, e))
+            continue
+        p = game.player
+        print("%s: %s, turn %d, level %d, %d monsters, %d items"
+              % (path, game, p.turns, p.levels_seen, len(game.map.get_monsters()), len(game.map.get_items())))
+
+
+if __name__ == '__main__':
+    main()
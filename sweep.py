@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Run map generation, or whole headless games, over ranges of seeds across all cores.
+
+Usage: sweep.py [-g] [-t TURNS] [-j PROCESSES] [--cache DIR] first_seed [last_seed]
+
+Results are written to stdout as tab-separated rows, in seed order; progress goes to stderr."""
+
+# system imports
+import os
+import sys
+import gc
+import argparse
+import traceback
+import multiprocessing
+from time import perf_counter
+
+# our imports
+from interfaces import Position, TurnTaker
+from maps import Map
+from player import HeadlessPlayer
+from tiles import Tile, StairsUp, StairsDown
+from errors import GameOverError, LevelWinError
+from context import GameContext
+from levelcache import LevelCache
+
+
+MAP_SIZE = Position(80, 46)
+
+
+class SweepResult:
+    """Metrics for one seed"""
+    GENERATED = 'generated'
+    WIN       = 'win'
+    CAUGHT    = 'caught'
+    TIMEOUT   = 'timeout'
+    ERROR     = 'error'
+
+    FIELDS = ('seed', 'outcome', 'gen_time', 'layouts', 'rooms', 'path_length', 'monsters', 'items', 'turns', 'evidence')
+
+    def __init__(self, seed):
+        self.seed        = seed
+        self.outcome     = None
+        self.gen_time    = 0.0
+        self.layouts     = None # layouts generated, including rejected ones
+        self.rooms       = None
+        self.path_length = None # walking distance from StairsUp to StairsDown
+        self.monsters    = 0
+        self.items       = 0
+        self.turns       = 0
+        self.evidence    = 0
+        self.error       = None # traceback text if outcome is ERROR
+
+    def __str__(self):
+        return "Seed %d: %s" % (self.seed, self.outcome)
+
+    def as_row(self):
+        """values of FIELDS, as strings"""
+        r = []
+        for f in SweepResult.FIELDS:
+            v = getattr(self, f)
+            if v is None:
+                r.append('-')
+            elif isinstance(v, float):
+                r.append('%.4f' % v)
+            else:
+                r.append(str(v))
+        return r
+
+
+def stair_runner(player):
+    """headless policy: head straight for the down stairs and climb them"""
+    m = player.map
+    stairs = m.find_all(StairsDown, Tile)
+    if len(stairs) == 0:
+        return '.'
+    if player.pos == stairs[0].pos:
+        return ' '
+    path = m.get_path(player.pos, stairs[0].pos, 1)
+    if len(path) == 0:
+        return '.'
+    d = path[0] - player.pos
+    return STEP_KEYS.get((d.x, d.y), '.')
+
+STEP_KEYS = {
+    ( 0, -1): 'k',
+    ( 0,  1): 'j',
+    (-1,  0): 'h',
+    ( 1,  0): 'l',
+    (-1, -1): 'y',
+    ( 1, -1): 'u',
+    (-1,  1): 'b',
+    ( 1,  1): 'n',
+    }
+
+
+def run_seed(seed, play=False, size=MAP_SIZE, max_turns=1000, policy=stair_runner, cache=None):
+    """generate the map for seed and, if play is set, play it headlessly until the player
+    escapes, is caught or max_turns pass. Maps come from cache (a LevelCache), if given.
+    Never raises: failures are reported in the result"""
+    r = SweepResult(seed)
+    game = GameContext(seed)
+    p = m = None
+    try:
+        with game:
+            p = game.player = HeadlessPlayer(policy)
+            t = perf_counter()
+            if cache is None:
+                m = game.map = Map.random(seed, Position(size), p, game)
+                m.generate()
+            else:
+                m = cache.generate(game, size)
+            r.gen_time = perf_counter() - t
+
+            r.layouts  = getattr(m, 'layouts', None)
+            r.rooms    = getattr(m, 'room_count', None)
+            r.monsters = len(m.get_monsters())
+            r.items    = len(m.get_items())
+            up   = m.find_all(StairsUp, Tile)
+            down = m.find_all(StairsDown, Tile)
+            if len(up) > 0 and len(down) > 0:
+                r.path_length = m.get_distance(up[0].pos, down[0].pos)
+
+            if not play:
+                r.outcome = SweepResult.GENERATED
+            else:
+                r.outcome = SweepResult.TIMEOUT
+                try:
+                    while p.turns < max_turns:
+                        TurnTaker.take_all_turns(game)
+                except GameOverError:
+                    r.outcome = SweepResult.CAUGHT
+                except LevelWinError:
+                    r.outcome = SweepResult.WIN
+                r.turns    = p.turns
+                r.evidence = len(p.evidence)
+
+    except Exception:
+        r.outcome = SweepResult.ERROR
+        r.error   = traceback.format_exc()
+
+    # drop this seed's game before the worker moves on
+    game = p = m = None
+    gc.collect()
+
+    return r
+
+
+_cache = None # worker's LevelCache, if any
+
+def _init_worker(cache_path):
+    """the game prints as it goes; keep workers quiet. Each worker opens the cache once, for all its seeds"""
+    global _cache
+    sys.stdout = open(os.devnull, 'w')
+    _cache = not cache_path is None and LevelCache(cache_path) or None
+
+def _run_job(indexed_job):
+    (i, job) = indexed_job
+    return (i, run_seed(*job, cache=_cache))
+
+
+def sweep(seeds, play=False, size=MAP_SIZE, max_turns=1000, processes=None, progress=None, maxtasksperchild=None,
+          cache_path=None):
+    """Generator yielding a SweepResult for each seed, in the order seeds are given.
+    Seeds are run across processes workers (default: all cores). progress, if given, is called as
+    progress(done, total, result) as each seed finishes, in completion order. Set maxtasksperchild
+    to recycle workers periodically, and cache_path to use a LevelCache"""
+    seeds = list(seeds)
+    jobs  = [(s, play, (size.x, size.y), max_turns, stair_runner) for s in seeds]
+
+    pool = multiprocessing.Pool(processes, _init_worker, (cache_path,), maxtasksperchild=maxtasksperchild)
+    try:
+        # results arrive in completion order; hold them back until the ones before them are in
+        waiting = {}
+        next_i  = 0
+        done    = 0
+        for (i, r) in pool.imap_unordered(_run_job, enumerate(jobs)):
+            done += 1
+            if not progress is None:
+                progress(done, len(jobs), r)
+            waiting[i] = r
+            while next_i in waiting:
+                yield waiting.pop(next_i)
+                next_i += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep DalekRL seeds across all cores")
+    parser.add_argument('first_seed', type=int)
+    parser.add_argument('last_seed', type=int, nargs='?', help="inclusive; defaults to first_seed")
+    parser.add_argument('-g', '--games', action='store_true', help="play headless games, not just generate maps")
+    parser.add_argument('-t', '--turns', type=int, default=1000, help="turn limit for headless games")
+    parser.add_argument('-j', '--processes', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--recycle', type=int, default=None, help="replace each worker after this many seeds")
+    parser.add_argument('--cache', default=None, metavar='DIR', help="cache generated levels in DIR")
+    args = parser.parse_args(argv)
+
+    last = args.last_seed
+    if last is None:
+        last = args.first_seed
+
+    def show_progress(done, total, r):
+        sys.stderr.write("\r%d/%d seeds (%s)   " % (done, total, r))
+        if r.outcome == SweepResult.ERROR:
+            sys.stderr.write("\n%s" % r.error)
+        sys.stderr.flush()
+
+    print("\t".join(SweepResult.FIELDS))
+    for r in sweep(range(args.first_seed, last + 1), args.games, MAP_SIZE, args.turns,
+                   args.processes, show_progress, args.recycle, args.cache):
+        print("\t".join(r.as_row()))
+        sys.stdout.flush()
+    sys.stderr.write("\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+
+# item under test
+import bench
+
+class BenchTest(DalekTest):
+    def test_should_time_both_position_classes(self):
+        (times, memory) = bench.position(number=10, repeat=1, size=(4,3))
+        assert_equal(sorted(times.keys()), ['LegacyPosition', 'Position'])
+        for t in times.values():
+            assert_equal(sorted(t.keys()), sorted(op for (op, stmt) in bench.POSITION_OPS))
+        assert_greater(memory['LegacyPosition'], memory['Position'])
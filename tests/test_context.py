@@ -0,0 +1,94 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import Mock
+
+# lang imports
+import threading
+
+# item under test
+import libtcodpy as libtcod
+import context
+import interfaces
+import ui
+
+class GameContextTest(DalekTest):
+    class C(interfaces.TurnTaker):
+        def take_turn(self):
+            pass
+
+    def test_should_create_default_context_on_demand(self):
+        c = context.GameContext.current()
+        assert_is_instance(c, context.GameContext)
+        assert_is(context.GameContext.current(), c)
+
+    def test_with_should_switch_context_and_restore_previous(self):
+        outer = context.GameContext.current()
+        g = context.GameContext(10)
+        with g as c:
+            assert_is(c, g)
+            assert_is(context.GameContext.current(), g)
+        assert_is(context.GameContext.current(), outer)
+
+    def test_objects_should_join_current_context(self):
+        g1 = context.GameContext()
+        g2 = context.GameContext()
+        with g1:
+            a = self.C(1)
+            u = ui.UI()
+        with g2:
+            b = self.C(1)
+
+        assert_is(a.context, g1)
+        assert_is(u.context, g1)
+        assert_equal([r() for r in g1.turn_takers], [a])
+        assert_equal([r() for r in g2.turn_takers], [b])
+        assert_equal(len(g2.ui_elements), 0)
+
+    def test_games_should_take_turns_independently(self):
+        g1 = context.GameContext()
+        g2 = context.GameContext()
+        with g1:
+            a = self.C(1)
+            a.take_turn = Mock()
+        with g2:
+            b = self.C(1)
+            b.take_turn = Mock()
+
+        interfaces.TurnTaker.take_all_turns(g1)
+        interfaces.TurnTaker.clear_all(g2)
+
+        a.take_turn.assert_called_once_with()
+        assert_equal(b.take_turn.call_count, 0)
+        assert_equal(len(g1.turn_takers), 1)
+
+    def test_threads_should_have_their_own_context(self):
+        here = context.GameContext.current()
+        there = []
+        t = threading.Thread(target=lambda: there.append(context.GameContext.current()))
+        t.start()
+        t.join()
+
+        assert_equal(len(there), 1)
+        assert_is_not(there[0], here)
+
+class GameContextRngTest(DalekTest):
+    def test_should_give_same_stream_for_same_seed(self):
+        (a, b) = (context.GameContext(5), context.GameContext(5))
+        assert_equal([libtcod.random_get_int(a.rng('ai'), 0, 1000) for i in range(10)],
+                     [libtcod.random_get_int(b.rng('ai'), 0, 1000) for i in range(10)])
+
+    def test_should_keep_streams_independent(self):
+        (a, b) = (context.GameContext(5), context.GameContext(5))
+        libtcod.random_get_int(a.rng('draw'), 0, 1000)
+        assert_equal(libtcod.random_get_int(a.rng('ai'), 0, 1000), libtcod.random_get_int(b.rng('ai'), 0, 1000))
+        assert_is_not(a.rng('ai'), a.rng('draw'))
+
+    def test_should_restart_streams(self):
+        g = context.GameContext(5)
+        first = libtcod.random_get_int(g.rng('ai'), 0, 1000000)
+        g.restart_rngs()
+        assert_equal(libtcod.random_get_int(g.rng('ai'), 0, 1000000), first)
+
+    def test_should_use_global_rng_without_seed(self):
+        assert_is(context.GameContext().rng('ai'), None)
@@ -0,0 +1,68 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import patch
+
+# item under test
+import maps
+import env
+import errors
+import interfaces
+import snapshot
+
+class DalekEnvTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.env = env.DalekEnv()
+
+    def test_reset_should_return_observation_with_player(self):
+        o = self.env.reset(2000)
+        player = maps.Map.OBSERVATION_CHANNELS.index('player')
+        p = self.env.game.player.pos
+        assert_equal(len(bytes(o)), self.env.observation_size)
+        assert_equal(sum(bytes(o)[player * 80 * 46:(player + 1) * 80 * 46]), 1)
+        assert_equal(o[player][p.x][p.y], 1)
+
+    def test_step_should_play_one_round(self):
+        self.env.reset(2000)
+        (o, r, d) = self.env.step(0)
+        assert_equal(self.env.game.player.turns, 1)
+        assert_equal(r, 0.0)
+        assert_false(d)
+
+    def test_step_should_penalise_and_finish_on_game_over(self):
+        self.env.reset(2000)
+        with patch.object(interfaces.TurnTaker, 'take_all_turns', side_effect=errors.GameOverError):
+            (o, r, d) = self.env.step(0)
+        assert_equal(r, env.DalekEnv.REWARD_CAUGHT)
+        assert_true(d)
+
+    def test_step_should_reward_and_continue_on_level_win(self):
+        self.env.reset(2000)
+        with patch.object(interfaces.TurnTaker, 'take_all_turns', side_effect=errors.LevelWinError):
+            (o, r, d) = self.env.step(0)
+        assert_equal(r, env.DalekEnv.REWARD_LEVEL)
+        assert_false(d)
+        assert_equal(self.env.game.player.levels_seen, 2)
+
+    def test_game_should_save_and_fork(self):
+        self.env.reset(2000)
+        self.env.step(0)
+        g = snapshot.load(snapshot.save(self.env.game))
+        assert_equal(g.player.pos, self.env.game.player.pos)
+        self.env.game = snapshot.fork(self.env.game)
+        self.env.step(0)
+        assert_equal(self.env.game.player.turns, 2)
+
+
+class VecDalekEnvTest(DalekTest):
+    def test_should_step_games_in_lockstep(self):
+        v = env.VecDalekEnv(2, seed=2000)
+        try:
+            o = v.reset()
+            (o, r, d) = v.step([0, 0])
+            assert_equal(len(r), 2)
+            assert_equal(len(d), 2)
+            assert_equal(len(bytes(o)), 2 * len(maps.Map.OBSERVATION_CHANNELS) * 80 * 46)
+        finally:
+            v.close()
@@ -7,6 +7,7 @@ from mock import Mock, MagicMock, patch, ANY
 from functools import reduce
 from math import hypot
 import gc
+import pickle
 
 # item under test
 import libtcodpy as libtcod
@@ -17,6 +18,7 @@ import player
 import tiles
 import errors
 import ui
+import context
 
 class InterfaceTest(DalekTest):
     pass
@@ -98,10 +100,31 @@ class PositionTest(InterfaceTest):
             p2 = interfaces.Position(p1)
 
             assert_equal(p1,p2)
-            assert_is_not(p1,p2)
+            # immutable, so no need to copy
+            assert_is(p1,p2)
             assert_equal(p1.x,p2.x)
             assert_equal(p1.y,p2.y)
 
+    def test_should_be_immutable(self):
+        p = interfaces.Position(4,3)
+        assert_raises(AttributeError, setattr, p, 'x', 5)
+        assert_raises(AttributeError, setattr, p, 'z', 5)
+        assert_equal(p, (4,3))
+
+    def test_should_intern_map_coordinates(self):
+        p = interfaces.Position(4,3)
+        assert_is(interfaces.Position((4,3)), p)
+        assert_is(interfaces.Position(1,1) + (3,2), p)
+        assert_is(pickle.loads(pickle.dumps(p)), p)
+        assert_is_not(interfaces.Position(-4,3), interfaces.Position(-4,3))
+        assert_equal(interfaces.Position(-4,3), interfaces.Position(-4,3))
+        assert_equal(hash(interfaces.Position(-4,3)), hash((-4,3)))
+
+    def test_should_pack_into_cell_id(self):
+        p = interfaces.Position(4,3)
+        assert_equal(p.cell(46), 4*46+3)
+        assert_is(interfaces.Position.from_cell(p.cell(46), 46), p)
+
     def test_should_be_greater_than_position(self):
         # assert p > q
         for (px, py, qx, qy, result) in (
@@ -1023,9 +1046,9 @@ class TurnTakerTest(InterfaceTest):
         assert_is(interfaces.TurnTaker.take_all_turns(), None)
 
         # checks static list is in right order
-        assert_is(interfaces.TurnTaker.turn_takers[0](), cm10)
-        assert_is(interfaces.TurnTaker.turn_takers[1](), c1)
-        assert_is(interfaces.TurnTaker.turn_takers[2](), c5)
+        assert_is(context.GameContext.current().turn_takers[0](), cm10)
+        assert_is(context.GameContext.current().turn_takers[1](), c1)
+        assert_is(context.GameContext.current().turn_takers[2](), c5)
 
         # check turn taken in right order
         assert_equal(len(o),3)
@@ -1063,7 +1086,7 @@ class TurnTakerTest(InterfaceTest):
 
         assert_is(interfaces.TurnTaker.take_all_turns(), None)
 
-        assert_equal(len(interfaces.TurnTaker.turn_takers),10)
+        assert_equal(len(context.GameContext.current().turn_takers),10)
         for c in do_not_delete:
             c.take_turn.assert_called_once_with()
 
@@ -1075,14 +1098,14 @@ class TurnTakerTest(InterfaceTest):
             do_not_delete.append( c )
         
         assert_is(interfaces.TurnTaker.take_all_turns(), None)
-        assert_equal(len(interfaces.TurnTaker.turn_takers),10)
+        assert_equal(len(context.GameContext.current().turn_takers),10)
         for c in do_not_delete:
             c.take_turn.assert_called_once_with()
             c.take_turn.reset_mock()
 
         assert_is(interfaces.TurnTaker.clear_all(), None)
 
-        assert_equal(len(interfaces.TurnTaker.turn_takers),0)
+        assert_equal(len(context.GameContext.current().turn_takers),0)
         for c in do_not_delete:
             assert_equal(c.take_turn.call_count,0)
 
@@ -1103,8 +1126,8 @@ class TurnTakerTest(InterfaceTest):
         gc.collect()
 
         assert_is(interfaces.TurnTaker.take_all_turns(), None)
-        assert_equal(len(interfaces.TurnTaker.turn_takers),1)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),a)
+        assert_equal(len(context.GameContext.current().turn_takers),1)
+        assert_is(context.GameContext.current().turn_takers[0](),a)
         a.take_turn.assert_called_once_with()
 
     def test_refresh_should_replace_turntaker_in_static_list(self):
@@ -1117,56 +1140,56 @@ class TurnTakerTest(InterfaceTest):
         a.take_turn.reset_mock()
 
         assert_is(interfaces.TurnTaker.clear_all(), None)
-        assert_equal(interfaces.TurnTaker.turn_takers,[])
+        assert_equal(context.GameContext.current().turn_takers,[])
         assert_is(interfaces.TurnTaker.take_all_turns(), None)
         assert_equal(a.take_turn.call_count,0)
 
         assert_is(a.refresh_turntaker(), None)
-        assert_is(interfaces.TurnTaker.turn_takers[0](), a)
+        assert_is(context.GameContext.current().turn_takers[0](), a)
         assert_is(interfaces.TurnTaker.take_all_turns(), None)
         a.take_turn.assert_called_once_with()
 
     def test_add_turntaker_should_add_to_list(self):
         a = self.C(1,False)
         b = self.C(2)
-        assert_equal(len(interfaces.TurnTaker.turn_takers),1)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),b)
+        assert_equal(len(context.GameContext.current().turn_takers),1)
+        assert_is(context.GameContext.current().turn_takers[0](),b)
 
         assert_is(interfaces.TurnTaker.add_turntaker(a), None)
 
-        assert_equal(len(interfaces.TurnTaker.turn_takers),2)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),a)
-        assert_is(interfaces.TurnTaker.turn_takers[1](),b)
+        assert_equal(len(context.GameContext.current().turn_takers),2)
+        assert_is(context.GameContext.current().turn_takers[0](),a)
+        assert_is(context.GameContext.current().turn_takers[1](),b)
 
     def test_clear_turntaker_should_remove_count_from_list(self):
         a = self.C(1)
         b = self.C(2)
         interfaces.TurnTaker.add_turntaker(b) # again
 
-        assert_equal(len(interfaces.TurnTaker.turn_takers),3)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),a)
-        assert_is(interfaces.TurnTaker.turn_takers[1](),b)
-        assert_is(interfaces.TurnTaker.turn_takers[2](),b)
+        assert_equal(len(context.GameContext.current().turn_takers),3)
+        assert_is(context.GameContext.current().turn_takers[0](),a)
+        assert_is(context.GameContext.current().turn_takers[1](),b)
+        assert_is(context.GameContext.current().turn_takers[2](),b)
 
         assert_equal(interfaces.TurnTaker.clear_turntaker(a), None)
-        assert_equal(len(interfaces.TurnTaker.turn_takers),2)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),b)
-        assert_is(interfaces.TurnTaker.turn_takers[1](),b)
+        assert_equal(len(context.GameContext.current().turn_takers),2)
+        assert_is(context.GameContext.current().turn_takers[0](),b)
+        assert_is(context.GameContext.current().turn_takers[1](),b)
 
         assert_equal(interfaces.TurnTaker.clear_turntaker(b,2), None)
-        assert_equal(len(interfaces.TurnTaker.turn_takers),0)
+        assert_equal(len(context.GameContext.current().turn_takers),0)
 
     def test_clear_turntaker_should_not_raise_error_if_arg_not_in_list(self):
         a = self.C(1)
         b = self.C(2,False)
 
-        assert_equal(len(interfaces.TurnTaker.turn_takers),1)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),a)
+        assert_equal(len(context.GameContext.current().turn_takers),1)
+        assert_is(context.GameContext.current().turn_takers[0](),a)
 
         assert_equal(interfaces.TurnTaker.clear_turntaker(b), None)
 
-        assert_equal(len(interfaces.TurnTaker.turn_takers),1)
-        assert_is(interfaces.TurnTaker.turn_takers[0](),a)
+        assert_equal(len(context.GameContext.current().turn_takers),1)
+        assert_is(context.GameContext.current().turn_takers[0](),a)
 
 
 class TraversableTest(InterfaceTest):
@@ -1194,14 +1217,16 @@ class TraversableTest(InterfaceTest):
         assert_true(t1.blocks_movement())
         assert_false(t2.blocks_movement())
 
-    def test_should_permit_movement_if_testing_pathing_and_may_block(self):
+    def test_should_block_movement_if_testing_pathing_and_may_block(self):
         t1 = interfaces.Traversable(0.0)
-        t2 = interfaces.Traversable(0.0,True)
+        t2 = interfaces.Traversable(0.5,True)
+        t3 = interfaces.Traversable(0.5)
 
         assert_true(t1.blocks_movement())
-        assert_true(t2.blocks_movement())
-        assert_false(t1.blocks_movement(is_for_mapping=True))
+        assert_false(t2.blocks_movement())
+        assert_true(t1.blocks_movement(is_for_mapping=True))
         assert_true(t2.blocks_movement(is_for_mapping=True))
+        assert_false(t3.blocks_movement(is_for_mapping=True))
 
 
 class TransparentTest(InterfaceTest):
@@ -1531,7 +1556,7 @@ class AlertableTest(InterfaceTest):
             a = self.A(interfaces.Position(my_pos),r)
             assert_true(a.alert(interfaces.Position(alert_pos),priority=pri))
             assert_equal(a.investigate_list[pri], [alert_pos])
-            assert_in(a,interfaces.Alertable.ALERTABLES)
+            assert_in(a,context.GameContext.current().alertables)
 
     def test_should_not_alert_to_pos_outside_radius(self):
         for (r, my_pos, alert_pos, pri) in (
@@ -1543,21 +1568,21 @@ class AlertableTest(InterfaceTest):
             a = self.A(interfaces.Position(my_pos),r)
             assert_false(a.alert(interfaces.Position(alert_pos),priority=pri))
             assert_equal(a.investigate_list[pri], [])
-            assert_in(a,interfaces.Alertable.ALERTABLES)
+            assert_in(a,context.GameContext.current().alertables)
 
     def test_should_default_priority_to_medium(self):
         p = interfaces.Position(1,1)
         a = self.A(p,10)
         assert_true(a.alert(p))
         assert_equal(a.investigate_list[interfaces.Alertable.PRI_MED], [p])
-        assert_in(a,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
 
     def test_should_not_clear_other_alerts_if_their_pri_is_high(self):
         p = interfaces.Position(1,1)
         a = self.A(p, 1)
         b = self.A(p, 1)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
-        assert_in(b,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
+        assert_in(b,context.GameContext.current().alertables)
 
         assert_true(a.alert(p,interfaces.Alertable.PRI_MED))
         assert_true(b.alert(p,interfaces.Alertable.PRI_HIGH))
@@ -1569,8 +1594,8 @@ class AlertableTest(InterfaceTest):
         p = interfaces.Position(1,1)
         a = self.A(p, 1)
         b = self.A(p, 1)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
-        assert_in(b,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
+        assert_in(b,context.GameContext.current().alertables)
 
         assert_true(a.alert(p,interfaces.Alertable.PRI_HIGH))
         assert_true(b.alert(p,interfaces.Alertable.PRI_MED))
@@ -1582,8 +1607,8 @@ class AlertableTest(InterfaceTest):
         p = interfaces.Position(1,1)
         a = self.A(p, 1)
         b = self.A(p, 1)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
-        assert_in(b,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
+        assert_in(b,context.GameContext.current().alertables)
 
         assert_true(a.alert(p,interfaces.Alertable.PRI_LOW))
         assert_true(b.alert(p,interfaces.Alertable.PRI_MED))
@@ -1594,14 +1619,14 @@ class AlertableTest(InterfaceTest):
     def test_should_return_false_if_no_alerts_cleared(self):
         p = interfaces.Position(1,1)
         a = self.A(p, 1)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
         assert_false(a.clear_alert(p))
 
     def test_should_give_high_priority_pos_to_investigate_next(self):
         p1 = interfaces.Position(1,2)
         p2 = interfaces.Position(2,1)
         a = self.A(interfaces.Position(1,1), 2)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
 
         assert_true(a.alert(p1,interfaces.Alertable.PRI_HIGH))
         assert_true(a.alert(p2,interfaces.Alertable.PRI_LOW))
@@ -1614,7 +1639,7 @@ class AlertableTest(InterfaceTest):
         p1 = interfaces.Position(1,2)
         p2 = interfaces.Position(2,1)
         a = self.A(interfaces.Position(1,1), 2)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
 
         assert_true(a.alert(p1,interfaces.Alertable.PRI_MED))
         assert_true(a.alert(p2,interfaces.Alertable.PRI_LOW))
@@ -1626,13 +1651,50 @@ class AlertableTest(InterfaceTest):
     def test_should_give_low_pri_pos_to_investigate_if_no_med_or_high(self):
         p1 = interfaces.Position(1,2)
         a = self.A(interfaces.Position(1,1), 2)
-        assert_in(a,interfaces.Alertable.ALERTABLES)
+        assert_in(a,context.GameContext.current().alertables)
 
         assert_true(a.alert(p1,interfaces.Alertable.PRI_LOW))
 
         assert_equal(a.investigate_next(),p1)
         assert_equal(a.investigate_next(),None)
 
+    def test_should_prefer_nearer_pos_unless_a_priority_outweighs_it(self):
+        P = interfaces.Position
+        a = self.A(P(10,10), 4)
+        for (pos, pri) in ((P(13,10), interfaces.Alertable.PRI_MED), (P(11,10), interfaces.Alertable.PRI_MED),
+                           (P(10,11), interfaces.Alertable.PRI_LOW), (P(6,10), interfaces.Alertable.PRI_HIGH)):
+            assert_true(a.alert(pos,pri))
+        a.pos = P(12,10)
+        # medium counts 4 nearer and high 8, so (6,10) is at -2 and (10,11) at 2.2, after both (13,10) and (11,10) at -3
+        assert_equal([a.investigate_next() for i in range(5)], [P(13,10), P(11,10), P(6,10), P(10,11), None])
+
+    def test_should_only_investigate_pos_once_however_often_alerted(self):
+        p = interfaces.Position(1,1)
+        a = self.A(p, 1)
+        assert_true(a.alert(p))
+        assert_true(a.alert(p))
+        assert_equal(a.investigate_next(),p)
+        assert_equal(a.investigate_next(),None)
+
+    def test_should_still_investigate_pos_alerted_to_after_it_was_cleared(self):
+        p = interfaces.Position(1,1)
+        a = self.A(p, 1)
+        b = self.A(p, 1)
+        assert_true(a.alert(p,interfaces.Alertable.PRI_LOW))
+        assert_true(b.alert(p,interfaces.Alertable.PRI_MED))
+        assert_true(a.clear_alert(p))
+        assert_false(b.clear_alert(p))
+        assert_true(b.alert(p,interfaces.Alertable.PRI_LOW))
+        assert_equal(b.investigate_next(),p)
+
+    def test_should_clear_alerts_of_many_at_once(self):
+        p  = interfaces.Position(5,5)
+        As = [self.A(p, 1) for i in range(300)]
+        for a in As:
+            assert_true(a.alert(p,interfaces.Alertable.PRI_MED))
+        assert_true(As[0].clear_alert(p))
+        assert_equal([a.investigate_next() for a in As], [None] * 300)
+
 
 class TalkerTest(InterfaceTest):
 
@@ -1704,13 +1766,13 @@ class TalkerTest(InterfaceTest):
         assert_true(t.is_talking)
         assert_equal( mock_message.text, '1' )
         assert_true(mock_message.is_visible)
-        assert_equal(len(interfaces.Talker.currently_talking),1,"%s"%interfaces.Talker.currently_talking)
+        assert_equal(len(context.GameContext.current().currently_talking),1,"%s"%context.GameContext.current().currently_talking)
 
         assert_is(t.stop_talk(),None)
 
         assert_false(t.is_talking)
         assert_false(mock_message.is_visible)
-        assert_equal(len(interfaces.Talker.currently_talking),0)
+        assert_equal(len(context.GameContext.current().currently_talking),0)
 
     @patch('interfaces.Message')
     def test_should_stop_talking_even_when_not_talking(self,M):
@@ -1723,7 +1785,7 @@ class TalkerTest(InterfaceTest):
 
         assert_false(t.is_talking)
         assert_false(mock_message.is_visible)
-        assert_equal(len(interfaces.Talker.currently_talking),0)
+        assert_equal(len(context.GameContext.current().currently_talking),0)
 
     @patch('interfaces.Message')
     def test_should_talk_using_default_key_of_none(self,M):
@@ -1744,7 +1806,7 @@ class TalkerTest(InterfaceTest):
             assert_true(t.is_talking)
             assert_equal( mock_message.text, phrase )
             assert_true(mock_message.is_visible)
-            assert_equal(len(interfaces.Talker.currently_talking),1)
+            assert_equal(len(context.GameContext.current().currently_talking),1)
 
     @patch('interfaces.Message')
     def test_should_not_talk_if_no_phrases_for_key(self,M):
@@ -1757,7 +1819,7 @@ class TalkerTest(InterfaceTest):
         assert_false(t.talk('not none'))
         assert_false(t.is_talking)
         assert_false(mock_message.is_visible)
-        assert_equal(len(interfaces.Talker.currently_talking),0)
+        assert_equal(len(context.GameContext.current().currently_talking),0)
 
     @patch('interfaces.Message')
     def test_should_not_talk_if_probability_for_key_is_zero(self,M):
@@ -1769,7 +1831,7 @@ class TalkerTest(InterfaceTest):
         assert_false(t.talk())
         assert_false(t.is_talking)
         assert_false(mock_message.is_visible)
-        assert_equal(len(interfaces.Talker.currently_talking),0)
+        assert_equal(len(context.GameContext.current().currently_talking),0)
 
     @patch('interfaces.Message')
     def test_should_not_talk_if_key_not_configured(self,M):
@@ -1781,7 +1843,7 @@ class TalkerTest(InterfaceTest):
         assert_false(t.talk('not none'))
         assert_false(t.is_talking)
         assert_false(mock_message.is_visible)
-        assert_equal(len(interfaces.Talker.currently_talking),0)
+        assert_equal(len(context.GameContext.current().currently_talking),0)
 
     def test_should_stop_talking_if_talking_again_whilst_still_talking(self):
         t = self.T()
@@ -1849,15 +1911,15 @@ class TalkerTest(InterfaceTest):
         assert_true(t2.is_talking)
         assert_false(t3.is_talking)
 
-        assert_equal(len(interfaces.Talker.currently_talking),2)
-        assert_in(t1,interfaces.Talker.currently_talking)
-        assert_in(t2,interfaces.Talker.currently_talking)
+        assert_equal(len(context.GameContext.current().currently_talking),2)
+        assert_in(t1,context.GameContext.current().currently_talking)
+        assert_in(t2,context.GameContext.current().currently_talking)
 
         assert_is(interfaces.Talker.stop_all_talk(),None)
         assert_false(t1.is_talking)
         assert_false(t2.is_talking)
         assert_false(t3.is_talking)
-        assert_equal(len(interfaces.Talker.currently_talking),0)
+        assert_equal(len(context.GameContext.current().currently_talking),0)
 
 
 class ShouterTest(InterfaceTest):
@@ -1882,16 +1944,16 @@ class ShouterTest(InterfaceTest):
             s = self.S(pos,r)
             expected_alerts = [Mock(spec=interfaces.Alertable,pos=p) for p in ps]
             s.map = Mock(spec=maps.Map)
-            s.map.find_all_within_r = Mock(return_value=expected_alerts)
+            s.map.find_all_audible = Mock(return_value=expected_alerts)
             assert_is(s.shout(), None)
             for a in expected_alerts:
                 a.alert.assert_called_once_with(pos,None)
-            s.map.find_all_within_r.assert_called_once_with(s,interfaces.Alertable,r)
+            s.map.find_all_audible.assert_called_once_with(s,interfaces.Alertable,r)
 
     #def test_should_not_alert_any_outside_radius(self):
     #    pass
     #    ... because of the way the previous test works, by mocking
-    #    find_all_within_r, this test is effectively redundant
+    #    find_all_audible, this test is effectively redundant
 
     def test_should_alert_all_within_radius_to_pos(self):
         for (pos, ps, r) in (
@@ -1903,12 +1965,12 @@ class ShouterTest(InterfaceTest):
             s = self.S(interfaces.Position(25,25),r)
             expected_alerts = [Mock(spec=interfaces.Alertable,pos=p) for p in ps]
             s.map = Mock(spec=maps.Map)
-            s.map.find_all_within_r = Mock(return_value=expected_alerts)
+            s.map.find_all_audible = Mock(return_value=expected_alerts)
             at_thing = Mock(spec=interfaces.Mappable,pos=pos)
             assert_is(s.shout(at_thing), None)
             for a in expected_alerts:
                 a.alert.assert_called_once_with(pos,None)
-            s.map.find_all_within_r.assert_called_once_with(s,interfaces.Alertable,r)
+            s.map.find_all_audible.assert_called_once_with(s,interfaces.Alertable,r)
 
     def test_should_alert_with_given_priority(self):
         for (pos, ps, r, pri) in (
@@ -1920,12 +1982,12 @@ class ShouterTest(InterfaceTest):
             s = self.S(interfaces.Position(25,25),r)
             expected_alerts = [Mock(spec=interfaces.Alertable,pos=p) for p in ps]
             s.map = Mock(spec=maps.Map)
-            s.map.find_all_within_r = Mock(return_value=expected_alerts)
+            s.map.find_all_audible = Mock(return_value=expected_alerts)
             at_thing = Mock(spec=interfaces.Mappable,pos=pos)
             assert_is(s.shout(at_thing,pri), None)
             for a in expected_alerts:
                 a.alert.assert_called_once_with(pos,pri)
-            s.map.find_all_within_r.assert_called_once_with(s,interfaces.Alertable,r)
+            s.map.find_all_audible.assert_called_once_with(s,interfaces.Alertable,r)
 
     def test_should_not_alert_self(self):
         for (pos, ps, r) in (
@@ -1938,12 +2000,12 @@ class ShouterTest(InterfaceTest):
             s.alert = Mock()
             expected_alerts = [Mock(spec=interfaces.Alertable,pos=p) for p in ps]
             s.map = Mock(spec=maps.Map)
-            s.map.find_all_within_r = Mock(return_value=expected_alerts+[s])
+            s.map.find_all_audible = Mock(return_value=expected_alerts+[s])
             at_thing = Mock(spec=interfaces.Mappable,pos=pos)
             assert_is(s.shout(at_thing), None)
             for a in expected_alerts:
                 a.alert.assert_called_once_with(pos,None)
-            s.map.find_all_within_r.assert_called_once_with(s,interfaces.Alertable,r)
+            s.map.find_all_audible.assert_called_once_with(s,interfaces.Alertable,r)
             assert_equal(s.alert.call_count, 0)
 
     def test_should_not_alert_target_of_shout(self):
@@ -1958,11 +2020,11 @@ class ShouterTest(InterfaceTest):
 
             expected_alerts = [Mock(spec=interfaces.Alertable,pos=p) for p in ps]
             s.map = Mock(spec=maps.Map)
-            s.map.find_all_within_r = Mock(return_value=expected_alerts+[at_thing])
+            s.map.find_all_audible = Mock(return_value=expected_alerts+[at_thing])
             assert_is(s.shout(at_thing), None)
             for a in expected_alerts:
                 a.alert.assert_called_once_with(pos,None)
-            s.map.find_all_within_r.assert_called_once_with(s,interfaces.Alertable,r)
+            s.map.find_all_audible.assert_called_once_with(s,interfaces.Alertable,r)
 
             assert_equal(at_thing.alert.call_count, 0)
 
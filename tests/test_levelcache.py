@@ -0,0 +1,120 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import Mock, patch
+
+# lang imports
+import os
+import sys
+import shutil
+import tempfile
+
+# item under test
+import libtcodpy as libtcod
+import context
+import interfaces
+import levelcache
+import maps
+import player
+import sweep
+
+class LevelCacheTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.path = tempfile.mkdtemp()
+        self.cache = levelcache.LevelCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def new_game(self, seed):
+        g = context.GameContext(seed)
+        with g:
+            g.player = player.HeadlessPlayer(sweep.stair_runner)
+            self.cache.generate(g, sweep.MAP_SIZE)
+        return g
+
+    def test_should_generate_once_per_seed(self):
+        g1 = self.new_game(55)
+        assert_equal((self.cache.hits, self.cache.misses), (0, 1))
+        assert_true(os.path.exists(self.cache.file_for(55, g1.map.size)))
+        g2 = self.new_game(55)
+        assert_equal((self.cache.hits, self.cache.misses), (1, 1))
+        assert_is(g2.map.player, g2.player)
+        assert_equal(g2.player.pos, g1.player.pos)
+        assert_equal(g2.map.checksum(), g1.map.checksum())
+        assert_equal([list(c) for c in g2.map._map], [list(c) for c in g1.map._map])
+        assert_equal(libtcod.random_get_int(g2.map.map_rng, 0, 1000), libtcod.random_get_int(g1.map.map_rng, 0, 1000))
+
+    def test_should_match_uncached_generation(self):
+        g1 = self.new_game(56)
+        g2 = context.GameContext(56)
+        with g2:
+            g2.player = player.HeadlessPlayer(sweep.stair_runner)
+            g2.map = maps.Map.random(56, g1.map.size, g2.player, g2)
+            g2.map.generate()
+        assert_equal(sorted(str(m) for m in g1.map.get_monsters()), sorted(str(m) for m in g2.map.get_monsters()))
+        assert_equal(g1.map.checksum(), g2.map.checksum())
+
+    def test_should_invalidate_when_generator_changes(self):
+        g = self.new_game(57)
+        f = self.cache.file_for(57, g.map.size)
+        with patch.object(maps.TypeAMap, 'MAX_ROOMS', maps.TypeAMap.MAX_ROOMS + 1):
+            c = levelcache.LevelCache(self.path)
+            assert_not_equal(c.version, self.cache.version)
+            assert_false(os.path.exists(f))
+            assert_is(c.get(57, g.map.size), None)
+
+    def test_sweep_should_use_cache(self):
+        r1 = sweep.run_seed(58, cache=self.cache)
+        r2 = sweep.run_seed(58, cache=self.cache)
+        assert_equal(r1.outcome, sweep.SweepResult.GENERATED)
+        assert_equal((r1.rooms, r1.monsters, r1.items), (r2.rooms, r2.monsters, r2.items))
+        assert_equal(len(os.listdir(self.path)), 1)
+
+    def test_sweep_workers_should_open_cache_once(self):
+        with patch.object(sweep, 'LevelCache', wraps=levelcache.LevelCache) as LevelCache, patch.object(sys, 'stdout'):
+            sweep._init_worker(self.path)
+            for i in range(2):
+                sweep._run_job((i, (59, False, (40,30), 5, sweep.stair_runner)))
+        c = sweep._cache
+        sweep._cache = None
+        assert_equal(LevelCache.call_count, 1)
+        assert_equal((c.hits, c.misses), (1, 1))
+
+    def test_prune_should_ignore_files_already_gone(self):
+        open(os.path.join(self.path, 'old-1-40x30' + levelcache.LevelCache.SUFFIX), 'wb').close()
+        with patch.object(os, 'remove', side_effect=FileNotFoundError) as remove:
+            self.cache.prune()
+        assert_equal(remove.call_count, 1)
+
+class NextLevelTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.game = context.GameContext(54)
+        with self.game:
+            levelcache.next_level(self.game, (40,30), lambda: player.HeadlessPlayer(sweep.stair_runner))
+
+    def test_should_start_new_game_on_next_seed(self):
+        g = self.game
+        assert_equal(g.seed, 55)
+        assert_is(g.map.player, g.player)
+        assert_equal(g.map.size, interfaces.Position(40,30))
+        assert_equal(g.player.levels_seen, 1)
+
+    def test_should_close_old_map_and_keep_player(self):
+        (g, p, old) = (self.game, self.game.player, self.game.map)
+        with g:
+            levelcache.next_level(g, (40,30))
+        assert_false(old.has_native())
+        assert_is(g.player, p)
+        assert_is(g.map.player, p)
+        assert_equal(p.levels_seen, 2)
+        assert_equal(g.seed, 56)
+
+    def test_should_take_map_from_source(self):
+        source = Mock()
+        with self.game:
+            m = levelcache.next_level(self.game, (40,30), None, source)
+        source.generate.assert_called_once_with(self.game, (40,30))
+        assert_is(m, source.generate.return_value)
@@ -10,6 +10,7 @@ import gc
 
 # item under test
 import libtcodpy as libtcod
+import context
 import items
 import interfaces
 import maps
@@ -453,6 +454,460 @@ class MapTest(MapsTest):
     def test_should_get_all_items(self):
         pass
 
+    def test_should_update_observation_as_objects_come_and_go(self):
+        M = maps.Map
+        (a, b) = (interfaces.Position(0,1), interfaces.Position(2,1))
+        for p in (a, b):
+            self.map.add(tiles.Floor(p))
+        self.map.add(tiles.Wall(interfaces.Position(1,1)))
+        obs = self.map.observation
+        assert_equal(obs[M.OBS_WALKABLE][a.x][a.y], 1)
+        assert_equal(obs[M.OBS_WALKABLE][1][1], 0)
+        assert_equal(obs[M.OBS_TRANSPARENT][1][1], 0)
+
+        d = monsters.LitDalek(a)
+        dalek = M.OBS_MONSTER + M.OBSERVED_MONSTERS.index(monsters.LitDalek)
+        self.map.add(d)
+        self.map.add(items.HandTeleport(b,1.0))
+        assert_equal(obs[dalek][a.x][a.y], 1)
+        assert_equal(obs[M.OBS_MONSTER + M.OBSERVED_MONSTERS.index(monsters.Dalek)][a.x][a.y], 0)
+        assert_equal(obs[M.OBS_ITEM][b.x][b.y], 1)
+
+        self.map.move(d, b)
+        assert_equal(obs[dalek][a.x][a.y], 0)
+        assert_equal(obs[dalek][b.x][b.y], 1)
+        self.map.remove(d)
+        assert_equal(obs[dalek][b.x][b.y], 0)
+
+    def test_should_observe_door_state(self):
+        M = maps.Map
+        p = interfaces.Position(1,1)
+        d = tiles.Door(p)
+        self.map.add(d)
+        assert_equal(self.map.observation[M.OBS_DOOR][p.x][p.y], M.OBS_DOOR_CLOSED)
+        assert_equal(self.map.observation[M.OBS_TRANSPARENT][p.x][p.y], 0)
+        d.to_open()
+        assert_equal(self.map.observation[M.OBS_DOOR][p.x][p.y], M.OBS_DOOR_OPEN)
+        assert_equal(self.map.observation[M.OBS_TRANSPARENT][p.x][p.y], 1)
+        d.to_closing()
+        assert_equal(self.map.observation[M.OBS_DOOR][p.x][p.y], M.OBS_DOOR_CLOSING)
+
+    def test_should_copy_observation_into_buffer(self):
+        self.map.add(tiles.Floor(interfaces.Position(2,2)))
+        buf = bytearray(self.map.observation_size())
+        self.map.observe(buf)
+        assert_equal(bytes(buf), bytes(memoryview(self.map.observation).cast('B')))
+
     # don't test abstract generate method
 
     # TODO: map generation functions
+
+class GenerateTest(MapsTest):
+    def test_should_generate_in_maps_context(self):
+        game = context.GameContext(7)
+        with game:
+            game.player = player.HeadlessPlayer(lambda p: '.')
+        outside = len(context.GameContext.current().turn_takers)
+        game.map = maps.Map.random(7,interfaces.Position(40,30),game.player,game)
+        game.map.generate()
+        assert_equal(len(context.GameContext.current().turn_takers), outside)
+        assert_true(all(m.context is game for m in game.map.get_monsters()))
+        assert_greater(len(game.turn_takers), 1)
+
+class CloseTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.map = maps.Map(None,interfaces.Position(3,3),Mock(spec_set=player.Player))
+
+    def test_should_free_tcod_resources_once(self):
+        with patch.object(libtcod, 'map_delete', wraps=libtcod.map_delete) as map_delete:
+            self.map.close()
+            self.map.close()
+            self.map.__del__()
+        assert_equal(map_delete.call_count, 2)
+        assert_false(self.map.has_native())
+
+class ComponentsTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.game = context.GameContext(3)
+        with self.game:
+            self.game.player = player.HeadlessPlayer(lambda p: '.')
+            self.map = maps.Map(3,interfaces.Position(7,5),self.game.player,self.game)
+        self.map._gen_draw_map_edges()
+
+    def floor(self, *cells):
+        for (x, y) in cells:
+            self.map.add(tiles.Floor(interfaces.Position(x,y)))
+
+    def test_should_label_largest_component_first(self):
+        # a diagonal step joins (1,1) to (2,2); (5,1) stands alone
+        self.floor((5,1), (1,1), (2,2), (2,3), (3,3))
+        self.map.recalculate_paths(is_for_mapping=True)
+        c = self.map.label_components()
+        assert_equal(self.map.component_sizes, [0, 4, 1])
+        assert_equal([c[x*5+y] for (x, y) in ((1,1), (2,2), (3,3), (5,1), (0,0), (2,1))], [1, 1, 1, 2, 0, 0])
+
+    def test_should_find_clear_cell_in_given_component(self):
+        self.floor((5,1), (1,1), (2,2), (2,3), (3,3))
+        self.map.recalculate_paths(is_for_mapping=True)
+        self.map.label_components()
+        for i in range(10):
+            assert_equal(self.map.find_random_clear(self.map.map_rng, 2), interfaces.Position(5,1))
+
+    def test_should_keep_clear_cells_by_component_up_to_date(self):
+        P = interfaces.Position
+        self.floor((5,1), (1,1), (2,2), (2,3), (3,3))
+        self.map.recalculate_paths(is_for_mapping=True)
+        self.map.label_components()
+        self.map.add(monsters.Dalek(P(2,2)))
+        self.map.add(monsters.Dalek(P(3,3)))
+        assert_equal(set(self.map.find_random_clear(self.map.map_rng, 1) for i in range(50)), set([P(1,1), P(2,3)]))
+        assert_equal(self.map.find_random_clear(self.map.map_rng, 1, away_from=P(1,1), min_distance=5), P(2,3))
+
+    def test_should_not_find_clear_cell_in_full_component(self):
+        self.floor((5,1), (1,1), (2,2), (2,3), (3,3))
+        self.map.recalculate_paths(is_for_mapping=True)
+        self.map.label_components()
+        self.map.add(monsters.Dalek(interfaces.Position(5,1)))
+        assert_raises(errors.MapGenerationError, self.map.find_random_clear, self.map.map_rng, 2)
+
+    def test_should_put_stairs_in_largest_component(self):
+        self.floor((5,1), (1,1), (2,2), (2,3))
+        with self.game:
+            self.map._gen_add_key_elements()
+        up   = self.map.find_at_pos(self.game.player.pos, tiles.Tile)
+        down = self.map.find_all(tiles.StairsDown, tiles.Tile)[0]
+        assert_not_equal(up.pos, down.pos)
+        for t in (up, down):
+            assert_equal(self.map.components[t.pos.x*5+t.pos.y], 1)
+
+    def test_should_fail_if_no_room_for_stairs(self):
+        self.floor((1,1), (5,3))
+        assert_raises(errors.MapGenerationError, self.map._gen_add_key_elements)
+
+class CellSetTest(MapsTest):
+    def test_should_fill_gaps_with_last_cell(self):
+        c = maps.CellSet(10)
+        for i in (4, 7, 2, 9):
+            c.add(i)
+        c.add(7)
+        c.discard(7)
+        c.discard(5)
+        assert_equal(list(c.cells), [4, 9, 2])
+        assert_true(9 in c)
+        assert_false(7 in c)
+        c.discard(2)
+        c.add(7)
+        assert_equal(list(c.cells), [4, 9, 7])
+
+class FindRandomClearTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.map = maps.Map(5,interfaces.Position(4,3),Mock(spec_set=player.Player))
+        for x in range(4):
+            self.map.add(tiles.Floor(interfaces.Position(x,1)))
+        self.map.add(tiles.Wall(interfaces.Position(0,0)))
+
+    def clear_cells(self):
+        return set(self.map.find_random_clear(self.map.map_rng) for i in range(100))
+
+    def test_should_only_find_unoccupied_floor(self):
+        P = interfaces.Position
+        d = monsters.Dalek(P(1,1))
+        self.map.add(d)
+        self.map.add(items.HandTeleport(P(2,1),1.0))
+        assert_equal(self.clear_cells(), set([P(0,1), P(2,1), P(3,1)]))
+        self.map.move(d, P(3,1))
+        assert_equal(self.clear_cells(), set([P(0,1), P(1,1), P(2,1)]))
+        self.map.remove(d)
+        assert_equal(len(self.clear_cells()), 4)
+
+    def test_should_find_clear_cell_far_enough_away(self):
+        P = interfaces.Position
+        far = set(self.map.find_random_clear(self.map.map_rng,away_from=P(0,1),min_distance=1.5) for i in range(50))
+        assert_equal(far, set([P(2,1), P(3,1)]))
+        # or the furthest, if none is far enough
+        assert_equal(self.map.find_random_clear(self.map.map_rng,away_from=P(0,1),min_distance=5), P(3,1))
+
+class OccupancyTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.map = maps.Map(5,interfaces.Position(4,3),Mock(spec_set=player.Player))
+        for x in range(4):
+            self.map.add(tiles.Floor(interfaces.Position(x,1)))
+
+    def test_should_count_mobile_and_immobile_monsters(self):
+        P = interfaces.Position
+        d = monsters.Dalek(P(1,1))
+        c = monsters.StaticCamera(P(2,1))
+        self.map.add(d)
+        self.map.add(c)
+        assert_equal(self.map.occupancy(P(1,1)), (1,0))
+        assert_equal(self.map.occupancy(P(2,1)), (0,1))
+        self.map.move(d, P(2,1))
+        assert_equal(self.map.occupancy(P(1,1)), (0,0))
+        assert_equal(self.map.occupancy(P(2,1)), (1,1))
+        self.map.remove(d)
+        assert_equal(self.map.occupancy(P(2,1)), (0,1))
+        assert_equal(self.map.occupancy(P(-1,9)), (0,0))
+
+    def test_should_find_free_neighbours(self):
+        P = interfaces.Position
+        self.map.add(monsters.Dalek(P(2,1)))
+        self.map.add(tiles.Wall(P(1,0)))
+        assert_equal(self.map.free_neighbours(P(1,1)), [P(0,1)])
+        assert_equal(self.map.free_neighbours(P(3,1)), [])
+
+class CanSeeAllTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        P = interfaces.Position
+        self.map = maps.Map(5,P(9,9),Mock(spec=player.Player))
+        self.map.player.pos = P(4,4)
+        self.map.player.is_visible = True
+        self.daleks = []
+        for x in range(9):
+            for y in range(9):
+                d = monsters.Dalek(P(x,y))
+                d.last_pos = P(x+(x*y)%3-1,y+(x+y)%3-1)
+                self.daleks.append(d)
+
+    def in_sight(self, from_pos, to_pos):
+        return (to_pos.x+to_pos.y)%4 != 0
+
+    def can_see_each(self, angle_of_vis):
+        return [self.map.can_see(d,None,angle_of_vis) for d in self.daleks]
+
+    def test_should_see_as_can_see_does(self):
+        with patch.object(self.map, 'is_lit', return_value=True), \
+                patch.object(self.map, 'in_sight', side_effect=self.in_sight):
+            for angle_of_vis in (0.25, 0.5, 1.0):
+                assert_equal(self.map.can_see_all(self.daleks,angle_of_vis), self.can_see_each(angle_of_vis))
+                with patch.object(maps, 'numpy_available', False):
+                    assert_equal(self.map.can_see_all(self.daleks,angle_of_vis), self.can_see_each(angle_of_vis))
+
+    def test_should_see_nothing_if_player_is_unlit(self):
+        with patch.object(self.map, 'is_lit', return_value=False) as is_lit:
+            assert_equal(self.map.can_see_all(self.daleks,0.5), [False] * len(self.daleks))
+        is_lit.assert_called_once_with(self.map.player)
+
+class LineOfSightTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        P = interfaces.Position
+        # two rooms with a door between them, and a closet that can't see the door
+        self.map = maps.Map(5,P(9,5),Mock(spec=player.Player))
+        self.map.player.has_effect.return_value = False
+        self.map._gen_draw_map_edges()
+        for x in (1,2,4,5,7):
+            for y in range(1,4):
+                self.map.add(tiles.Floor(P(x,y)))
+        for y in range(1,4):
+            self.map.add(tiles.Wall(P(6,y)))
+            if y != 2:
+                self.map.add(tiles.Wall(P(3,y)))
+        self.door = tiles.Door(P(3,2))
+        self.map.add(self.door)
+        self.map.recalculate_paths()
+
+    def in_sight(self, pos):
+        P = interfaces.Position
+        return set((x,y) for x in range(9) for y in range(5) if self.map.in_sight(pos,P(x,y)))
+
+    def test_should_see_as_fov_does(self):
+        P = interfaces.Position
+        for pos in (P(1,1), P(2,2), P(5,3), P(7,2)):
+            self.map.prepare_fov(pos)
+            fov = set((x,y) for x in range(9) for y in range(5) if self.map._drawing_can_see(P(x,y)))
+            assert_equal(self.in_sight(pos), fov)
+
+    def test_should_only_forget_sight_that_a_door_changes(self):
+        P = interfaces.Position
+        assert_false((5,2) in self.in_sight(P(1,2)))
+        closet = self.in_sight(P(7,2))
+        self.door.to_open()
+        self.map.recalculate_paths(self.door.pos, force_now=True)
+        with patch.object(libtcod, 'map_compute_fov', wraps=libtcod.map_compute_fov) as compute_fov:
+            assert_equal(self.in_sight(P(7,2)), closet)
+            assert_equal(compute_fov.call_count, 0)
+            assert_true((5,2) in self.in_sight(P(1,2)))
+            assert_equal(compute_fov.call_count, 1)
+
+    def test_should_see_player_from_where_they_are_within_fov_radius(self):
+        P = interfaces.Position
+        d = monsters.Dalek(P(2,3))
+        self.map.add(d)
+        self.map.player.is_visible = True
+        self.map.player.pos = P(1,1)
+        with patch.object(self.map, 'is_lit', return_value=True):
+            self.map.prepare_fov(P(7,2))
+            assert_true(self.map.can_see(d))
+            self.map.prepare_fov(P(1,1),1)
+            assert_false(self.map.can_see(d))
+
+    def test_should_add_view_without_changing_fov(self):
+        P = interfaces.Position
+        self.map.prepare_fov(P(1,2))
+        self.map.add_view(P(7,2))
+        assert_true(self.map.find_at_pos(P(7,1)).visible_to_player)
+        assert_true(self.map.find_at_pos(P(1,1)).visible_to_player)
+        assert_false(self.map.find_at_pos(P(5,1)).visible_to_player)
+        assert_false(self.map._drawing_can_see(P(7,1)))
+
+class SoundFieldTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        # a corridor along y=1, split at x=4
+        self.map = maps.Map(None,interfaces.Position(9,3),Mock(spec_set=player.Player))
+        self.map._gen_draw_map_edges()
+        for x in (1,2,3,5,6,7):
+            self.map.add(tiles.Floor(interfaces.Position(x,1)))
+
+    def test_should_not_carry_through_walls(self):
+        self.map.add(tiles.Wall(interfaces.Position(4,1)))
+        f = self.map.sound_field(interfaces.Position(1,1),10)
+        assert_equal(sorted(f.items()), [(1*3+1, 0.0), (2*3+1, 1.0), (3*3+1, 2.0)])
+
+    def test_should_be_damped_by_closed_doors(self):
+        door = tiles.Door(interfaces.Position(4,1))
+        self.map.add(door)
+        f = self.map.sound_field(interfaces.Position(1,1),10)
+        assert_equal(f[5*3+1], 3.0 + maps.Map.SOUND_DAMPING)
+        assert_not_in(7*3+1, self.map.sound_field(interfaces.Position(1,1),6))
+
+        door.to_open()
+        assert_equal(self.map.sound_field(interfaces.Position(1,1),10)[5*3+1], 4.0)
+
+    def test_should_find_only_what_can_hear(self):
+        P = interfaces.Position
+        self.map.add(tiles.Wall(P(4,1)))
+        (near, far) = (monsters.Dalek(P(3,1)), monsters.Dalek(P(5,1)))
+        self.map.add(near)
+        self.map.add(far)
+        shouter = Mock(spec=interfaces.Mappable,pos=P(1,1))
+        assert_equal(self.map.find_all_audible(shouter,interfaces.Alertable,10), [near])
+        assert_equal(self.map.find_all_audible(shouter,interfaces.Alertable,2), [])
+        assert_equal(len(self.map.find_all_within_r(shouter,interfaces.Alertable,10)), 2)
+
+    def test_should_keep_field_until_geometry_changes(self):
+        f = self.map.sound_field(interfaces.Position(1,1),10)
+        assert_is(self.map.sound_field(interfaces.Position(1,1),10), f)
+        self.map.add(tiles.Floor(interfaces.Position(4,1)))
+        assert_is_not(self.map.sound_field(interfaces.Position(1,1),10), f)
+        assert_in(7*3+1, self.map.sound_field(interfaces.Position(1,1),10))
+
+class FlowFieldTest(MapsTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        # a room 5 wide and 3 high, with a wall sticking into it at x=3
+        self.map = maps.Map(None,interfaces.Position(7,5),Mock(spec_set=player.Player))
+        self.map._gen_draw_map_edges()
+        for x in range(1,6):
+            for y in range(1,4):
+                self.map.add(x == 3 and y < 3 and tiles.Wall(interfaces.Position(x,y)) or tiles.Floor(interfaces.Position(x,y)))
+        self.map.recalculate_paths(force_now=True)
+
+    def distances(self, rows):
+        """stands in for libtcod's walking distances, given row by row"""
+        return lambda field, x, y: rows[y][x]
+
+    def test_should_step_downhill_to_nearest_neighbour(self):
+        P = interfaces.Position
+        rows = ((-1, -1,  -1,  -1,  -1,  -1, -1),
+                (-1,  5.6, 5.2, -1,  1.0, 0.0, -1),
+                (-1,  5.2, 4.2, -1,  1.4, 1.0, -1),
+                (-1,  4.8, 3.8, 2.8, 2.4, 2.0, -1),
+                (-1, -1,  -1,  -1,  -1,  -1, -1))
+        with patch.object(libtcod, 'dijkstra_get_distance', side_effect=self.distances(rows)):
+            assert_equal([self.map.flow_step(P(x,y),P(5,1)) for (x,y) in ((1,1),(2,2),(2,3),(3,3),(4,2),(5,1))],
+                         [P(2,2), P(3,3), P(3,3), P(4,2), P(5,1), None])
+        rows = tuple(tuple(-1 for x in range(7)) for y in range(5))
+        with patch.object(libtcod, 'dijkstra_get_distance', side_effect=self.distances(rows)):
+            assert_is(self.map.flow_step(P(1,1),P(5,1)), None)
+
+    def test_should_share_field_between_users_until_released(self):
+        P = interfaces.Position
+        with patch.object(libtcod, 'dijkstra_compute', wraps=libtcod.dijkstra_compute) as compute:
+            for i in range(10):
+                self.map.use_flow(P(5,1))
+            for x in (1,2):
+                for y in (1,2,3):
+                    self.map.flow_step(P(x,y), P(5,1))
+            assert_equal(compute.call_count, 1)
+
+            for i in range(10):
+                self.map.release_flow(P(5,1))
+            self.map.flow_step(P(1,1), P(5,1))
+            self.map.flow_step(P(1,1), P(5,1))
+            assert_equal(compute.call_count, 3)
+        assert_raises(AssertionError, self.map.release_flow, P(5,1))
+
+    def test_should_recompute_field_when_pathing_changes(self):
+        P = interfaces.Position
+        self.map.use_flow(P(5,1))
+        with patch.object(libtcod, 'dijkstra_compute', wraps=libtcod.dijkstra_compute) as compute:
+            self.map.flow_step(P(2,1), P(5,1))
+            self.map.add(tiles.Floor(P(3,2)))
+            self.map.recalculate_paths(P(3,2))
+            self.map.flow_step(P(2,1), P(5,1))
+            assert_equal(compute.call_count, 1)
+            self.map.recalculate_paths(P(3,2), force_now=True)
+            self.map.flow_step(P(2,1), P(5,1))
+            compute.assert_called_with(ANY, 5, 1)
+            assert_equal(compute.call_count, 2)
+
+class TypeAMapTest(MapsTest):
+    def setUp(self):
+        self.map = maps.TypeAMap(None,interfaces.Position(8,6),Mock(spec_set=player.Player))
+
+    def grids(self):
+        """the generation grid as an array and as lists"""
+        gs = [[[0 for y in range(6)] for x in range(8)]]
+        if maps.numpy_available:
+            gs.append(maps.numpy.zeros((8,6),dtype=maps.numpy.uint8))
+        return gs
+
+    def test_should_commit_elements_to_grid(self):
+        r = []
+        for g in self.grids():
+            maps.TypeAMap._ME(tiles.MapPattern.ROOM,(1,1),(3,2)).commit(g)
+            maps.TypeAMap._ME(tiles.MapPattern.WALL,(2,0),(1,6)).commit(g)
+            # hanging off the top left wraps round
+            maps.TypeAMap._ME(tiles.MapPattern.DOOR,(-1,-1),(2,2)).commit(g)
+            r.append([list(c) for c in g])
+        assert_equal(r[0][1][1], tiles.MapPattern.ROOM)
+        assert_equal(r[0][2][1], tiles.MapPattern.ROOM|tiles.MapPattern.WALL)
+        assert_equal(r[0][7][5], tiles.MapPattern.DOOR)
+        for l in r:
+            assert_equal(l, r[0])
+
+    def test_should_find_first_hit_in_x_then_y_order(self):
+        for g in self.grids():
+            self.map._map = g
+            assert_equal(self.map._gen_first_hit(range(0,8),range(0,6)), [])
+            maps.TypeAMap._ME(tiles.MapPattern.ROOM,(4,2),(2,2)).commit(g)
+            assert_equal(self.map._gen_first_hit(range(3,6),range(1,5)), [(4,2)])
+            assert_equal(self.map._gen_first_hit(range(5,6),range(0,6)), [(5,2)])
+            assert_equal(self.map._gen_first_hit(range(-2,2),range(0,6)), [])
+
+    def test_should_give_up_after_too_many_rejected_layouts(self):
+        with patch.object(maps.TypeAMap, '_gen_layout', side_effect=errors.MapRejectedError("coverage")):
+            assert_raises(errors.MapGenerationError, self.map.generate)
+        assert_equal(self.map.layouts, maps.TypeAMap.MAX_LAYOUTS)
+        assert_equal(self.map.rejections, {"coverage": maps.TypeAMap.MAX_LAYOUTS})
+        assert_equal(self.map.find_all(tiles.Tile), [])
+
+    def test_should_place_walls_next_to_occupied_cells(self):
+        r = []
+        for g in self.grids():
+            self.map._map = g
+            maps.TypeAMap._ME(tiles.MapPattern.ROOM,(3,2),(2,1)).commit(g)
+            maps.TypeAMap._ME(tiles.MapPattern.WALL,(7,0),(1,6)).commit(g)
+            r.append(self.map._gen_cells_to_place())
+        (cells, misses) = r[0]
+        assert_equal(misses, 8*2+4*2-6)
+        assert_equal(cells[:4], [(2,1),(2,2),(2,3),(3,1)])
+        assert_equal(len(cells), 4*3+4+6)
+        for x in r:
+            assert_equal(x, r[0])
@@ -0,0 +1,106 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import Mock, patch
+
+# item under test
+import context
+import interfaces
+import maps
+import monsters
+import player
+import tiles
+from interfaces import Position
+
+class MonstersTest(DalekTest):
+    pass
+
+class PatrollingTest(MonstersTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.game = context.GameContext(7)
+        with self.game:
+            # a corridor along y=1
+            self.map = maps.Map(None,Position(10,3),Mock(spec_set=player.Player),self.game)
+            self.map._gen_draw_map_edges()
+            self.floors = dict((x, tiles.Floor(Position(x,1))) for x in range(1,9))
+            for f in self.floors.values():
+                self.map.add(f)
+            self.dalek = monsters.Dalek(Position(1,1))
+        self.map.add(self.dalek)
+
+    def corridor_path(self, from_pos, to_pos, steps=None):
+        d = to_pos.x > from_pos.x and 1 or -1
+        return [Position(x,1) for x in range(from_pos.x+d,to_pos.x+d,d)]
+
+    def walk(self, state, turns):
+        for i in range(turns):
+            self.map.move(self.dalek,state.get_move())
+        return self.dalek.pos
+
+    def test_should_patrol_far_enough(self):
+        with self.game:
+            for i in range(10):
+                assert_greater(monsters.MS_Patrolling(self.dalek,5).patrolpt2.x, 6)
+
+    def test_should_work_out_each_leg_once(self):
+        with patch.object(self.map, 'get_path', side_effect=self.corridor_path) as get_path, self.game:
+            s = monsters.MS_Patrolling(self.dalek,5)
+            end = s.patrolpt2
+            assert_equal(self.walk(s, end.x-1), end)
+            assert_equal(self.walk(s, end.x-1), Position(1,1))
+            assert_equal(self.walk(s, 2), Position(3,1))
+            assert_equal(get_path.call_count, 1)
+
+    def test_should_work_out_route_again_if_moved_off_it(self):
+        with patch.object(self.map, 'get_path', side_effect=self.corridor_path) as get_path, self.game:
+            s = monsters.MS_Patrolling(self.dalek,5)
+            self.walk(s, 2)
+            self.map.move(self.dalek,Position(5,1))
+            assert_equal(s.get_move(), Position(6,1))
+            assert_equal(get_path.call_count, 2)
+            get_path.assert_called_with(Position(5,1),s.patrolpt2)
+
+    def test_should_work_out_route_again_only_if_blocked(self):
+        with patch.object(self.map, 'get_path', side_effect=self.corridor_path) as get_path, self.game:
+            s = monsters.MS_Patrolling(self.dalek,5)
+            self.walk(s, 1)
+            self.map.add(tiles.Door(Position(5,1)))
+            self.walk(s, 1)
+            assert_equal(get_path.call_count, 1)
+            self.map.remove(self.floors[4])
+            s.get_move()
+            assert_equal(get_path.call_count, 2)
+
+class DalekAITest(MonstersTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.game = context.GameContext(7)
+        with self.game:
+            self.map = maps.Map(None,Position(10,3),Mock(spec=player.Player),self.game)
+            self.map.player.pos = Position(8,1)
+            self.daleks = [monsters.Dalek(Position(x,1)) for x in (1,2)] + [monsters.BetterDalek(Position(3,1))]
+        for d in self.daleks:
+            self.map.add(d)
+
+    def sees(self, objs, angle_of_vis):
+        return [d.pos.x != 2 for d in objs]
+
+    def test_should_work_out_sight_for_all_daleks_at_once(self):
+        with patch.object(self.map, 'can_see_all', side_effect=self.sees) as can_see_all:
+            assert_equal([d.can_see_player() for d in self.daleks], [True, False, True])
+            can_see_all.assert_called_once_with(self.daleks, monsters.DalekAI.ANGLE_OF_VIS)
+
+    def test_should_work_out_sight_again_next_round(self):
+        with patch.object(self.map, 'can_see_all', side_effect=self.sees) as can_see_all:
+            self.daleks[0].can_see_player()
+            self.game.ticks += 1
+            self.daleks[1].can_see_player()
+            assert_equal(can_see_all.call_count, 2)
+
+    def test_should_work_out_sight_again_for_a_dalek_that_moved(self):
+        with patch.object(self.map, 'can_see_all', side_effect=self.sees) as can_see_all:
+            self.daleks[0].can_see_player()
+            self.map.move(self.daleks[1], Position(4,2))
+            assert_true(self.daleks[1].can_see_player())
+            can_see_all.assert_called_with([self.daleks[1]], monsters.DalekAI.ANGLE_OF_VIS)
@@ -0,0 +1,52 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+
+# item under test
+import context
+import interfaces
+import player
+import pregen
+import levelcache
+import snapshot
+import tiles
+
+class LevelPregeneratorTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.game = context.GameContext(77)
+        with self.game:
+            self.game.player = player.HeadlessPlayer(lambda p: '.')
+
+    def test_generated_level_should_attach_to_game(self):
+        data = levelcache.generate_level(77, (40,30))
+        with self.game:
+            m = snapshot.load_level(data, self.game)
+        p = self.game.player
+        assert_is(self.game.map, m)
+        assert_is(m.context, self.game)
+        assert_is(m.player, p)
+        assert_is(p.map, m)
+        assert_equal([s.pos for s in m.find_all(tiles.StairsUp, tiles.Tile)], [p.pos])
+        assert_equal(m.find_all(player.Player), [p])
+        monsters = m.get_monsters()
+        assert_greater(len(monsters), 0)
+        takers = [t() for t in self.game.turn_takers]
+        for t in takers:
+            assert_is(t.context, self.game)
+        for mon in monsters:
+            assert_in(mon, takers)
+        assert_true(m.has_native())
+
+    def test_should_hand_over_requested_level(self):
+        g = pregen.LevelPregenerator((40,30))
+        try:
+            g.request(77)
+            with self.game:
+                assert_is(g.take(context.GameContext(76)), None)
+                m = g.take(self.game)
+                assert_is(self.game.map, m)
+                assert_is(g.take(self.game), None)
+        finally:
+            g.close()
+        assert_is(m.player, self.game.player)
@@ -0,0 +1,128 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import Mock
+
+# lang imports
+import os
+import random
+import tempfile
+
+# item under test
+import context
+import interfaces
+import maps
+import player
+import replay
+import errors
+import ui
+
+def mock_player(turns):
+    p = Mock()
+    p.pos = interfaces.Position(1,1)
+    p.turns = turns
+    p.evidence = []
+    p.levels_seen = 1
+    p.map.checksum = Mock(return_value=1234)
+    return p
+
+class ReplayTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.recording = replay.Recording(10, (20,20), 2)
+
+    def test_should_record_keys_and_checkpoints(self):
+        r = replay.Recorder(self.recording)
+        r.record_key('k')
+        r.checkpoint(mock_player(1))
+        r.checkpoint(mock_player(2))
+        r.record_key(None)
+        r.finish(mock_player(3), replay.Recording.GAME_OVER)
+        assert_equal(self.recording.keys, ['k', None])
+        assert_equal(self.recording.checkpoints, [(2, replay.checksum(mock_player(2)))])
+        assert_equal(self.recording.final, (3, replay.checksum(mock_player(3))))
+
+    def test_should_not_record_end_state_of_stopped_game(self):
+        replay.Recorder(self.recording).finish(mock_player(3), replay.Recording.STOPPED)
+        assert_equal(self.recording.outcome, replay.Recording.STOPPED)
+        assert_is(self.recording.final, None)
+
+    def test_should_feed_recorded_keys_back_until_they_run_out(self):
+        self.recording.keys = ['k', '1']
+        r = replay.Replayer(self.recording)
+        assert_equal(r.next_key(), 'k')
+        assert_equal(r.next_key(), '1')
+        assert_raises(errors.ReplayEndError, r.next_key)
+
+    def test_should_check_checkpoints(self):
+        self.recording.checkpoints = [(2, replay.checksum(mock_player(2))), (4, 0)]
+        r = replay.Replayer(self.recording)
+        r.checkpoint(mock_player(2))
+        r.checkpoint(mock_player(3))
+        assert_equal(r.checked, 1)
+        assert_raises(errors.ReplayError, r.checkpoint, mock_player(4))
+        replay.Replayer(self.recording, verify=False).checkpoint(mock_player(4))
+
+    def test_should_check_outcome(self):
+        self.recording.outcome = replay.Recording.GAME_OVER
+        self.recording.final = (3, replay.checksum(mock_player(3)))
+        r = replay.Replayer(self.recording)
+        assert_raises(errors.ReplayError, r.finish, mock_player(3), replay.Recording.STOPPED)
+        assert_raises(errors.ReplayError, r.finish, mock_player(4), replay.Recording.GAME_OVER)
+        r.finish(mock_player(3), replay.Recording.GAME_OVER)
+
+    def test_should_save_and_load(self):
+        self.recording.keys = ['k', None, 'x']
+        self.recording.checkpoints = [(2, 99)]
+        self.recording.outcome = replay.Recording.GAME_OVER
+        self.recording.final = (3, 100)
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.recording.save(path)
+            r = replay.Recording.load(path)
+        finally:
+            os.remove(path)
+        for a in ('seed', 'size', 'checkpoint_every', 'keys', 'checkpoints', 'outcome', 'final'):
+            assert_equal(getattr(r, a), getattr(self.recording, a))
+
+    def test_should_record_player_keys(self):
+        game = context.GameContext(10)
+        game.recorder = replay.Recorder(self.recording)
+        with game:
+            p = player.HeadlessPlayer(Mock(return_value='k'))
+            assert_equal(p.handle_keys(), p.move_n)
+        assert_equal(self.recording.keys, ['k'])
+
+    def test_should_take_menu_choices_from_replay(self):
+        self.recording.keys = ['2']
+        game = context.GameContext(10)
+        game.recorder = replay.Replayer(self.recording)
+        with game:
+            m = ui.Menu(interfaces.Position(0,0), interfaces.Position(10,10))
+            m.add('1', "one")
+            m.add('2', "two")
+            assert_equal(m.get_key(), '2')
+
+    def test_should_replay_headless_game(self):
+        seed = 2003
+        size = interfaces.Position(60,40)
+        rng = random.Random(seed)
+        recording = replay.Recording(seed, size)
+        game = context.GameContext(seed)
+        game.recorder = replay.Recorder(recording)
+        with game:
+            game.player = player.HeadlessPlayer(lambda p: rng.choice('kjhlyubn.'))
+            game.map = maps.Map.random(seed, size, game.player, game)
+            game.map.generate()
+            outcome = replay.Recording.STOPPED
+            try:
+                while game.player.turns < 5:
+                    interfaces.TurnTaker.take_all_turns(game)
+            except (errors.GameOverError, errors.LevelWinError):
+                outcome = replay.Recording.GAME_OVER
+            game.recorder.finish(game.player, outcome)
+
+        r = replay.replay(recording, verify=False)
+        assert_is_instance(r.game.player, replay.ReplayPlayer)
+        assert_greater(r.game.player.turns, 0)
@@ -0,0 +1,37 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import patch
+
+# lang imports
+import random
+
+# item under test
+import libtcodpy as libtcod
+import sampling
+from sampling import WeightedSampler
+
+class WeightedSamplerTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.sampler = WeightedSampler([0.5, 0.0, 1.2, 0.8, 0.1])
+
+    def test_should_pick_first_index_whose_total_reaches_draw(self):
+        s = self.sampler
+        assert_equal([s.index(r) for r in (0.0, 0.5, 0.51, 1.7, 1.71, 2.6)], [0, 0, 2, 2, 3, 4])
+        assert_equal(s.locate(1.0)[0], 2)
+        assert_almost_equal(s.locate(1.0)[1], 0.5)
+
+    def test_should_match_legacy_walk(self):
+        rng = random.Random(2)
+        for i in range(1000):
+            r = rng.uniform(0.0, self.sampler.total)
+            with patch.object(sampling, 'LEGACY', True):
+                legacy = self.sampler.locate(r)
+            assert_equal(self.sampler.locate(r)[0], legacy[0])
+            assert_almost_equal(self.sampler.locate(r)[1], legacy[1])
+
+    def test_should_redraw_until_in_range(self):
+        with patch.object(libtcod, 'random_get_float', side_effect=[5.0, 2.8, 0.6]) as draw:
+            assert_equal(self.sampler.choose(None, 2.0), 2)
+        draw.assert_called_with(None, 0.0, self.sampler.total * 2.0)
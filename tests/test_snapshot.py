@@ -0,0 +1,110 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+
+# lang imports
+
+# item under test
+import libtcodpy as libtcod
+import context
+import interfaces
+import maps
+import player
+import snapshot
+import errors
+import sweep
+import tiles
+
+class SnapshotTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.game = context.GameContext(1234)
+        with self.game:
+            self.game.player = player.HeadlessPlayer(sweep.stair_runner)
+            self.game.map = maps.Map.random(1234, interfaces.Position(40,30), self.game.player, self.game)
+            self.game.map.generate()
+
+    def test_should_restore_map_contents(self):
+        g = snapshot.load(snapshot.save(self.game))
+        assert_equal(g.seed, self.game.seed)
+        assert_equal(g.player.pos, self.game.player.pos)
+        assert_equal(sorted(str(m) for m in g.map.get_monsters()), sorted(str(m) for m in self.game.map.get_monsters()))
+        assert_equal(len(g.map.get_items()), len(self.game.map.get_items()))
+        assert_is(g.player.map, g.map)
+        assert_is(g.map.context, g)
+
+    def test_should_preserve_turn_order(self):
+        g = snapshot.fork(self.game)
+        assert_equal([str(t()) for t in g.turn_takers], [str(t()) for t in self.game.turn_takers])
+
+    def test_should_continue_rng_streams(self):
+        for s in ('ai', 'talk'):
+            libtcod.random_get_int(self.game.rng(s), 0, 1000)
+        g = snapshot.fork(self.game)
+        for s in ('ai', 'talk', 'draw'):
+            assert_equal([libtcod.random_get_int(g.rng(s), 0, 1000) for i in range(5)],
+                         [libtcod.random_get_int(self.game.rng(s), 0, 1000) for i in range(5)])
+        assert_equal(libtcod.random_get_int(g.map.map_rng, 0, 1000), libtcod.random_get_int(self.game.map.map_rng, 0, 1000))
+
+    def test_should_rebuild_native_handles_when_used(self):
+        g = snapshot.copy(self.game)
+        assert_false(g.map.has_native())
+        assert_equal(g.map.checksum(), self.game.map.checksum())
+        p = g.player.pos
+        assert_equal(g.map.light_level(p), self.game.map.light_level(p))
+        assert_true(g.map.has_native())
+        assert_equal(g.map.checksum(), self.game.map.checksum())
+
+    def test_should_reject_bad_data(self):
+        assert_raises(errors.SnapshotError, snapshot.load, b'DR')
+        assert_raises(errors.SnapshotError, snapshot.load, b'nope' + snapshot.save(self.game)[4:])
+        assert_raises(errors.SnapshotError, snapshot.load, snapshot.HEADER.pack(snapshot.MAGIC, 99))
+
+    def test_fork_should_give_its_map_its_own_tiles(self):
+        g = snapshot.fork(self.game)
+        for t in self.game.map.find_all(tiles.Tile, tiles.Tile):
+            fs = g.map.find_all_at_pos(t.pos, tiles.Tile)
+            assert_equal([type(f) for f in fs], [type(o) for o in self.game.map.find_all_at_pos(t.pos, tiles.Tile)])
+            assert_false(t in fs)
+            assert_true(all(f.map is g.map for f in fs))
+        assert_is_not(g.player, self.game.player)
+
+    def test_fork_should_see_inert_tiles_without_changing_original(self):
+        t = [t for t in self.game.map.find_all(tiles.Tile, tiles.Tile) if t.is_inert and not t.has_been_seen][0]
+        g = snapshot.fork(self.game)
+        f = g.map.find_at_pos(t.pos, tiles.Tile)
+        f.has_been_seen = True
+        f.visible_to_player = not t.visible_to_player
+        assert_false(t.has_been_seen)
+        assert_not_equal(f.visible_to_player, t.visible_to_player)
+
+    def test_fork_should_be_ready_to_play(self):
+        g = snapshot.fork(self.game)
+        assert_true(g.map.has_native())
+        p = g.player.pos
+        assert_equal(g.map.light_level(p), self.game.map.light_level(p))
+        assert_equal(g.map.checksum(), self.game.map.checksum())
+
+    def test_fork_should_not_change_original(self):
+        crc = self.game.map.checksum()
+        pos = self.game.player.pos
+        g = snapshot.fork(self.game)
+        with g:
+            m = g.map.get_monsters()[0]
+            p = m.pos
+            g.map.remove(m)
+            g.player.move_to(p)
+        assert_equal(self.game.map.checksum(), crc)
+        assert_equal(self.game.player.pos, pos)
+        assert_not_equal(g.map.checksum(), crc)
+
+    def test_fork_should_relight_without_changing_original(self):
+        lights = [l for l in self.game.map.find_all(interfaces.LightSource) if l.remains_in_place]
+        levels = [self.game.map.light_level(l.pos) for l in lights]
+        g = snapshot.fork(self.game)
+        with g:
+            for l in g.map.find_all(interfaces.LightSource):
+                l.light_enabled = False
+            g.map.recalculate_lighting(statics=True)
+        assert_equal([self.game.map.light_level(l.pos) for l in lights], levels)
+        assert_not_equal([g.map.light_level(l.pos) for l in lights], levels)
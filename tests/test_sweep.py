@@ -0,0 +1,43 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import Mock
+
+# item under test
+import maps
+import sweep
+
+class SweepTest(DalekTest):
+    def test_should_yield_results_in_seed_order(self):
+        seeds = [2003, 2000, 2001]
+        progress = Mock()
+        rs = list(sweep.sweep(seeds, processes=2, progress=progress))
+        assert_equal([r.seed for r in rs], seeds)
+        assert_equal(progress.call_count, len(seeds))
+        for r in rs:
+            assert_equal(r.outcome, sweep.SweepResult.GENERATED, r.error)
+            assert_equal(r.monsters, 15)
+            assert_greater_equal(r.rooms, maps.TypeAMap.MIN_ROOMS)
+            assert_greater(r.path_length, 0.0)
+
+    def test_should_generate_same_level_for_same_seed(self):
+        r1 = sweep.run_seed(2001)
+        sweep.run_seed(2000)
+        r2 = sweep.run_seed(2001)
+        assert_equal(r1.as_row()[3:], r2.as_row()[3:])
+
+    def test_should_retry_rejected_layouts(self):
+        # this seed used to grow rooms forever at this size
+        r = sweep.run_seed(55, size=(40,30))
+        assert_equal(r.outcome, sweep.SweepResult.GENERATED, r.error)
+        assert_greater(r.layouts, 1)
+
+    def test_should_play_headless_game_until_outcome(self):
+        r = sweep.run_seed(2000, play=True, max_turns=5)
+        assert_in(r.outcome, (sweep.SweepResult.WIN, sweep.SweepResult.CAUGHT, sweep.SweepResult.TIMEOUT), r.error)
+        assert_less_equal(r.turns, 5)
+
+    def test_should_report_errors_without_raising(self):
+        r = sweep.run_seed(2000, play=True, policy=Mock(side_effect=ValueError("bad policy")))
+        assert_equal(r.outcome, sweep.SweepResult.ERROR)
+        assert_in("bad policy", r.error)
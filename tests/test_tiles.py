@@ -0,0 +1,105 @@
+# test imports
+from unit_environment import DalekTest
+from nose.tools import *
+from mock import Mock
+
+# lang imports
+import random
+
+# item under test
+import maps
+import player
+import tiles
+from tiles import MapPattern
+from interfaces import Position
+
+FLAGS = [MapPattern.EMPTY, MapPattern.CORRIDOR, MapPattern.ROOM, MapPattern.WALL, MapPattern.DOOR,
+         MapPattern.ROOM|MapPattern.LIGHT, MapPattern.CORRIDOR|MapPattern.SPECIAL]
+
+def random_map(rng, w, h):
+    return [[rng.choice(FLAGS) for y in range(h)] for x in range(w)]
+
+def all_patterns():
+    ps = []
+    for T in [tiles.FloorTeleport,tiles.FloorCharger,tiles.Crate,tiles.Window,tiles.Table,tiles.Locker,
+              tiles.EvidencePanel,tiles.LightSwitch,tiles.ClankyFloor,tiles.TripWire,tiles.CameraConsole,tiles.TrapConsole]:
+        ps += T.patterns
+    return ps
+
+class MapPatternTest(DalekTest):
+    def test_should_match_every_rotation(self):
+        p = MapPattern("###",
+                       "...",
+                       "###")
+        for m in ([[MapPattern.WALL, MapPattern.ROOM, MapPattern.WALL] for x in range(3)],
+                  [[MapPattern.WALL]*3, [MapPattern.ROOM]*3, [MapPattern.WALL]*3]):
+            # once per matching rotation
+            assert_equal(set(p.apply_to(m)), set([Position(1,1)]))
+            assert_equal(p.apply_to(m), p._apply_to_lists(m))
+
+    def test_empty_cell_should_match_wall(self):
+        p = MapPattern("###",
+                       "#.#",
+                       "###")
+        m = [[0, 0, 0], [0, MapPattern.CORRIDOR, 0], [0, 0, 0]]
+        assert_equal(p.apply_to(m), p._apply_to_lists(m))
+        assert_not_equal(p.apply_to(m), [])
+
+    def test_should_match_as_python_loop_does(self):
+        if not tiles.numpy_available:
+            return
+        rng = random.Random(4)
+        for (w, h) in [(30, 20), (3, 3), (2, 9)]:
+            m = random_map(rng, w, h)
+            for p in all_patterns():
+                assert_equal(p.apply_to(m), p._apply_to_lists(m))
+
+class PatternMatcherTest(DalekTest):
+    def test_should_match_as_each_pattern_does(self):
+        if not tiles.numpy_available:
+            return
+        rng = random.Random(5)
+        ps = all_patterns()
+        matcher = tiles.PatternMatcher(ps)
+        for (w, h) in [(30, 20), (3, 3), (2, 9)]:
+            m = random_map(rng, w, h)
+            assert_equal(matcher.apply_to(m), [p._apply_to_lists(m) for p in ps])
+
+    def test_should_compile_once(self):
+        if not tiles.numpy_available:
+            return
+        ps = all_patterns()
+        assert_is(tiles.PatternMatcher.compiled(ps), tiles.PatternMatcher.compiled(list(ps)))
+
+class FlyweightTileTest(DalekTest):
+    def setUp(self):
+        DalekTest.setUp(self)
+        self.map = maps.Map(None, Position(4,4), Mock(spec_set=player.Player))
+
+    def test_should_share_properties_between_instances(self):
+        f = tiles.Floor(Position(1,1))
+        assert_equal(vars(f), {'pos': Position(1,1)})
+        assert_equal((f.symbol, f.walk_cost, f.transparency), ('.', 1.0, 1.0))
+        assert_false(f.blocks_movement())
+        assert_true(tiles.Wall(Position(0,0)).blocks_light())
+
+    def test_should_keep_seen_and_visible_per_cell(self):
+        (f, d) = (tiles.Floor(Position(1,2)), tiles.Door(Position(1,2)))
+        w = tiles.Wall(Position(2,1))
+        for t in (f, d, w):
+            self.map.add(t)
+        f.has_been_seen = True
+        assert_true(d.has_been_seen)
+        assert_false(w.has_been_seen)
+        assert_equal(self.map.cell_flags[1*4+2], tiles.Tile.CELL_SEEN)
+        d.visible_to_player = True
+        d.visible_to_player = False
+        assert_false(f.visible_to_player)
+        assert_true(f.has_been_seen)
+
+    def test_should_keep_flags_on_tile_when_off_map(self):
+        f = tiles.Floor(Position(1,1))
+        assert_false(f.has_been_seen)
+        f.visible_to_player = True
+        assert_true(f.visible_to_player)
+        assert_equal(self.map.cell_flags, bytearray(16))
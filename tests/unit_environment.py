@@ -2,9 +2,14 @@
 
 import unittest
 
+import libtcodpy as libtcod
+
+# some tests mock out libtcod functions and leave them that way
+LIBTCOD = dict(vars(libtcod))
+
 class DalekTest(unittest.TestCase):
     def setUp(self):
-        pass
+        vars(libtcod).update(LIBTCOD)
 
     def tearDown(self):
         pass
@@ -4,11 +4,18 @@ import libtcodpy as libtcod
 from interfaces import Mappable, Traversable, Transparent, TurnTaker, CountUp, Position, Activatable, HasInventory, Shouter, Talker, StatusEffect, LightSource, FlatLightSource, Alertable
 from errors import LevelWinError, InvalidMoveError
 from ui import HBar, Menu
+from context import GameContext
 
 from functools import reduce
 import re # for sub
 import weakref
 
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
 #possibly belongs in maps.py
 class MapPattern:
     # static constants used for map generation
@@ -76,8 +83,41 @@ class MapPattern:
             del self.masks[2:3]
 
         # convert each row from list to 
+        if numpy_available:
+            self.__mask_arrays = [numpy.array(m) for m in self.masks]
 
     def apply_to(self,map_array):
+        """list of positions in map_array (flags, indexed [x][y]) where pattern matches, once for every rotation
+        that matches there. map_array may be a list of lists or a 2d numpy array"""
+        if numpy_available:
+            return self.__apply_to_array(numpy.asarray(map_array))
+        return self._apply_to_lists(map_array)
+
+    def __apply_to_array(self,a):
+        """apply_to, matching each rotation at every position at once"""
+        kw2 = len(self.masks[0])//2
+        kh2 = len(self.masks[0][0])//2
+        (w,h) = a.shape
+        if w <= kw2*2 or h <= kh2*2:
+            return []
+        iw = w-kw2*2
+        ih = h-kh2*2
+        empty = a == 0
+        ok = numpy.ones((iw,ih,len(self.masks)), dtype=bool)
+        for (i,mask) in enumerate(self.__mask_arrays):
+            for kci in range(kw2*2+1):
+                for kri in range(kh2*2+1):
+                    m = int(mask[kci,kri])
+                    # cell matches if it shares a flag with the mask, or is empty and the mask allows wall
+                    hit = (a[kci:kci+iw,kri:kri+ih] & m) != 0
+                    if m & MapPattern.WALL:
+                        hit |= empty[kci:kci+iw,kri:kri+ih]
+                    ok[:,:,i] &= hit
+        # nonzero() goes in x, y, rotation order: the order _apply_to_lists finds them in
+        (xs,ys,rs) = numpy.nonzero(ok)
+        return [Position(int(x)+kw2,int(y)+kh2) for (x,y) in zip(xs,ys)]
+
+    def _apply_to_lists(self,map_array):
         r   = []
         kw2 = len(self.masks[0])//2
         kh2 = len(self.masks[0][0])//2
@@ -105,10 +145,122 @@ class MapPattern:
     def __hash__(self):
         return self.__hash
 
+
+class PatternMatcher:
+    """Several MapPatterns compiled to be matched together, in one pass over the map.
+
+    Each kernel cell of each rotation is a test (offset from centre, mask). The tests of every rotation are put in one
+    tree, most shared first, so that rotations and patterns with cells in common (e.g. a row of wall) share the work
+    of matching them. Matching tests each distinct mask against the map once, then walks the tree."""
+    __compiled = {} # tuple of patterns: PatternMatcher
+
+    @staticmethod
+    def compiled(patterns):
+        """PatternMatcher for patterns, compiled once and reused for every level"""
+        key = tuple(patterns)
+        if not key in PatternMatcher.__compiled:
+            PatternMatcher.__compiled[key] = PatternMatcher(key)
+        return PatternMatcher.__compiled[key]
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+        # tests for each rotation of each pattern
+        rotations = [] # (pattern index, [(dx,dy,mask)])
+        for (pi,p) in enumerate(self.patterns):
+            for mask in p.masks:
+                kw2 = len(mask)//2
+                kh2 = len(mask[0])//2
+                rotations.append( (pi, [(kci-kw2,kri-kh2,mask[kci][kri]) for kci in range(len(mask)) for kri in range(len(mask[kci]))]) )
+
+        # commonest tests first, to share as much of the tree as possible
+        count = {}
+        for (pi,tests) in rotations:
+            for t in tests:
+                count[t] = count.get(t,0)+1
+        order = lambda t: (-count[t],t)
+
+        # tree of tests; a node is [{test: child node}, [rotation indices that end here]]
+        self.__tree = [{},[]]
+        for (ri,(pi,tests)) in enumerate(rotations):
+            node = self.__tree
+            for t in sorted(set(tests), key=order):
+                node = node[0].setdefault(t, [{},[]])
+            node[1].append(ri)
+
+        self.__rotation_pattern = [pi for (pi,tests) in rotations]
+        self.__masks  = sorted(set(t[2] for t in count.keys()))
+        self.__border = max([0]+[max(abs(t[0]),abs(t[1])) for t in count.keys()])
+
+    def apply_to(self, map_array):
+        """list of MapPattern.apply_to(map_array) for each pattern. map_array is a 2d numpy array"""
+        a = numpy.asarray(map_array)
+        (w,h) = a.shape
+        b = self.__border
+
+        # cells that pass each mask, with a border that passes nothing so tests can't match off the edge
+        empty = a == 0
+        planes = {}
+        for m in self.__masks:
+            plane = numpy.zeros((w+b*2,h+b*2), dtype=bool)
+            hit = plane[b:b+w,b:b+h]
+            numpy.not_equal(a & m, 0, out=hit)
+            if m & MapPattern.WALL:
+                hit |= empty
+            planes[m] = plane
+
+        # walk the tree, and-ing in each test
+        found = [None]*len(self.__rotation_pattern)
+        stack = [(self.__tree, numpy.ones((w,h), dtype=bool))]
+        while len(stack) > 0:
+            ((children,ends),ok) = stack.pop()
+            for ri in ends:
+                found[ri] = ok
+            for ((dx,dy,m),child) in children.items():
+                stack.append( (child, ok & planes[m][b+dx:b+dx+w,b+dy:b+dy+h]) )
+
+        # as MapPattern.apply_to: positions in x, y, rotation order, once for each rotation
+        r = []
+        for pi in range(len(self.patterns)):
+            ok = numpy.stack([found[ri] for ri in range(len(found)) if self.__rotation_pattern[ri] == pi], axis=2)
+            (xs,ys,rs) = numpy.nonzero(ok)
+            r.append([Position(int(x),int(y)) for (x,y) in zip(xs,ys)])
+        return r
+
+
+class _CellFlag:
+    """flag of a Tile that is kept per cell, in its map's cell_flags, rather than on the tile: every tile in a cell
+    is seen, or visible, at once. Kept on the tile while it isn't on a map"""
+    def __init__(self, name, flag):
+        self.name = name
+        self.flag = flag
+
+    def __get__(self, obj, T):
+        if obj is None:
+            return self
+        if obj.map is None:
+            return obj.__dict__.get(self.name, False)
+        return obj.map.cell_flags[obj.pos.x * obj.map.size.y + obj.pos.y] & self.flag != 0
+
+    def __set__(self, obj, value):
+        if obj.map is None:
+            obj.__dict__[self.name] = value
+        elif value:
+            obj.map.cell_flags[obj.pos.x * obj.map.size.y + obj.pos.y] |= self.flag
+        else:
+            obj.map.cell_flags[obj.pos.x * obj.map.size.y + obj.pos.y] &= ~self.flag & 0xFF
+
+
 class Tile(Traversable,Transparent,Mappable):
     patterns  = []
     place_min = 1
     place_max = 10
+    is_inert  = False # never changes during play, so forks of the game needn't pickle it (see snapshot.fork)
+
+    CELL_SEEN    = 0x1
+    CELL_VISIBLE = 0x2
+    has_been_seen     = _CellFlag('has_been_seen', CELL_SEEN)
+    visible_to_player = _CellFlag('visible_to_player', CELL_VISIBLE)
 
     def __init__(self, pos, symbol, colour, walk_cost=0.0, transparency=0.0, may_block_movement=False):
         """walk_cost == 0.0  =>  can't traverse tile
@@ -158,9 +310,19 @@ class Tile(Traversable,Transparent,Mappable):
                     pattern_map[p] = []
                 pattern_map[p].append(T)
         
+        if numpy_available:
+            map_array = numpy.asarray(map_array)
+            if map_array.max() <= 0xFF:
+                map_array = map_array.astype(numpy.uint8)
+
+        if numpy_available:
+            # match every pattern in one pass
+            p_lists = PatternMatcher.compiled(pattern_map.keys()).apply_to(map_array)
+        else:
+            p_lists = [p.apply_to(map_array) for p in pattern_map.keys()]
+
         r = {}
-        for (p,T_list) in pattern_map.items():
-            p_list = p.apply_to(map_array)
+        for (T_list,p_list) in zip(pattern_map.values(),p_lists):
             for T in T_list:
                 if not T in r.keys():
                     r[T] = []
@@ -216,9 +378,35 @@ class CanHaveEvidence:
         return not self.evidence is None
     
 
-class Wall(Tile):
+class FlyweightTile(Tile):
+    """Tile that is the same wherever it is, e.g. plain floor and walls, which make up most of a map.
+    Its appearance and properties are class attributes, shared by every instance rather than set up on each by
+    Tile.__init__, so an instance holds only its position and map"""
+    is_inert           = True
+    remains_in_place   = True
+    is_visible         = True
+    unseen_colour      = Mappable.UNSEEN_COLOUR
+    walk_cost          = 0.0
+    may_block_movement = False
+    transparency       = 0.0
+    map                = None
+    last_pos           = None # never moves
+
     def __init__(self, pos):
-        Tile.__init__(self, pos, '#', libtcod.light_grey)
+        self.pos = pos
+
+    def view(self):
+        """this tile, for another map to have as its own (e.g. a fork's; see snapshot.fork). There's nothing to a
+        flyweight but its position, so it's as good as a copy, but quicker to make than a pickled one"""
+        v = object.__new__(type(self))
+        v.pos = self.pos
+        return v
+
+
+class Wall(FlyweightTile):
+    symbol        = '#'
+    unseen_symbol = '#'
+    colour        = libtcod.light_grey
 
     #@property
     #def light_level(self):
@@ -256,6 +444,17 @@ class LightSwitch(WallPanel,Shouter):
         Shouter.__init__(self,15)
         self.switch_lights = None
 
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        if not self.switch_lights is None:
+            d['switch_lights'] = list(self.switch_lights)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        if not self.switch_lights is None:
+            self.switch_lights = weakref.WeakSet(self.switch_lights)
+
     def try_movement(self,obj):
         if self.switch_lights is None:
             self.switch_lights = weakref.WeakSet()
@@ -300,7 +499,7 @@ class Locker(WallPanel,CanHaveEvidence):
                 obj.pickup(self.evidence)
 
             else:
-                i = Item.random(None,None,weight=1.2)
+                i = Item.random(self.map.context.rng('items'),None,weight=1.2)
                 if not obj.pickup(i):
                     i.pos = obj.pos
                     i.is_visible = True
@@ -359,9 +558,12 @@ class Table(Tile,Activatable):
         # prevent leaving if in crate
         return not obj is self.owner
 
-class Floor(Tile):
-    def __init__(self, pos):
-        Tile.__init__(self, pos, '.', libtcod.dark_grey, 1.0, 1.0)
+class Floor(FlyweightTile):
+    symbol        = '.'
+    unseen_symbol = '.'
+    colour        = libtcod.dark_grey
+    walk_cost     = 1.0
+    transparency  = 1.0
 
 class ClankyFloor(Tile,Talker,Shouter):
     patterns = [
@@ -373,7 +575,7 @@ class ClankyFloor(Tile,Talker,Shouter):
     place_max = 25
 
     def __init__(self, pos):
-        Floor.__init__(self, pos)
+        Tile.__init__(self, pos, '.', libtcod.dark_grey, 1.0, 1.0)
         Talker.__init__(self)
         Shouter.__init__(self, 15)
         self.add_phrases('ON',['** CLONK **','** CLANK **'],0.8)
@@ -397,8 +599,10 @@ class Light(Tile,LightSource):
         LightSource.__init__(self,r,intensity,light_colour)
 
 class FlatLight(Floor,FlatLightSource):
+    is_inert = False
+
     def __init__(self, pos, size, intensity=1.0, light_colour=Mappable.LIGHT_H_CLAMP):
-        Floor.__init__(self, pos)
+        Tile.__init__(self, pos, '.', libtcod.dark_grey, 1.0, 1.0)
         FlatLightSource.__init__(self,size,intensity,light_colour)
 
 # TODO: is this an interface?
@@ -422,9 +626,10 @@ class TripWire(Floor,Talker,Shouter,TurnTaker,Trap):
         ]
     place_min = 3
     place_max = 7
+    is_inert  = False
 
     def __init__(self, pos):
-        Floor.__init__(self, pos)
+        Tile.__init__(self, pos, '.', libtcod.dark_grey, 1.0, 1.0)
         Talker.__init__(self)
         Shouter.__init__(self, 30)
         TurnTaker.__init__(self,0)
@@ -442,7 +647,7 @@ class TripWire(Floor,Talker,Shouter,TurnTaker,Trap):
         return self.walk_cost
 
     def draw(self):
-        if libtcod.random_get_float(None,0.0,1.0) < self.show_probability:
+        if libtcod.random_get_float(self.map.context.rng('draw'),0.0,1.0) < self.show_probability:
             self._show_wire()
         else:
             self._hide_wire()
@@ -594,6 +799,8 @@ class Door(Tile,CountUp,TurnTaker):
         self.count_to = state_dat['timer']
         self.bar.fgcolours = [state_dat['barcolour']]
         self.reset()
+        if not self.map is None:
+            self.map.tile_changed(self.pos)
 
     def try_movement(self, obj):
         if self.state is Door.OPEN:
@@ -697,7 +904,7 @@ class FloorTeleport(Tile):
             if len(targets) == 0:
                 pass # oops, only one telepad on the level
             else:
-                obj.move_to( targets[libtcod.random_get_int(None,0,len(targets)-1)].pos )
+                obj.move_to( targets[libtcod.random_get_int(self.map.context.rng('tiles'),0,len(targets)-1)].pos )
 
         except InvalidMoveError:
             pass # teleport exit blocked?
@@ -738,11 +945,9 @@ class CameraConsole(CountUpTile):
     place_min = 1
     place_max = 2
 
-    cameras_on = True
-
     def __init__(self,pos):
         CountUpTile.__init__(self, pos, 'C', libtcod.purple, 1.0, 1.0, count_up=7)
-        CameraConsole.cameras_on = True # expect this only to be called during map generation
+        GameContext.current().cameras_on = True # expect this only to be called during map generation
         self.can_be_remote_controlled = True
 
     def activate(self, activator=None):
@@ -751,7 +956,7 @@ class CameraConsole(CountUpTile):
             yu = self.map.size.y//4
             b = Menu( Position(xu,yu), Position(xu*2,yu*2), title="Camera Control" )
             b.add('1',"View cameras")
-            b.add('2',"Switch %s cameras" %(CameraConsole.cameras_on and 'off' or 'on'))
+            b.add('2',"Switch %s cameras" %(self.map.context.cameras_on and 'off' or 'on'))
             b.add('x',"Exit")
 
             c = b.get_key()
@@ -761,18 +966,18 @@ class CameraConsole(CountUpTile):
 
             if c == '1':
                 for cam in cams:
-                    self.map.prepare_fov(cam.pos,reset=False)
+                    self.map.add_view(cam.pos)
                 self.map.player.handle_keys()
 
             elif c == '2':
-                if CameraConsole.cameras_on:
+                if self.map.context.cameras_on:
                     for cam in cams:
                         cam.add_effect(StatusEffect.BLIND)
                 else:
                     for cam in cams:
                         cam.remove_effect(StatusEffect.BLIND)
 
-                CameraConsole.cameras_on = not CameraConsole.cameras_on
+                self.map.context.cameras_on = not self.map.context.cameras_on
 
             return True
         return False
@@ -787,11 +992,9 @@ class TrapConsole(CountUpTile):
     place_min = 1
     place_max = 2
 
-    traps_on = True
-
     def __init__(self,pos):
         CountUpTile.__init__(self, pos, 'T', libtcod.purple, 1.0, 1.0, count_up=7)
-        TrapConsole.traps_on = True # expect this only to be called during map generation
+        GameContext.current().traps_on = True # expect this only to be called during map generation
         self.can_be_remote_controlled = True
 
     def activate(self, activator=None):
@@ -800,7 +1003,7 @@ class TrapConsole(CountUpTile):
             yu = self.map.size.y//4
             b = Menu( Position(xu,yu), Position(xu*2,yu*2), title="Trap Control" )
             b.add('1',"View traps")
-            b.add('2',"%s traps" %(TrapConsole.traps_on and 'Disable' or 'Enable'))
+            b.add('2',"%s traps" %(self.map.context.traps_on and 'Disable' or 'Enable'))
             b.add('3',"Set off traps")
             b.add('x',"Exit")
 
@@ -816,9 +1019,9 @@ class TrapConsole(CountUpTile):
 
             elif c == '2':
                 for trap in traps:
-                    trap.enabled = TrapConsole.traps_on
+                    trap.enabled = self.map.context.traps_on
 
-                TrapConsole.traps_on = not TrapConsole.traps_on
+                self.map.context.traps_on = not self.map.context.traps_on
 
             elif c == '3':
                 for trap in traps:
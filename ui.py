@@ -4,9 +4,9 @@ import weakref
 
 import libtcodpy as libtcod
 
+from context import GameContext
+
 class UI:
-    ui_elements = []
-    timeout_register = {}
 
     # abstraction of tcod coloured text control constants (also see map in DalekRL.py)
     COLCTRL_RED    = libtcod.COLCTRL_1
@@ -17,7 +17,8 @@ class UI:
     COLCTRL_STOP   = libtcod.COLCTRL_STOP  # for consistency
 
     def __init__(self):
-        UI.ui_elements.append(weakref.ref(self))
+        self.context = GameContext.current()
+        self.context.ui_elements.append(weakref.ref(self))
         self.is_visible = False
         self._timeout = 0.0
 
@@ -26,46 +27,53 @@ class UI:
         return self._timeout
     @timeout.setter
     def timeout(self,t):
+        register = self.context.timeout_register
         if self._timeout > 0.0:
-            UI.timeout_register[self._timeout] -= 1
-            if UI.timeout_register[self._timeout] == 0:
-                UI.timeout_register.remove(self._timeout)
+            register[self._timeout] -= 1
+            if register[self._timeout] == 0:
+                register.remove(self._timeout)
         if t > 0.0:
-            UI.timeout_register[t] = UI.timeout_register.get(t,0) + 1
+            register[t] = register.get(t,0) + 1
         self._timeout = t
     @timeout.deleter
     def timeout(self):
         del self._timeout
 
     @staticmethod
-    def need_update(timeout):
-        return timeout == 0.0 or timeout in UI.timeout_register.keys()
+    def need_update(timeout, context=None):
+        if context is None:
+            context = GameContext.current()
+        return timeout == 0.0 or timeout in context.timeout_register.keys()
 
     @staticmethod
-    def draw_all(timeout):
-        for eref in UI.ui_elements:
+    def draw_all(timeout, context=None):
+        if context is None:
+            context = GameContext.current()
+        for eref in context.ui_elements:
             e = eref()
             if e is None:
-                UI.ui_elements.remove(eref)
+                context.ui_elements.remove(eref)
             else:
                 if e.is_visible:
                     if e.timeout==0.0 or e.timeout>timeout:
                         e.draw()
         #if timeout == 0.0:
-        #    print("%d UI elements"%len(UI.ui_elements))
+        #    print("%d UI elements"%len(context.ui_elements))
 
     @staticmethod
-    def clear_all():
-        for eref in UI.ui_elements:
+    def clear_all(context=None):
+        if context is None:
+            context = GameContext.current()
+        for eref in context.ui_elements:
             e = eref()
             if e is not None:
                 e.is_visible = False
                 del e
-        UI.ui_elements = []
+        context.ui_elements = []
 
     def refresh_ui_list(self):
-        if not weakref.ref(self) in UI.ui_elements:
-            UI.ui_elements.append(weakref.ref(self))
+        if not weakref.ref(self) in self.context.ui_elements:
+            self.context.ui_elements.append(weakref.ref(self))
 
 
 class Message(UI):
@@ -248,6 +256,10 @@ class Menu(Box):
         return True
 
     def get_key(self):
+        recorder = self.context.recorder
+        if not recorder is None and recorder.is_replaying:
+            return recorder.next_key()
+
         self.is_visible = True
         r = None
         while 1:
@@ -271,4 +283,6 @@ class Menu(Box):
 
         # TODO: player.redraw_screen()
 
+        if not recorder is None:
+            recorder.record_key(r)
         return r